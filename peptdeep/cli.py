@@ -113,10 +113,30 @@ _help_str = (
 
 @run.command("library", help="Predict library for DIA search." + _help_str)
 @click.argument("settings_yaml", type=str)
-def _library(settings_yaml: str):
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Only estimate the precursor number, peak memory, disk size and "
+    "wall time of the library run, and recommend batch and thread settings.",
+)
+@click.option(
+    "--plan-protein-num",
+    default=500,
+    type=int,
+    show_default=True,
+    help="Number of fasta proteins to sample for --plan.",
+)
+def _library(settings_yaml: str, plan: bool, plan_protein_num: int):
+    load_global_settings(settings_yaml)
+    if plan:
+        from peptdeep.spec_lib.library_planner import plan_library, format_library_plan
+
+        click.echo(format_library_plan(plan_library(plan_protein_num)))
+        return
+
     from peptdeep.pipeline_api import generate_library
 
-    load_global_settings(settings_yaml)
     generate_library()
 
 
@@ -1,7 +1,9 @@
-from sklearn.neighbors import KNeighborsRegressor
+import numba
 import pandas as pd
 import numpy as np
 
+from peptdeep.mass_spec.match import SparseMatchedFragments
+
 
 def get_fragment_median(start_end_idxes: tuple, frag_df: pd.DataFrame):
     start_idx, end_idx = start_end_idxes
@@ -17,29 +19,137 @@ def calibrate_one(start_end_shift, frag_df):
     frag_df.values[int(start_idx) : int(end_idx)] -= mass_shift
 
 
+@numba.njit(parallel=True, nogil=True)
+def _get_fragment_medians(
+    mass_errs: np.ndarray, frag_start_idxes: np.ndarray, frag_stop_idxes: np.ndarray
+) -> np.ndarray:
+    """Median of the finite mass errors in rows [start, stop) of
+    each PSM, 0.0 if none of them is finite.
+    `mass_errs` is a 2-D array, np.inf or np.nan means not matched."""
+    medians = np.zeros(len(frag_start_idxes))
+    for i in numba.prange(len(frag_start_idxes)):
+        buffer = np.empty(
+            (frag_stop_idxes[i] - frag_start_idxes[i]) * mass_errs.shape[1]
+        )
+        n = 0
+        for row in range(frag_start_idxes[i], frag_stop_idxes[i]):
+            for col in range(mass_errs.shape[1]):
+                if np.isfinite(mass_errs[row, col]):
+                    buffer[n] = mass_errs[row, col]
+                    n += 1
+        if n > 0:
+            medians[i] = np.median(buffer[:n])
+    return medians
+
+
+@numba.njit(parallel=True, nogil=True)
+def _shift_fragments(
+    mass_errs: np.ndarray,
+    frag_start_idxes: np.ndarray,
+    frag_stop_idxes: np.ndarray,
+    mass_shifts: np.ndarray,
+):
+    """Subtract mass_shifts[i] from rows [start, stop) of each PSM in place"""
+    for i in numba.prange(len(frag_start_idxes)):
+        for row in range(frag_start_idxes[i], frag_stop_idxes[i]):
+            for col in range(mass_errs.shape[1]):
+                mass_errs[row, col] -= mass_shifts[i]
+
+
+@numba.njit(parallel=True, nogil=True)
+def _knn_predict_sorted(
+    sorted_xs: np.ndarray,
+    sorted_ys: np.ndarray,
+    query_xs: np.ndarray,
+    n_neighbors: int,
+) -> np.ndarray:
+    """Mean y of the `n_neighbors` nearest x of each query in 1-D.
+    The neighbors form a window around the insertion position of the query
+    in `sorted_xs`, which is grown towards the nearer side."""
+    n_neighbors = min(n_neighbors, len(sorted_xs))
+    preds = np.zeros(len(query_xs))
+    if n_neighbors == 0:
+        return preds
+    for i in numba.prange(len(query_xs)):
+        x = query_xs[i]
+        left = np.searchsorted(sorted_xs, x)
+        right = left
+        for _ in range(n_neighbors):
+            if left == 0:
+                right += 1
+            elif right == len(sorted_xs):
+                left -= 1
+            elif x - sorted_xs[left - 1] <= sorted_xs[right] - x:
+                left -= 1
+            else:
+                right += 1
+        preds[i] = sorted_ys[left:right].mean()
+    return preds
+
+
+def _get_sparse_frag_ranges(
+    psm_df: pd.DataFrame, sparse_matched: SparseMatchedFragments
+) -> tuple:
+    """Ranges of each PSM in the sparse entries"""
+    return (
+        np.searchsorted(sparse_matched.frag_rows, psm_df.frag_start_idx.values),
+        np.searchsorted(sparse_matched.frag_rows, psm_df.frag_stop_idx.values),
+    )
+
+
 class MassCalibratorForRT_KNN:
-    """Using KNN to calibrate measured m/z across RT."""
+    """Calibrate fragment mass errors across RT with the mean median
+    mass error of the `n_neighbors` nearest PSMs in RT (kNN regression).
+    `mass_error_df` can be a dataframe or :class:`SparseMatchedFragments`,
+    mass errors are shifted in place."""
 
     def __init__(self, n_neighbors=5):
         self._n_neighbors = n_neighbors
-        self.model = KNeighborsRegressor(n_neighbors)
+        self._sorted_rts = np.empty(0)
+        self._sorted_mass_shifts = np.empty(0)
 
     def fit(self, psm_df: pd.DataFrame, mass_error_df: pd.DataFrame):
-        mass_error_df = mass_error_df.replace(np.inf, np.nan)
-        mean_merrs = (
-            psm_df[["frag_start_idx", "frag_stop_idx"]]
-            .apply(get_fragment_median, axis=1, frag_df=mass_error_df)
-            .values
+        if isinstance(mass_error_df, SparseMatchedFragments):
+            mass_errs = mass_error_df.mz_errs.reshape(-1, 1)
+            frag_starts, frag_stops = _get_sparse_frag_ranges(psm_df, mass_error_df)
+        else:
+            mass_errs = mass_error_df.values
+            frag_starts = psm_df.frag_start_idx.values
+            frag_stops = psm_df.frag_stop_idx.values
+        median_merrs = _get_fragment_medians(
+            mass_errs,
+            frag_starts.astype(np.int64),
+            frag_stops.astype(np.int64),
+        )
+        rts = psm_df.rt.values.astype(np.float64)
+        order = np.argsort(rts, kind="stable")
+        self._sorted_rts = rts[order]
+        self._sorted_mass_shifts = median_merrs[order]
+
+    def predict(self, rts: np.ndarray) -> np.ndarray:
+        """Predict the mass shifts at the given RTs"""
+        return _knn_predict_sorted(
+            self._sorted_rts,
+            self._sorted_mass_shifts,
+            np.asarray(rts, dtype=np.float64),
+            self._n_neighbors,
         )
-        self.model.fit(psm_df.rt.values.reshape((-1, 1)), mean_merrs.reshape(-1, 1))
 
     def calibrate(
         self, psm_df: pd.DataFrame, mass_error_df: pd.DataFrame
     ) -> pd.DataFrame:
-        psm_df["frag_mass_shift"] = self.model.predict(
-            psm_df.rt.values.reshape((-1, 1))
-        ).reshape(-1)
-        psm_df[["frag_start_idx", "frag_stop_idx", "frag_mass_shift"]].apply(
-            calibrate_one, axis=1, frag_df=mass_error_df
-        ).values
+        psm_df["frag_mass_shift"] = self.predict(psm_df.rt.values)
+        if isinstance(mass_error_df, SparseMatchedFragments):
+            mass_errs = mass_error_df.mz_errs.reshape(-1, 1)
+            frag_starts, frag_stops = _get_sparse_frag_ranges(psm_df, mass_error_df)
+        else:
+            mass_errs = mass_error_df.values
+            frag_starts = psm_df.frag_start_idx.values
+            frag_stops = psm_df.frag_stop_idx.values
+        _shift_fragments(
+            mass_errs,
+            frag_starts.astype(np.int64),
+            frag_stops.astype(np.int64),
+            psm_df.frag_mass_shift.values.astype(mass_errs.dtype),
+        )
         return mass_error_df
@@ -2,11 +2,15 @@ import numpy as np
 import numba
 import pandas as pd
 import tqdm
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from alphabase.peptide.fragment import (
     create_fragment_mz_dataframe,
     get_charged_frag_types,
 )
+from peptdeep.settings import global_settings
 from peptdeep.mass_spec.ms_reader import ms2_reader_provider, MSReaderBase
 
 
@@ -157,7 +161,112 @@ def match_first_last_profile_mz(
     return first_indices, last_indices
 
 
-@numba.njit
+@numba.njit(nogil=True, inline="always")
+def _match_centroid_one_mz(
+    query_mz: float,
+    all_spec_mzs: np.ndarray,
+    peak_start: int,
+    peak_end: int,
+    ppm: bool,
+    tol: float,
+):
+    """
+    Match one query mz against sorted centroid peaks in
+    all_spec_mzs[peak_start:peak_end] without allocation,
+    the tolerance is calculated for each candidate peak.
+    Returns the closest peak index (-1 if not matched) and its abs mass error.
+    """
+    lo = peak_start
+    hi = peak_end
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if all_spec_mzs[mid] < query_mz:
+            lo = mid + 1
+        else:
+            hi = mid
+    min_idx = -1
+    min_merr = np.inf
+    if lo > peak_start:
+        spec_mz = all_spec_mzs[lo - 1]
+        merr = abs(spec_mz - query_mz)
+        if merr <= (spec_mz * tol * 1e-6 if ppm else tol):
+            min_idx = lo - 1
+            min_merr = merr
+    if lo < peak_end:
+        spec_mz = all_spec_mzs[lo]
+        merr = abs(spec_mz - query_mz)
+        if merr <= (spec_mz * tol * 1e-6 if ppm else tol) and merr < min_merr:
+            min_idx = lo
+            min_merr = merr
+    return min_idx, min_merr
+
+
+@numba.njit(nogil=True, inline="always")
+def _match_profile_one_mz(
+    query_mz: float,
+    all_spec_mzs: np.ndarray,
+    all_spec_intensities: np.ndarray,
+    peak_start: int,
+    peak_end: int,
+    ppm: bool,
+    tol: float,
+    use_apex: bool,
+):
+    """
+    Match one query mz against sorted profile points in
+    all_spec_mzs[peak_start:peak_end] without allocation.
+    The window contains the consecutive points within the tolerance
+    around the query (the first/last points of `match_first_last_profile_mz`).
+    Returns the apex intensity and the abs mass error of the apex if `use_apex`,
+    otherwise the summed intensity and the abs mass error of
+    the intensity-weighted mz. (0, np.inf) if no intensity is in the window.
+    """
+    lo = peak_start
+    hi = peak_end
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if all_spec_mzs[mid] < query_mz:
+            lo = mid + 1
+        else:
+            hi = mid
+    apex_inten = 0.0
+    apex_mz = 0.0
+    sum_inten = 0.0
+    sum_mz_inten = 0.0
+    for idx in range(lo - 1, peak_start - 1, -1):
+        spec_mz = all_spec_mzs[idx]
+        if query_mz - spec_mz > (spec_mz * tol * 1e-6 if ppm else tol):
+            break
+        inten = all_spec_intensities[idx]
+        sum_inten += inten
+        sum_mz_inten += spec_mz * inten
+        if inten > apex_inten:
+            apex_inten = inten
+            apex_mz = spec_mz
+    for idx in range(lo, peak_end):
+        spec_mz = all_spec_mzs[idx]
+        if spec_mz - query_mz > (spec_mz * tol * 1e-6 if ppm else tol):
+            break
+        inten = all_spec_intensities[idx]
+        sum_inten += inten
+        sum_mz_inten += spec_mz * inten
+        if inten > apex_inten:
+            apex_inten = inten
+            apex_mz = spec_mz
+    if sum_inten <= 0:
+        return 0.0, np.inf
+    if use_apex:
+        return apex_inten, abs(apex_mz - query_mz)
+    return sum_inten, abs(sum_mz_inten / sum_inten - query_mz)
+
+
+# `peak_mode` values of match_one_raw_with_numba
+PEAK_MODE_CENTROID = 0
+PEAK_MODE_PROFILE_APEX = 1
+PEAK_MODE_PROFILE_SUM = 2
+
+
+@numba.njit(parallel=True, nogil=True)
 def match_one_raw_with_numba(
     spec_idxes,
     frag_start_idxes,
@@ -171,57 +280,503 @@ def match_one_raw_with_numba(
     matched_mz_errs,
     ppm,
     tol,
+    peak_mode=PEAK_MODE_CENTROID,
 ):
     """
     Internel function to match fragment mz values to spectrum mz values.
+    PSMs are matched in parallel (`numba.prange`) and results are written
+    into matched_intensities and matched_mz_errs in place.
     Matched_mz_errs[i] = np.inf if no peaks are matched.
+    PSMs of which the spectrum does not exist or has no peaks are skipped.
+
+    `peak_mode` is PEAK_MODE_CENTROID (closest centroid peak),
+    PEAK_MODE_PROFILE_APEX or PEAK_MODE_PROFILE_SUM (apex or summed
+    intensity of the profile points in the tolerance window,
+    see `_match_profile_one_mz`).
     """
-    for spec_idx, frag_start, frag_end in zip(
-        spec_idxes, frag_start_idxes, frag_stop_idxes
-    ):
+    for i in numba.prange(len(spec_idxes)):
+        spec_idx = spec_idxes[i]
+        if spec_idx < 0 or spec_idx >= len(peak_start_idxes):
+            continue
         peak_start = peak_start_idxes[spec_idx]
         peak_end = peak_end_idxes[spec_idx]
-        if peak_end == peak_start:
+        if peak_end <= peak_start:
             continue
-        spec_mzs = all_spec_mzs[peak_start:peak_end]
-        spec_intens = all_spec_intensities[peak_start:peak_end]
+        for frag_idx in range(frag_start_idxes[i], frag_stop_idxes[i]):
+            for j in range(all_frag_mzs.shape[1]):
+                if peak_mode != PEAK_MODE_CENTROID:
+                    inten, merr = _match_profile_one_mz(
+                        all_frag_mzs[frag_idx, j],
+                        all_spec_mzs,
+                        all_spec_intensities,
+                        peak_start,
+                        peak_end,
+                        ppm,
+                        tol,
+                        peak_mode == PEAK_MODE_PROFILE_APEX,
+                    )
+                    matched_intensities[frag_idx, j] = inten
+                    matched_mz_errs[frag_idx, j] = merr
+                    continue
+                matched_idx, merr = _match_centroid_one_mz(
+                    all_frag_mzs[frag_idx, j],
+                    all_spec_mzs,
+                    peak_start,
+                    peak_end,
+                    ppm,
+                    tol,
+                )
+                if matched_idx == -1:
+                    matched_intensities[frag_idx, j] = 0
+                    matched_mz_errs[frag_idx, j] = np.inf
+                else:
+                    matched_intensities[frag_idx, j] = all_spec_intensities[matched_idx]
+                    matched_mz_errs[frag_idx, j] = merr
 
-        if ppm:
-            spec_mz_tols = spec_mzs * tol * 1e-6
-        else:
-            spec_mz_tols = np.full_like(spec_mzs, tol)
 
-        frag_mzs = all_frag_mzs[frag_start:frag_end, :].copy()
+# Single-threaded version to match raw files in concurrent threads
+_match_one_raw_serial = numba.njit(nogil=True)(match_one_raw_with_numba.py_func)
+
+
+class SparseMatchedFragments:
+    """
+    Matched fragments in the coordinate (COO) layout, only matched fragments
+    (finite mass errors) are stored, sorted by `frag_rows`.
+    Unmatched fragments are 0 for intensities and np.inf for mass errors
+    when densified.
+
+    Attributes
+    ----------
+    psm_idxes : np.ndarray
+        int64, positional index of the PSM in psm_df of each matched fragment.
 
-        matched_idxes = match_centroid_mz(spec_mzs, frag_mzs, spec_mz_tols).reshape(-1)
+    frag_rows : np.ndarray
+        int64, row index in fragment_mz_df.
 
-        matched_intens = spec_intens[matched_idxes]
-        matched_intens[matched_idxes == -1] = 0
+    frag_cols : np.ndarray
+        int16, column index in fragment_mz_df (or `columns`).
+
+    intensities : np.ndarray
+        float32, matched intensities.
+
+    mz_errs : np.ndarray
+        float32, matched mass errors.
+
+    columns : list
+        Charged fragment types, the columns of fragment_mz_df.
+
+    frag_row_num : int
+        Row number of fragment_mz_df.
+    """
+
+    def __init__(
+        self,
+        columns: list,
+        frag_row_num: int,
+        psm_idxes: np.ndarray = None,
+        frag_rows: np.ndarray = None,
+        frag_cols: np.ndarray = None,
+        intensities: np.ndarray = None,
+        mz_errs: np.ndarray = None,
+    ):
+        self.columns = list(columns)
+        self.frag_row_num = frag_row_num
+        if psm_idxes is None:
+            psm_idxes = np.empty(0, dtype=np.int64)
+            frag_rows = np.empty(0, dtype=np.int64)
+            frag_cols = np.empty(0, dtype=np.int16)
+            intensities = np.empty(0, dtype=np.float32)
+            mz_errs = np.empty(0, dtype=np.float32)
+        self.psm_idxes = psm_idxes.astype(np.int64, copy=False)
+        self.frag_rows = frag_rows.astype(np.int64, copy=False)
+        self.frag_cols = frag_cols.astype(np.int16, copy=False)
+        self.intensities = intensities.astype(np.float32, copy=False)
+        self.mz_errs = mz_errs.astype(np.float32, copy=False)
+
+    def __len__(self):
+        return len(self.frag_rows)
+
+    @property
+    def shape(self) -> tuple:
+        """Shape of the dense matrices"""
+        return (self.frag_row_num, len(self.columns))
+
+    @classmethod
+    def from_dense(
+        cls,
+        matched_intensities: np.ndarray,
+        matched_mz_errs: np.ndarray,
+        columns: list,
+        frag_rows: np.ndarray = None,
+        row_psm_idxes: np.ndarray = None,
+        frag_row_num: int = None,
+    ) -> "SparseMatchedFragments":
+        """Keep only matched fragments (finite mass errors) of dense matrices.
+
+        Parameters
+        ----------
+        matched_intensities : np.ndarray
+            Dense matched intensities.
+
+        matched_mz_errs : np.ndarray
+            Dense matched mass errors, np.inf if not matched.
+
+        columns : list
+            Charged fragment types.
+
+        frag_rows : np.ndarray, optional
+            Row index in fragment_mz_df of each dense row.
+            By default None (`np.arange(len(matched_intensities))`).
+
+        row_psm_idxes : np.ndarray, optional
+            PSM index of each dense row. By default None (-1).
+
+        frag_row_num : int, optional
+            By default None (`len(matched_intensities)`).
+        """
+        rows, cols = np.nonzero(np.isfinite(matched_mz_errs))
+        return cls(
+            columns,
+            len(matched_intensities) if frag_row_num is None else frag_row_num,
+            psm_idxes=(
+                np.full(len(rows), -1, dtype=np.int64)
+                if row_psm_idxes is None
+                else row_psm_idxes[rows]
+            ),
+            frag_rows=rows if frag_rows is None else frag_rows[rows],
+            frag_cols=cols,
+            intensities=matched_intensities[rows, cols],
+            mz_errs=matched_mz_errs[rows, cols],
+        )
 
-        matched_mass_errs = np.abs(
-            spec_mzs[matched_idxes.reshape(-1)] - frag_mzs.reshape(-1)
+    @classmethod
+    def concat(
+        cls, sparse_list: list, columns: list, frag_row_num: int
+    ) -> "SparseMatchedFragments":
+        """Concatenate the matched fragments of different PSMs"""
+        if len(sparse_list) == 0:
+            return cls(columns, frag_row_num)
+        frag_rows = np.concatenate([sparse.frag_rows for sparse in sparse_list])
+        order = np.argsort(frag_rows, kind="stable")
+        return cls(
+            columns,
+            frag_row_num,
+            psm_idxes=np.concatenate([sparse.psm_idxes for sparse in sparse_list])[
+                order
+            ],
+            frag_rows=frag_rows[order],
+            frag_cols=np.concatenate([sparse.frag_cols for sparse in sparse_list])[
+                order
+            ],
+            intensities=np.concatenate([sparse.intensities for sparse in sparse_list])[
+                order
+            ],
+            mz_errs=np.concatenate([sparse.mz_errs for sparse in sparse_list])[order],
         )
-        matched_mass_errs[matched_idxes == -1] = np.inf
 
-        matched_intensities[frag_start:frag_end, :] = matched_intens.reshape(
-            frag_mzs.shape
+    def get_frag_range(self, frag_start: int, frag_stop: int) -> tuple:
+        """Start and stop positions of the matched fragments
+        in rows [frag_start, frag_stop)"""
+        return tuple(np.searchsorted(self.frag_rows, [frag_start, frag_stop]))
+
+    def densify(
+        self,
+        frag_start: int = 0,
+        frag_stop: int = None,
+        columns: list = None,
+        dtype=np.float32,
+    ) -> tuple:
+        """Dense matched intensities and mass errors of
+        rows [frag_start, frag_stop) and the given `columns`.
+
+        Returns
+        -------
+        tuple
+            np.ndarray: matched intensities, 0 if not matched.
+
+            np.ndarray: matched mass errors, np.inf if not matched.
+        """
+        if frag_stop is None:
+            frag_stop = self.frag_row_num
+        if columns is None:
+            columns = self.columns
+        col_map = np.full(len(self.columns), -1, dtype=np.int64)
+        col_map[[self.columns.index(col) for col in columns]] = np.arange(len(columns))
+        start, stop = self.get_frag_range(frag_start, frag_stop)
+        rows = self.frag_rows[start:stop] - frag_start
+        cols = col_map[self.frag_cols[start:stop]]
+        keep = cols >= 0
+        intensities = np.zeros((frag_stop - frag_start, len(columns)), dtype=dtype)
+        mz_errs = np.full((frag_stop - frag_start, len(columns)), np.inf, dtype=dtype)
+        intensities[rows[keep], cols[keep]] = self.intensities[start:stop][keep]
+        mz_errs[rows[keep], cols[keep]] = self.mz_errs[start:stop][keep]
+        return intensities, mz_errs
+
+    def to_intensity_df(self, columns: list = None, dtype=np.float32) -> pd.DataFrame:
+        """Dense matched intensity dataframe of the given `columns`"""
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame(
+            self.densify(columns=columns, dtype=dtype)[0], columns=columns
         )
 
-        matched_mz_errs[frag_start:frag_end, :] = matched_mass_errs.reshape(
-            frag_mzs.shape
+    def to_mz_err_df(self, columns: list = None, dtype=np.float32) -> pd.DataFrame:
+        """Dense matched mass error dataframe of the given `columns`"""
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame(
+            self.densify(columns=columns, dtype=dtype)[1], columns=columns
         )
 
 
 class PepSpecMatch(object):
-    """Main entry for peptide-spectrum matching"""
+    """Main entry for peptide-spectrum matching
+
+    Parameters
+    ----------
+    charged_frag_types : list, optional
+        Fragment types to match.
+
+    matched_format : str, optional
+        Format of the matched intensities and mass errors:
+        'float64' (dense dataframes),
+        'float32' (dense float32 dataframes), or
+        'sparse' (:class:`SparseMatchedFragments` with only matched fragments,
+        it is returned/stored as both the matched intensities and mass errors).
+        Defaults to 'float64'.
+
+    profile_intensity : str, optional
+        Fragment intensity of MS2 readers in `profile_mode`
+        (e.g. 'thermo_raw_profile' or 'mzml_profile' ms2_file_type):
+        'apex' (highest profile point in the tolerance window) or
+        'sum' (summed intensities in the window).
+        Centroid spectra are always matched with the closest peak.
+        Defaults to 'apex'.
+
+    block_spectrum_num : int, optional
+        If > 0, MS2 files are streamed with `MSReaderBase.load_blocks`
+        as blocks of `block_spectrum_num` spectra, each block is matched
+        and released before the next one is loaded,
+        see :meth:`_match_ms2_blocks`. Defaults to 0 (load whole files).
+    """
+
+    # Fragment rows matched in one dense buffer for 'sparse' matched_format
+    sparse_chunk_frag_rows: int = 1000000
 
     def __init__(
         self,
         charged_frag_types=get_charged_frag_types(
             ["b", "y", "b_modloss", "y_modloss"], 2
         ),
+        matched_format: str = "float64",
+        profile_intensity: str = "apex",
+        block_spectrum_num: int = 0,
     ):
         self.charged_frag_types = charged_frag_types
+        if matched_format not in ["float64", "float32", "sparse"]:
+            raise ValueError(f"Unknown matched_format `{matched_format}`")
+        self.matched_format = matched_format
+        if profile_intensity not in ["apex", "sum"]:
+            raise ValueError(f"Unknown profile_intensity `{profile_intensity}`")
+        self.profile_intensity = profile_intensity
+        self.block_spectrum_num = block_spectrum_num
+
+    def _get_peak_mode(self, ms2_reader: MSReaderBase) -> int:
+        """`peak_mode` of match_one_raw_with_numba for ms2_reader"""
+        if not getattr(ms2_reader, "profile_mode", False):
+            return PEAK_MODE_CENTROID
+        elif self.profile_intensity == "apex":
+            return PEAK_MODE_PROFILE_APEX
+        else:
+            return PEAK_MODE_PROFILE_SUM
+
+    def _init_matched_values(self, fragment_mz_df: pd.DataFrame):
+        """Allocate the matched intensities and mass errors for fragment_mz_df,
+        returns (None, None) for the 'sparse' matched_format."""
+        self._fragment_mzs = fragment_mz_df.values
+        if self.matched_format == "sparse":
+            self._matched_intensities = None
+            self._matched_mz_errs = None
+            return None, None
+        dtype = np.float32 if self.matched_format == "float32" else np.float64
+        matched_intensity_df = pd.DataFrame(
+            np.zeros(fragment_mz_df.shape, dtype=dtype),
+            columns=fragment_mz_df.columns,
+        )
+        matched_mz_err_df = pd.DataFrame(
+            np.full(fragment_mz_df.shape, np.inf, dtype=dtype),
+            columns=fragment_mz_df.columns,
+        )
+        self._matched_intensities = matched_intensity_df.values
+        self._matched_mz_errs = matched_mz_err_df.values
+        return matched_intensity_df, matched_mz_err_df
+
+    def _match_psms(
+        self,
+        ms2_reader: MSReaderBase,
+        spec_idxes: np.ndarray,
+        frag_start_idxes: np.ndarray,
+        frag_stop_idxes: np.ndarray,
+        psm_idxes: np.ndarray,
+        match_func=match_one_raw_with_numba,
+    ) -> SparseMatchedFragments:
+        """Match PSMs against a loaded ms2_reader. Dense results are written
+        into the PSM slices of the allocated matrices (returns None);
+        for the 'sparse' matched_format, PSMs are matched in chunks of
+        `sparse_chunk_frag_rows` and the matched fragments are returned."""
+        peak_args = (
+            ms2_reader.peak_df.mz.values,
+            ms2_reader.peak_df.intensity.values,
+            ms2_reader.spectrum_df.peak_start_idx.values,
+            ms2_reader.spectrum_df.peak_end_idx.values,
+        )
+        peak_mode = self._get_peak_mode(ms2_reader)
+        if self.matched_format != "sparse":
+            match_func(
+                spec_idxes,
+                frag_start_idxes,
+                frag_stop_idxes,
+                self._fragment_mzs,
+                *peak_args,
+                self._matched_intensities,
+                self._matched_mz_errs,
+                self.ppm,
+                self.tol,
+                peak_mode,
+            )
+            return None
+
+        frag_nums = (frag_stop_idxes - frag_start_idxes).astype(np.int64)
+        chunk_ids = np.cumsum(frag_nums) // max(self.sparse_chunk_frag_rows, 1)
+        chunk_bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+        sparse_list = []
+        for chunk in np.split(np.arange(len(spec_idxes)), chunk_bounds):
+            if len(chunk) == 0:
+                continue
+            local_stops = np.cumsum(frag_nums[chunk])
+            local_starts = local_stops - frag_nums[chunk]
+            frag_rows = np.repeat(
+                frag_start_idxes[chunk] - local_starts, frag_nums[chunk]
+            ) + np.arange(local_stops[-1])
+            frag_mzs = self._fragment_mzs[frag_rows]
+            matched_intensities = np.zeros(frag_mzs.shape, dtype=np.float32)
+            matched_mz_errs = np.full(frag_mzs.shape, np.inf, dtype=np.float32)
+            match_func(
+                spec_idxes[chunk],
+                local_starts,
+                local_stops,
+                frag_mzs,
+                *peak_args,
+                matched_intensities,
+                matched_mz_errs,
+                self.ppm,
+                self.tol,
+                peak_mode,
+            )
+            sparse_list.append(
+                SparseMatchedFragments.from_dense(
+                    matched_intensities,
+                    matched_mz_errs,
+                    self.charged_frag_types,
+                    frag_rows=frag_rows,
+                    row_psm_idxes=np.repeat(psm_idxes[chunk], frag_nums[chunk]),
+                    frag_row_num=len(self._fragment_mzs),
+                )
+            )
+        return SparseMatchedFragments.concat(
+            sparse_list, self.charged_frag_types, len(self._fragment_mzs)
+        )
+
+    def _match_ms2_blocks(
+        self,
+        ms2_file: str,
+        ms2_file_type: str,
+        df_group: pd.DataFrame,
+        psm_idxes: np.ndarray,
+        match_func=match_one_raw_with_numba,
+        spec_info_list: tuple = ("rt",),
+    ) -> tuple:
+        """Stream ms2_file block by block (`self.block_spectrum_num` spectra)
+        and match the PSMs of each block, PSMs are sorted by spec_idx to
+        find the PSMs in the spec_idx range of a block.
+        Only one loaded block is kept alive by this method.
+
+        Parameters
+        ----------
+        ms2_file : str
+            MS2 file path.
+
+        ms2_file_type : str
+            Reader type in `ms2_reader_provider`.
+
+        df_group : pd.DataFrame
+            PSMs with fragment indices of this file.
+
+        psm_idxes : np.ndarray
+            Positions of df_group in the PSM dataframe.
+
+        spec_info_list : tuple, optional
+            Spectrum columns to collect for the PSMs. Defaults to ("rt",).
+
+        Returns
+        -------
+        tuple
+            pd.DataFrame: the collected spectrum columns (NaN if the spectrum
+            is not found) with the index of df_group, and 'rt_norm'
+            (rt divided by the max rt of the file) if 'rt' is collected.
+
+            SparseMatchedFragments: matched fragments
+            for the 'sparse' matched_format, otherwise None.
+        """
+        order = np.argsort(df_group.spec_idx.values, kind="stable")
+        spec_idxes = df_group.spec_idx.values[order].astype(np.int64)
+        frag_start_idxes = df_group.frag_start_idx.values[order]
+        frag_stop_idxes = df_group.frag_stop_idx.values[order]
+        psm_idxes = np.asarray(psm_idxes)[order]
+        spec_info_dict = {}
+        max_rt = np.nan
+        sparse_list = []
+        ms2_reader = ms2_reader_provider.get_reader(ms2_file_type)
+        for block in ms2_reader.load_blocks(ms2_file, self.block_spectrum_num):
+            if len(block.spectrum_df) == 0:
+                continue
+            block_spec_start = block.spectrum_df.spec_idx.values[0]
+            if "rt" in block.spectrum_df.columns:
+                max_rt = np.fmax(max_rt, np.nanmax(block.spectrum_df.rt.values))
+            lo, hi = np.searchsorted(
+                spec_idxes,
+                [block_spec_start, block_spec_start + len(block.spectrum_df)],
+            )
+            if hi > lo:
+                local_spec_idxes = spec_idxes[lo:hi] - block_spec_start
+                found = block.spectrum_df.peak_start_idx.values[local_spec_idxes] >= 0
+                for col in spec_info_list:
+                    if col not in block.spectrum_df.columns:
+                        continue
+                    if col not in spec_info_dict:
+                        spec_info_dict[col] = np.full(len(df_group), np.nan)
+                    spec_info_dict[col][order[lo:hi][found]] = block.spectrum_df[
+                        col
+                    ].values[local_spec_idxes[found]]
+                sparse_matched = self._match_psms(
+                    block,
+                    local_spec_idxes,
+                    frag_start_idxes[lo:hi],
+                    frag_stop_idxes[lo:hi],
+                    psm_idxes[lo:hi],
+                    match_func,
+                )
+                if sparse_matched is not None:
+                    sparse_list.append(sparse_matched)
+            del block
+        spec_info_df = pd.DataFrame(spec_info_dict, index=df_group.index)
+        if "rt" in spec_info_df.columns:
+            spec_info_df["rt_norm"] = spec_info_df.rt / max_rt
+        if self.matched_format != "sparse":
+            return spec_info_df, None
+        return spec_info_df, SparseMatchedFragments.concat(
+            sparse_list, self.charged_frag_types, len(self._fragment_mzs)
+        )
 
     def _preprocess_psms(self, psm_df):
         pass
@@ -270,9 +825,16 @@ class PepSpecMatch(object):
             pd.DataFrame: matched mass error dataframe.
             np.inf if a fragment is not matched.
 
+            Both matched dataframes are the same
+            :class:`SparseMatchedFragments` for the 'sparse' `matched_format`.
+
         """
         self._preprocess_psms(psm_df_one_raw)
         psm_df = psm_df_one_raw
+        if self.block_spectrum_num > 0 and not isinstance(ms2_file, MSReaderBase):
+            return self._match_ms2_one_raw_blocks(
+                psm_df, ms2_file, ms2_file_type, ppm, tol
+            )
         if isinstance(ms2_file, MSReaderBase):
             ms2_reader = ms2_file
         else:
@@ -308,81 +870,277 @@ class PepSpecMatch(object):
                 psm_df["rt_norm"] = psm_df.rt / ms2_reader.spectrum_df.rt.max()
 
         fragment_mz_df = self.get_fragment_mz_df(psm_df)
-
-        matched_intensity_df = pd.DataFrame(
-            np.zeros_like(fragment_mz_df.values, dtype=np.float64),
-            columns=fragment_mz_df.columns,
+        self.ppm = ppm
+        self.tol = tol
+        (matched_intensity_df, matched_mz_err_df) = self._init_matched_values(
+            fragment_mz_df
         )
-
-        matched_mz_err_df = pd.DataFrame(
-            np.full_like(fragment_mz_df.values, np.inf, dtype=np.float64),
-            columns=fragment_mz_df.columns,
+        sparse_matched = self._match_psms(
+            ms2_reader,
+            psm_df.spec_idx.values,
+            psm_df.frag_start_idx.values,
+            psm_df.frag_stop_idx.values,
+            np.arange(len(psm_df)),
         )
+        if sparse_matched is not None:
+            matched_intensity_df = matched_mz_err_df = sparse_matched
 
-        for spec_idx, frag_start_idx, frag_stop_idx in psm_df[
-            ["spec_idx", "frag_start_idx", "frag_stop_idx"]
-        ].values:
-            (spec_mzs, spec_intens) = ms2_reader.get_peaks(spec_idx)
-            if len(spec_mzs) == 0:
-                continue
+        return (psm_df, fragment_mz_df, matched_intensity_df, matched_mz_err_df)
 
-            if ppm:
-                mz_tols = spec_mzs * tol * 1e-6
-            else:
-                mz_tols = np.full_like(spec_mzs, tol)
+    def _match_ms2_one_raw_blocks(
+        self,
+        psm_df: pd.DataFrame,
+        ms2_file: str,
+        ms2_file_type: str,
+        ppm: bool,
+        tol: float,
+    ) -> tuple:
+        """:meth:`match_ms2_one_raw` by streaming ms2_file block by block"""
+        spec_info_list = [
+            col for col in ["mobility", "nce"] if col not in psm_df.columns
+        ]
+        if "rt_norm" not in psm_df.columns:
+            spec_info_list.insert(0, "rt")
+        if len(spec_info_list) > 0:
+            psm_df = psm_df.copy()
 
-            frag_mzs = fragment_mz_df.values[frag_start_idx:frag_stop_idx, :]
+        fragment_mz_df = self.get_fragment_mz_df(psm_df)
+        self.ppm = ppm
+        self.tol = tol
+        (matched_intensity_df, matched_mz_err_df) = self._init_matched_values(
+            fragment_mz_df
+        )
+        spec_info_df, sparse_matched = self._match_ms2_blocks(
+            ms2_file,
+            ms2_file_type,
+            psm_df,
+            np.arange(len(psm_df)),
+            spec_info_list=spec_info_list,
+        )
+        for col in spec_info_df.columns:
+            psm_df[col] = spec_info_df[col].values
+        if sparse_matched is not None:
+            matched_intensity_df = matched_mz_err_df = sparse_matched
 
-            matched_idxes = match_centroid_mz(spec_mzs, frag_mzs, mz_tols)
-            matched_intens = spec_intens[matched_idxes]
-            matched_intens[matched_idxes == -1] = 0
+        return (psm_df, fragment_mz_df, matched_intensity_df, matched_mz_err_df)
 
-            matched_mz_errs = np.abs(spec_mzs[matched_idxes] - frag_mzs)
-            matched_mz_errs[matched_idxes == -1] = np.inf
+    def _load_ms2_reader(self, raw_name) -> MSReaderBase:
+        if isinstance(self._ms2_file_dict[raw_name], MSReaderBase):
+            return self._ms2_file_dict[raw_name]
+        ms2_reader = ms2_reader_provider.get_reader(self._ms2_file_type)
+        ms2_reader.load(self._ms2_file_dict[raw_name])
+        return ms2_reader
 
-            matched_intensity_df.values[frag_start_idx:frag_stop_idx, :] = (
-                matched_intens
-            )
+    def _match_ms2_reader(
+        self,
+        ms2_reader: MSReaderBase,
+        df_group: pd.DataFrame,
+        match_func=match_one_raw_with_numba,
+        psm_idxes: np.ndarray = None,
+    ) -> tuple:
+        """Match df_group against a loaded ms2_reader, see :meth:`_match_psms`.
+        `psm_idxes` are the positions of df_group in self.psm_df.
 
-            matched_mz_err_df.values[frag_start_idx:frag_stop_idx, :] = matched_mz_errs
+        Returns
+        -------
+        tuple
+            pd.DataFrame: the rt and rt_norm of df_group
+            if `self.rt_not_in_df`, otherwise None.
 
-        return (psm_df, fragment_mz_df, matched_intensity_df, matched_mz_err_df)
+            SparseMatchedFragments: matched fragments of df_group
+            for the 'sparse' matched_format, otherwise None.
+        """
+        rt_df = None
+        if self.rt_not_in_df:
+            # pfind does not report RT in the result file
+            rt_df = (
+                df_group.reset_index()
+                .merge(
+                    ms2_reader.spectrum_df[["spec_idx", "rt"]],
+                    how="left",
+                    on="spec_idx",
+                )
+                .set_index("index")
+            )
+            rt_df["rt_norm"] = rt_df.rt / ms2_reader.spectrum_df.rt.max()
+            rt_df = rt_df[["rt", "rt_norm"]]
+
+        if psm_idxes is None:
+            psm_idxes = self.psm_df.index.get_indexer(df_group.index)
+        sparse_matched = self._match_psms(
+            ms2_reader,
+            df_group.spec_idx.values,
+            df_group.frag_start_idx.values,
+            df_group.frag_stop_idx.values,
+            psm_idxes,
+            match_func,
+        )
+        return rt_df, sparse_matched
+
+    def _match_ms2_raw_blocks(
+        self,
+        raw_name: str,
+        df_group: pd.DataFrame,
+        psm_idxes: np.ndarray = None,
+        match_func=match_one_raw_with_numba,
+    ) -> tuple:
+        """:meth:`_match_ms2_reader` by streaming the ms2 file of raw_name,
+        loaded readers in `self._ms2_file_dict` are matched as a whole."""
+        if isinstance(self._ms2_file_dict[raw_name], MSReaderBase):
+            return self._match_ms2_reader(
+                self._ms2_file_dict[raw_name], df_group, match_func, psm_idxes
+            )
+        if psm_idxes is None:
+            psm_idxes = self.psm_df.index.get_indexer(df_group.index)
+        rt_df, sparse_matched = self._match_ms2_blocks(
+            self._ms2_file_dict[raw_name],
+            self._ms2_file_type,
+            df_group,
+            psm_idxes,
+            match_func,
+            spec_info_list=("rt",) if self.rt_not_in_df else (),
+        )
+        return (rt_df if self.rt_not_in_df else None), sparse_matched
 
     def _match_ms2_centroid_one_raw(self, raw_name, df_group):
         if raw_name in self._ms2_file_dict:
-            if isinstance(self._ms2_file_dict[raw_name], MSReaderBase):
-                ms2_reader = self._ms2_file_dict[raw_name]
+            if self.block_spectrum_num > 0:
+                rt_df, sparse_matched = self._match_ms2_raw_blocks(raw_name, df_group)
+            else:
+                rt_df, sparse_matched = self._match_ms2_reader(
+                    self._load_ms2_reader(raw_name), df_group
+                )
+            if rt_df is not None:
+                self.psm_df.loc[rt_df.index, ["rt", "rt_norm"]] = rt_df
+            return sparse_matched
+
+    def _match_ms2_centroid_multi_raw(
+        self,
+        raw_groups: list,
+        thread_num: int,
+        prefetch_file_num: int,
+        max_loaded_file_num: int,
+    ):
+        """Match raw files concurrently: `prefetch_file_num` threads load
+        the next raw files while `thread_num` threads match the loaded ones,
+        at most `max_loaded_file_num` readers are kept in memory.
+        Each raw file writes into the slices of its own PSMs
+        in the result matrices, rt values are merged in the main thread."""
+        if self.block_spectrum_num > 0:
+            # raw files are streamed, not limited by `max_loaded_file_num`
+            concurrent_file_num = thread_num
+        else:
+            concurrent_file_num = min(thread_num, max_loaded_file_num)
+        unfinished_file_num = len(raw_groups)
+        unfinished_lock = threading.Lock()
+        parallel_lock = threading.Lock()
+
+        def match_func(*args):
+            # The serial kernel uses one core for each raw file in the
+            # concurrent threads. If fewer raw files than `thread_num` can be
+            # matched concurrently (e.g. the last raw files), the numba parallel
+            # kernel is used instead, one call at a time, because numba
+            # parallelism inside concurrent threads would oversubscribe the CPU,
+            # and not all numba threading layers are thread-safe.
+            if min(unfinished_file_num, concurrent_file_num) < max(thread_num, 2):
+                with parallel_lock:
+                    match_one_raw_with_numba(*args)
             else:
-                ms2_reader = ms2_reader_provider.get_reader(self._ms2_file_type)
-                ms2_reader.load(self._ms2_file_dict[raw_name])
-            if self.rt_not_in_df:
-                # pfind does not report RT in the result file
-                _df = (
-                    df_group.reset_index()
-                    .merge(
-                        ms2_reader.spectrum_df[["spec_idx", "rt"]],
-                        how="left",
-                        on="spec_idx",
+                _match_one_raw_serial(*args)
+
+        def on_matched(progress_bar):
+            nonlocal unfinished_file_num
+            with unfinished_lock:
+                unfinished_file_num -= 1
+            progress_bar.update()
+
+        if self.block_spectrum_num > 0:
+            # each raw file is streamed in its matching thread
+            with ThreadPoolExecutor(thread_num) as match_executor, tqdm.tqdm(
+                total=len(raw_groups)
+            ) as progress_bar:
+                match_futures = []
+                for raw_name, df_group, psm_idxes in raw_groups:
+                    match_future = match_executor.submit(
+                        self._match_ms2_raw_blocks,
+                        raw_name,
+                        df_group,
+                        psm_idxes,
+                        match_func,
                     )
-                    .set_index("index")
+                    match_future.add_done_callback(lambda _: on_matched(progress_bar))
+                    match_futures.append(match_future)
+                self._collect_matched_results(match_futures)
+            return
+
+        loaded_semaphore = threading.BoundedSemaphore(max_loaded_file_num)
+
+        def load(raw_name):
+            try:
+                return self._load_ms2_reader(raw_name)
+            except BaseException:
+                loaded_semaphore.release()
+                raise
+
+        def match(ms2_reader, df_group, psm_idxes):
+            try:
+                return self._match_ms2_reader(
+                    ms2_reader, df_group, match_func, psm_idxes
                 )
+            finally:
+                loaded_semaphore.release()
+
+        with ThreadPoolExecutor(prefetch_file_num) as load_executor, ThreadPoolExecutor(
+            thread_num
+        ) as match_executor, tqdm.tqdm(total=len(raw_groups)) as progress_bar:
+            raw_iter = iter(raw_groups)
+            load_queue = deque()
+
+            def submit_loads():
+                # Slots are taken here in the main thread in file order,
+                # so a later file can never take the slot of the file
+                # the main thread is waiting for. At most
+                # `prefetch_file_num` (<= `max_loaded_file_num`) files are
+                # loaded but not yet matched, other slots are held by
+                # matching threads and are released once they finish.
+                while len(load_queue) < prefetch_file_num:
+                    raw_group = next(raw_iter, None)
+                    if raw_group is None:
+                        return
+                    raw_name, df_group, psm_idxes = raw_group
+                    loaded_semaphore.acquire()
+                    load_queue.append(
+                        (load_executor.submit(load, raw_name), df_group, psm_idxes)
+                    )
 
-                _df["rt_norm"] = _df.rt / ms2_reader.spectrum_df.rt.max()
-                self.psm_df.loc[_df.index, ["rt", "rt_norm"]] = _df[["rt", "rt_norm"]]
-
-            match_one_raw_with_numba(
-                df_group.spec_idx.values,
-                df_group.frag_start_idx.values,
-                df_group.frag_stop_idx.values,
-                self.fragment_mz_df.values,
-                ms2_reader.peak_df.mz.values,
-                ms2_reader.peak_df.intensity.values,
-                ms2_reader.spectrum_df.peak_start_idx.values,
-                ms2_reader.spectrum_df.peak_end_idx.values,
-                self.matched_intensity_df.values,
-                self.matched_mz_err_df.values,
-                self.ppm,
-                self.tol,
+            match_futures = []
+            submit_loads()
+            while load_queue:
+                load_future, df_group, psm_idxes = load_queue.popleft()
+                # no references to the reader are kept here,
+                # so it is released once it is matched
+                match_future = match_executor.submit(
+                    match, load_future.result(), df_group, psm_idxes
+                )
+                match_future.add_done_callback(lambda _: on_matched(progress_bar))
+                match_futures.append(match_future)
+                submit_loads()
+            self._collect_matched_results(match_futures)
+
+    def _collect_matched_results(self, match_futures: list):
+        """Merge rt values and sparse matched fragments of raw files"""
+        sparse_list = []
+        for match_future in match_futures:
+            rt_df, sparse_matched = match_future.result()
+            if rt_df is not None:
+                self.psm_df.loc[rt_df.index, ["rt", "rt_norm"]] = rt_df
+            if sparse_matched is not None:
+                sparse_list.append(sparse_matched)
+        if self.matched_format == "sparse":
+            self.matched_intensity_df = self.matched_mz_err_df = (
+                SparseMatchedFragments.concat(
+                    sparse_list, self.charged_frag_types, len(self._fragment_mzs)
+                )
             )
 
     def match_ms2_centroid(
@@ -392,6 +1150,9 @@ class PepSpecMatch(object):
         ms2_file_type: str = "alphapept",  # or 'mgf', or 'thermo'
         ppm=True,
         tol=20.0,
+        thread_num: int = 1,
+        prefetch_file_num: int = None,
+        max_loaded_file_num: int = None,
     ):
         """Matching PSM dataframe against the ms2 files in ms2_file_dict
         This method will store matched values as attributes:
@@ -400,6 +1161,9 @@ class PepSpecMatch(object):
         - self.matched_intensity_df
         - self.matched_mz_err_df
 
+        For the 'sparse' `matched_format`, self.matched_intensity_df and
+        self.matched_mz_err_df are the same :class:`SparseMatchedFragments`.
+
         Parameters
         ----------
         psm_df : pd.DataFrame
@@ -418,6 +1182,22 @@ class PepSpecMatch(object):
         tol : float, optional
             PPM units, defaults to 20.0.
 
+        thread_num : int, optional
+            Number of threads to match raw files. If fewer raw files than
+            `thread_num` are matched concurrently, each of them is matched
+            by the numba parallel kernel. Defaults to 1.
+
+        prefetch_file_num : int, optional
+            Number of threads to load the next raw files
+            while matching the loaded ones. Defaults to None
+            (`global_settings['peak_matching']['prefetch_file_num']`).
+
+        max_loaded_file_num : int, optional
+            Max number of loaded raw files kept in memory,
+            <=0 means `thread_num+prefetch_file_num`. `prefetch_file_num`
+            is clamped to `max_loaded_file_num`. Defaults to None
+            (`global_settings['peak_matching']['max_loaded_file_num']`).
+
         """
         self._preprocess_psms(psm_df)
         self.psm_df = psm_df
@@ -428,14 +1208,8 @@ class PepSpecMatch(object):
 
         self.fragment_mz_df = self.get_fragment_mz_df(self.psm_df)
 
-        self.matched_intensity_df = pd.DataFrame(
-            np.zeros_like(self.fragment_mz_df.values, dtype=np.float64),
-            columns=self.fragment_mz_df.columns,
-        )
-
-        self.matched_mz_err_df = pd.DataFrame(
-            np.full_like(self.fragment_mz_df.values, np.inf, dtype=np.float64),
-            columns=self.fragment_mz_df.columns,
+        (self.matched_intensity_df, self.matched_mz_err_df) = self._init_matched_values(
+            self.fragment_mz_df
         )
 
         self._ms2_file_dict = ms2_file_dict
@@ -447,5 +1221,26 @@ class PepSpecMatch(object):
             self.rt_not_in_df = True
         else:
             self.rt_not_in_df = False
-        for raw_name, df_group in tqdm.tqdm(self.psm_df.groupby("raw_name")):
-            self._match_ms2_centroid_one_raw(raw_name, df_group)
+        raw_groups = [
+            (raw_name, self.psm_df.iloc[psm_idxes], psm_idxes)
+            for raw_name, psm_idxes in self.psm_df.groupby("raw_name").indices.items()
+            if raw_name in self._ms2_file_dict
+        ]
+        if prefetch_file_num is None:
+            prefetch_file_num = global_settings["peak_matching"]["prefetch_file_num"]
+        if max_loaded_file_num is None:
+            max_loaded_file_num = global_settings["peak_matching"][
+                "max_loaded_file_num"
+            ]
+        thread_num = max(1, thread_num)
+        prefetch_file_num = max(1, prefetch_file_num)
+        if max_loaded_file_num <= 0:
+            max_loaded_file_num = thread_num + prefetch_file_num
+        # more loading files than slots would block the loading threads
+        prefetch_file_num = min(prefetch_file_num, max_loaded_file_num)
+        self._match_ms2_centroid_multi_raw(
+            raw_groups,
+            thread_num,
+            prefetch_file_num,
+            max_loaded_file_num,
+        )
@@ -1,8 +1,18 @@
 import os
+import re
+import hashlib
+import functools
+import mmap
+import zlib
+import base64
+import numba
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from alphabase.io.hdf import HDF_File
 from pyteomics import mzml
+from alphabase.yaml_utils import save_yaml, load_yaml
+from peptdeep.settings import global_settings
 from peptdeep.utils import logging
 from inspect import currentframe, getframeinfo
 
@@ -17,13 +27,75 @@ except (ImportError, AttributeError, RuntimeError) as e:
     RawFileReader = None
 
 
+def _scatter_spectrum_df(
+    spec_idxes: np.ndarray,
+    scan_indices: np.ndarray,
+    spec_idx_start: int,
+    rt_list: list,
+    mobility_list: list = None,
+    nce_list: list = None,
+    precursor_mz_list: list = None,
+    charge_list: list = None,
+) -> pd.DataFrame:
+    """spectrum_df of which the rows are spec_idx from `spec_idx_start`
+    to max(spec_idxes), missing spectra have no peaks (peak_start_idx=-1)"""
+    idx_len = np.max(spec_idxes) + 1 - spec_idx_start if len(spec_idxes) > 0 else 0
+    positions = spec_idxes - spec_idx_start
+    scan_indices = np.asarray(scan_indices, dtype=np.int64)
+
+    def scatter(values, dtype, na_value):
+        array = np.full(idx_len, na_value, dtype=dtype)
+        array[positions] = np.asarray(values, dtype=dtype)
+        return array
+
+    spectrum_dict = {
+        "spec_idx": np.arange(spec_idx_start, spec_idx_start + idx_len, dtype=np.int64),
+        "peak_start_idx": scatter(scan_indices[:-1], np.int64, -1),
+        "peak_end_idx": scatter(scan_indices[1:], np.int64, -1),
+        "rt": scatter(rt_list, np.float64, np.nan),
+    }
+    if mobility_list is not None:
+        spectrum_dict["mobility"] = scatter(mobility_list, np.float64, np.nan)
+    if nce_list is not None:
+        spectrum_dict["nce"] = scatter(nce_list, np.float64, np.nan)
+    if precursor_mz_list is not None:
+        spectrum_dict["precursor_mz"] = scatter(precursor_mz_list, np.float64, np.nan)
+    if charge_list is not None:
+        spectrum_dict["charge"] = scatter(charge_list, np.int64, 0)
+    return pd.DataFrame(spectrum_dict)
+
+
 class MSReaderBase:
-    def __init__(self):
+    def __init__(self, profile_mode: bool = False):
+        # If the peaks are profile points rather than centroids,
+        # see `peptdeep.mass_spec.match.PepSpecMatch`.
+        self.profile_mode = profile_mode
         self.spectrum_df: pd.DataFrame = pd.DataFrame()
         self.peak_df: pd.DataFrame = pd.DataFrame()
         # self.mzs: np.ndarray = np.array([])
         # self.intensities: np.ndarray = np.array([])
 
+    @property
+    def spectrum_df(self) -> pd.DataFrame:
+        """Spectrum information indexed by `spec_idx`.
+        Setting it also caches the peak start/end indices as numpy arrays
+        for :meth:`get_peaks` and :meth:`get_peaks_many`."""
+        return self._spectrum_df
+
+    @spectrum_df.setter
+    def spectrum_df(self, spectrum_df: pd.DataFrame):
+        self._spectrum_df = spectrum_df
+        if "peak_start_idx" in spectrum_df.columns:
+            self._peak_start_idxes = spectrum_df.peak_start_idx.values.astype(
+                np.int64, copy=False
+            )
+            self._peak_end_idxes = spectrum_df.peak_end_idx.values.astype(
+                np.int64, copy=False
+            )
+        else:
+            self._peak_start_idxes = np.empty(0, dtype=np.int64)
+            self._peak_end_idxes = np.empty(0, dtype=np.int64)
+
     def load(self, file_path):
         raise NotImplementedError("load()")
 
@@ -34,6 +106,8 @@ class MSReaderBase:
         rt_list: list,
         mobility_list: list = None,
         nce_list: list = None,
+        precursor_mz_list: list = None,
+        charge_list: list = None,
     ):
         """Build spectrum_df by the given information
 
@@ -52,27 +126,83 @@ class MSReaderBase:
         mobility_list : list, optional
             mobility for each scan. Defaults to None.
 
-        """
+        nce_list : list, optional
+            NCE for each scan. Defaults to None.
+
+        precursor_mz_list : list, optional
+            Precursor (or isolation) m/z for each scan,
+            NaN if unknown. Defaults to None.
 
-        def set_col(col, indexes, values, dtype, na_value):
-            self.spectrum_df.loc[indexes, col] = values
-            self.spectrum_df[col].fillna(na_value, inplace=True)
-            self.spectrum_df[col] = self.spectrum_df[col].astype(dtype)
+        charge_list : list, optional
+            Precursor charge for each scan, 0 if unknown. Defaults to None.
 
-        scan_list = np.array(scan_list, dtype=np.int32)
-        if scan_list.min() > 0:
+        """
+        scan_list = np.array(scan_list, dtype=np.int64)
+        if len(scan_list) > 0 and scan_list.min() > 0:
             # thermo scan >= 1
             scan_list -= 1
-        idx_len = np.max(scan_list) + 1
-        self.spectrum_df = pd.DataFrame(index=np.arange(idx_len, dtype=np.int64))
-        self.spectrum_df["spec_idx"] = self.spectrum_df.index.values
-        set_col("peak_start_idx", scan_list, scan_indices[:-1], np.int64, -1)
-        set_col("peak_end_idx", scan_list, scan_indices[1:], np.int64, -1)
-        set_col("rt", scan_list, rt_list, np.float64, np.nan)
-        if mobility_list is not None:
-            set_col("mobility", scan_list, mobility_list, np.float64, np.nan)
-        if nce_list is not None:
-            set_col("nce", scan_list, nce_list, np.float64, np.nan)
+        self.spectrum_df = _scatter_spectrum_df(
+            scan_list,
+            scan_indices,
+            0,
+            rt_list,
+            mobility_list,
+            nce_list,
+            precursor_mz_list,
+            charge_list,
+        )
+
+    def load_blocks(self, file_path, block_spectrum_num: int = 10000):
+        """Load the MS file as blocks of consecutive spec_idx values,
+        see :meth:`iter_blocks`. Readers that can parse a part of the file
+        (e.g. `MGFReader` and `FastMZMLReader`) only keep the current block
+        in memory, other readers load the whole file and yield views of it.
+
+        Parameters
+        ----------
+        file_path : str
+            MS file path.
+
+        block_spectrum_num : int, optional
+            Max number of spectra in a block. Defaults to 10000.
+
+        Yields
+        ------
+        MSReaderBase
+            The block.
+        """
+        self.load(file_path)
+        yield from self.iter_blocks(block_spectrum_num)
+
+    def iter_blocks(self, block_spectrum_num: int = 10000):
+        """Yield the loaded spectra as blocks of at most `block_spectrum_num`
+        consecutive spec_idx values. Each block is an `MSReaderBase` with its
+        own peak_df (a view) and spectrum_df, spectrum_df.spec_idx keeps the
+        spec_idx of this reader and `spec_idx-spectrum_df.spec_idx[0]` is
+        the position in the block."""
+        block_spectrum_num = max(1, block_spectrum_num)
+        mzs = self.peak_df.mz.values if len(self.peak_df) else np.empty(0)
+        intens = self.peak_df.intensity.values if len(self.peak_df) else np.empty(0)
+        for start in range(0, len(self.spectrum_df), block_spectrum_num):
+            block_df = self.spectrum_df.iloc[start : start + block_spectrum_num].copy()
+            valid = block_df.peak_start_idx.values >= 0
+            if valid.any():
+                peak_start = block_df.peak_start_idx.values[valid].min()
+                peak_end = block_df.peak_end_idx.values[valid].max()
+            else:
+                peak_start = peak_end = 0
+            block_df.loc[valid, ["peak_start_idx", "peak_end_idx"]] -= peak_start
+            yield self._make_block(
+                block_df.reset_index(drop=True),
+                mzs[peak_start:peak_end],
+                intens[peak_start:peak_end],
+            )
+
+    def _make_block(self, spectrum_df, mzs, intens) -> "MSReaderBase":
+        block = MSReaderBase(self.profile_mode)
+        block.spectrum_df = spectrum_df
+        block.peak_df = pd.DataFrame({"mz": mzs, "intensity": intens}, copy=False)
+        return block
 
     def get_peaks(self, spec_idx: int):
         """Get peak (mz and intensity) values by `spec_idx`
@@ -92,16 +222,50 @@ class MSReaderBase:
             intensity values for the given spec_idx
 
         """
-        if spec_idx not in self.spectrum_df.index:
+        spec_idx = int(spec_idx)
+        if spec_idx < 0 or spec_idx >= len(self._peak_start_idxes):
             return None, None
-        start_idx, end_idx = self.spectrum_df.loc[
-            spec_idx, ["peak_start_idx", "peak_end_idx"]
-        ].values.astype(np.int64)
+        start_idx = self._peak_start_idxes[spec_idx]
+        end_idx = self._peak_end_idxes[spec_idx]
         return (
             self.peak_df.mz.values[start_idx:end_idx],
             self.peak_df.intensity.values[start_idx:end_idx],
         )
 
+    def get_peaks_many(self, spec_idxes: np.ndarray) -> tuple:
+        """Get the peak offsets of many spectra at once
+
+        Parameters
+        ----------
+        spec_idxes : np.ndarray
+            spec_idx values
+
+        Returns
+        -------
+        tuple
+            np.ndarray: all mz values of the reader (not copied).
+
+            np.ndarray: all intensity values of the reader (not copied).
+
+            np.ndarray: peak start indices for spec_idxes.
+
+            np.ndarray: peak end indices for spec_idxes.
+            Both are -1 for spectra that do not exist.
+
+        """
+        spec_idxes = np.asarray(spec_idxes, dtype=np.int64)
+        valid = (spec_idxes >= 0) & (spec_idxes < len(self._peak_start_idxes))
+        start_idxes = np.full(len(spec_idxes), -1, dtype=np.int64)
+        end_idxes = np.full(len(spec_idxes), -1, dtype=np.int64)
+        start_idxes[valid] = self._peak_start_idxes[spec_idxes[valid]]
+        end_idxes[valid] = self._peak_end_idxes[spec_idxes[valid]]
+        return (
+            self.peak_df.mz.values,
+            self.peak_df.intensity.values,
+            start_idxes,
+            end_idxes,
+        )
+
     def get_peaks_by_scan_num(self, scan_num: int):
         """Get peak (mz and intensity) values by `spec_idx`
 
@@ -157,9 +321,32 @@ class AlphaPept_HDF_MS2_Reader(MSReaderBase):
             mobility_list=hdf.Raw.MS2_scans.mobility2.values
             if hasattr(hdf.Raw.MS2_scans, "mobility2")
             else None,
+            precursor_mz_list=hdf.Raw.MS2_scans.mono_mzs2.values
+            if hasattr(hdf.Raw.MS2_scans, "mono_mzs2")
+            else None,
+            charge_list=hdf.Raw.MS2_scans.charge2.values
+            if hasattr(hdf.Raw.MS2_scans, "charge2")
+            else None,
         )
 
 
+def _get_mzml_precursor(entry: dict) -> tuple:
+    """Selected ion m/z (or the isolation window target m/z)
+    and charge of a pyteomics mzML spectrum, (NaN, 0) if missing"""
+    precursors = entry.get("precursorList", {}).get("precursor", [])
+    if len(precursors) == 0:
+        return np.nan, 0
+    selected_ions = precursors[0].get("selectedIonList", {}).get("selectedIon", [])
+    selected_ion = selected_ions[0] if len(selected_ions) > 0 else {}
+    precursor_mz = selected_ion.get(
+        "selected ion m/z",
+        precursors[0]
+        .get("isolationWindow", {})
+        .get("isolation window target m/z", np.nan),
+    )
+    return float(precursor_mz), int(selected_ion.get("charge state", 0))
+
+
 class MZMLReader(MSReaderBase):
     def load(self, mzmlF):
         if isinstance(mzmlF, str):
@@ -172,6 +359,8 @@ class MZMLReader(MSReaderBase):
         scan_list = []
         rt_list = []
         nce_list = []
+        precursor_mz_list = []
+        charge_list = []
         for entry in f:
             if entry["ms level"] != 2:  # only care about MS2 scans
                 continue
@@ -192,17 +381,306 @@ class MZMLReader(MSReaderBase):
             masses_list.append(entry["m/z array"])
             intens_list.append(entry["intensity array"])
             rt_list.append(entry["scanList"]["scan"][0]["scan start time"])
+            precursor_mz, charge = _get_mzml_precursor(entry)
+            precursor_mz_list.append(precursor_mz)
+            charge_list.append(charge)
 
         if isinstance(mzmlF, str):
             f.close()
 
         self.build_spectrum_df(
-            scan_list, index_ragged_list(masses_list), rt_list, nce_list=nce_list
+            scan_list,
+            index_ragged_list(masses_list),
+            rt_list,
+            nce_list=nce_list,
+            precursor_mz_list=precursor_mz_list,
+            charge_list=charge_list,
         )
         self.peak_df["mz"] = np.concatenate(masses_list)
         self.peak_df["intensity"] = np.concatenate(intens_list)
 
 
+_MS_LEVEL = b'accession="MS:1000511"'
+_FILTER_STRING = b'accession="MS:1000512"'
+_SCAN_START_TIME = b'accession="MS:1000016"'
+_MZ_ARRAY = b'accession="MS:1000514"'
+_INTENSITY_ARRAY = b'accession="MS:1000515"'
+_FLOAT32 = b'accession="MS:1000521"'
+_FLOAT64 = b'accession="MS:1000523"'
+_ZLIB = b'accession="MS:1000574"'
+_NO_COMPRESSION = b'accession="MS:1000576"'
+_SELECTED_ION_MZ = b'accession="MS:1000744"'
+_ISOLATION_TARGET_MZ = b'accession="MS:1000827"'
+_CHARGE_STATE = b'accession="MS:1000041"'
+
+_value_pattern = re.compile(rb'\svalue="([^"]*)"')
+_id_pattern = re.compile(rb'\sid="([^"]*)"')
+_array_length_pattern = re.compile(rb'\sdefaultArrayLength="(\d+)"')
+_index_list_offset_pattern = re.compile(
+    rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>"
+)
+_spectrum_index_pattern = re.compile(
+    rb'<index\s+name="spectrum"\s*>(.*?)</index>', re.DOTALL
+)
+_offset_pattern = re.compile(rb"<offset[^>]*>\s*(\d+)\s*</offset>")
+_spectrum_pattern = re.compile(rb"<spectrum\s")
+
+
+def _get_cv_value(xml: bytes, accession: bytes):
+    """Value of the cvParam with `accession` in `xml`, None if not found"""
+    i = xml.find(accession)
+    if i < 0:
+        return None
+    tag = xml[xml.rfind(b"<", 0, i) : xml.find(b">", i)]
+    match = _value_pattern.search(tag)
+    return None if match is None else match.group(1)
+
+
+def _get_mzml_spectrum_offsets(data) -> list:
+    """Spectrum offsets from the mzML offset index,
+    or found by scanning the file if the index is missing or invalid."""
+    tail = data[max(0, len(data) - 4096) :]
+    match = _index_list_offset_pattern.search(tail)
+    if match is not None:
+        index_list_offset = int(match.group(1))
+        index_match = _spectrum_index_pattern.search(data[index_list_offset:])
+        if index_match is not None:
+            offsets = [
+                int(offset) for offset in _offset_pattern.findall(index_match.group(1))
+            ]
+            if all(data[offset : offset + 9] == b"<spectrum" for offset in offsets):
+                return offsets
+    return [match.start() for match in _spectrum_pattern.finditer(data)]
+
+
+def _decode_mzml_binary(xml: bytes) -> np.ndarray:
+    """Decode a <binaryDataArray> element"""
+    binary_start = xml.find(b"<binary>")
+    if binary_start < 0:  # <binary/>
+        return np.empty(0, dtype=np.float64)
+    binary = xml[binary_start + 8 : xml.find(b"</binary>", binary_start)]
+    if _ZLIB in xml:
+        binary = zlib.decompress(base64.b64decode(binary))
+    elif _NO_COMPRESSION in xml:
+        binary = base64.b64decode(binary)
+    else:
+        raise ValueError(
+            "Only zlib or no compression is supported by `FastMZMLReader`, "
+            "use `MZMLReader` instead"
+        )
+    return np.frombuffer(binary, dtype=np.float32 if _FLOAT32 in xml else np.float64)
+
+
+def _decode_mzml_spectra(
+    data,
+    array_list_starts: np.ndarray,
+    peak_starts: np.ndarray,
+    peak_nums: np.ndarray,
+    mzs: np.ndarray,
+    intens: np.ndarray,
+):
+    """Decode m/z and intensity arrays of the given spectra
+    into mzs[peak_start:peak_start+peak_num] and intens[...]"""
+    for array_list_start, peak_start, peak_num in zip(
+        array_list_starts, peak_starts, peak_nums
+    ):
+        array_list_end = data.find(b"</binaryDataArrayList>", array_list_start)
+        array_list = data[array_list_start:array_list_end]
+        for array_xml in array_list.split(b"</binaryDataArray>"):
+            if _MZ_ARRAY in array_xml:
+                out = mzs
+            elif _INTENSITY_ARRAY in array_xml:
+                out = intens
+            else:
+                continue
+            values = _decode_mzml_binary(array_xml)
+            if len(values) != peak_num:
+                raise ValueError(
+                    f"Array length {len(values)} does not match "
+                    f"defaultArrayLength {peak_num} in mzML"
+                )
+            out[peak_start : peak_start + peak_num] = values
+
+
+class FastMZMLReader(MSReaderBase):
+    """mzML Reader (MS2) with the same spectrum filters as `MZMLReader`.
+
+    Spectra are located with the mzML offset index (or by scanning the file
+    if it is not an indexed mzML). Only the spectrum headers are parsed to
+    select MS2 scans, so MS1 binary arrays are never decoded.
+    The base64/zlib arrays of the selected spectra are decoded by
+    `thread_num` threads directly into the concatenated peak arrays,
+    `thread_num=None` means `global_settings['thread_num']`.
+    Only zlib or no compression is supported (no numpress).
+    """
+
+    thread_num: int = None
+
+    def _parse_headers(self, data) -> tuple:
+        """scans, RTs, NCEs, precursor m/z values, charges,
+        binaryDataArrayList positions and peak numbers of the selected spectra"""
+        offsets = _get_mzml_spectrum_offsets(data)
+        offsets.append(len(data))
+        scanset = set()
+        scan_list = []
+        rt_list = []
+        nce_list = []
+        precursor_mz_list = []
+        charge_list = []
+        array_list_starts = []
+        peak_nums = []
+        for start, next_start in zip(offsets[:-1], offsets[1:]):
+            array_list_start = data.find(b"<binaryDataArrayList", start, next_start)
+            if array_list_start < 0:
+                continue
+            header = data[start:array_list_start]
+            ms_level = _get_cv_value(header, _MS_LEVEL)
+            if ms_level is None or int(ms_level) != 2:
+                continue
+            spec_id = _id_pattern.search(header).group(1).decode()
+            scan = int(spec_id.split("scan=")[1].split(" ")[0])
+            if scan in scanset:
+                continue
+            # accept only hcd and cid
+            filter_string = _get_cv_value(header, _FILTER_STRING)
+            if filter_string is None:
+                continue
+            filter_string = filter_string.decode()
+            if "@hcd" in filter_string:
+                nce = filter_string.split("@hcd")[1].split(" ")[0]
+            elif "@cid" in filter_string:
+                nce = filter_string.split("@cid")[1].split(" ")[0]
+            else:
+                continue
+
+            scanset.add(scan)
+            scan_list.append(scan)
+            nce_list.append(float(nce))
+            rt_list.append(float(_get_cv_value(header, _SCAN_START_TIME)))
+            precursor_mz = _get_cv_value(header, _SELECTED_ION_MZ)
+            if precursor_mz is None:
+                precursor_mz = _get_cv_value(header, _ISOLATION_TARGET_MZ)
+            precursor_mz_list.append(
+                np.nan if precursor_mz is None else float(precursor_mz)
+            )
+            charge = _get_cv_value(header, _CHARGE_STATE)
+            charge_list.append(0 if charge is None else int(charge))
+            array_list_starts.append(array_list_start)
+            peak_nums.append(int(_array_length_pattern.search(header).group(1)))
+        return (
+            np.array(scan_list, dtype=np.int64),
+            np.array(rt_list, dtype=np.float64),
+            np.array(nce_list, dtype=np.float64),
+            np.array(precursor_mz_list, dtype=np.float64),
+            np.array(charge_list, dtype=np.int64),
+            np.array(array_list_starts, dtype=np.int64),
+            np.array(peak_nums, dtype=np.int64),
+        )
+
+    def _decode_spectra(self, data, array_list_starts, peak_nums) -> tuple:
+        """Decode the peaks of the given spectra,
+        returns scan_indices, mzs and intensities"""
+        scan_indices = np.zeros(len(peak_nums) + 1, dtype=np.int64)
+        np.cumsum(peak_nums, out=scan_indices[1:])
+        mzs = np.empty(scan_indices[-1], dtype=np.float64)
+        intens = np.empty(scan_indices[-1], dtype=np.float64)
+
+        thread_num = self.thread_num or global_settings["thread_num"]
+        chunk_num = max(1, min(len(peak_nums), thread_num * 4))
+        chunks = np.array_split(np.arange(len(peak_nums)), chunk_num)
+        with ThreadPoolExecutor(thread_num) as executor:
+            futures = [
+                executor.submit(
+                    _decode_mzml_spectra,
+                    data,
+                    array_list_starts[chunk],
+                    scan_indices[chunk],
+                    peak_nums[chunk],
+                    mzs,
+                    intens,
+                )
+                for chunk in chunks
+            ]
+            for future in futures:
+                future.result()
+        return scan_indices, mzs, intens
+
+    def _load_data(self, data):
+        (
+            scan_list,
+            rt_list,
+            nce_list,
+            precursor_mz_list,
+            charge_list,
+            array_list_starts,
+            peak_nums,
+        ) = self._parse_headers(data)
+        scan_indices, mzs, intens = self._decode_spectra(
+            data, array_list_starts, peak_nums
+        )
+        self.build_spectrum_df(
+            scan_list,
+            scan_indices,
+            rt_list,
+            nce_list=nce_list,
+            precursor_mz_list=precursor_mz_list,
+            charge_list=charge_list,
+        )
+        self.peak_df["mz"] = mzs
+        self.peak_df["intensity"] = intens
+
+    def load_blocks(self, mzmlF, block_spectrum_num: int = 10000):
+        """All spectrum headers are parsed first, then only the peaks of
+        the current block are decoded, see :meth:`MSReaderBase.load_blocks`."""
+        if not isinstance(mzmlF, str):
+            yield from super().load_blocks(mzmlF, block_spectrum_num)
+            return
+        block_spectrum_num = max(1, block_spectrum_num)
+        with open(mzmlF, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            (
+                scans,
+                rts,
+                nces,
+                precursor_mzs,
+                charges,
+                array_list_starts,
+                peak_nums,
+            ) = self._parse_headers(data)
+            spec_idxes = scans - 1 if len(scans) > 0 and scans.min() > 0 else scans
+            for start in range(0, len(spec_idxes), block_spectrum_num):
+                block = slice(start, start + block_spectrum_num)
+                scan_indices, mzs, intens = self._decode_spectra(
+                    data, array_list_starts[block], peak_nums[block]
+                )
+                yield self._make_block(
+                    _scatter_spectrum_df(
+                        spec_idxes[block],
+                        scan_indices,
+                        spec_idxes[block].min(),
+                        rts[block],
+                        nce_list=nces[block],
+                        precursor_mz_list=precursor_mzs[block],
+                        charge_list=charges[block],
+                    ),
+                    mzs,
+                    intens,
+                )
+
+    def load(self, mzmlF):
+        if isinstance(mzmlF, str):
+            with open(mzmlF, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                self._load_data(data)
+        else:
+            data = mzmlF.read()
+            if isinstance(data, str):
+                data = data.encode()
+            self._load_data(data)
+
+
 def read_until(file, until):
     lines = []
     while True:
@@ -252,53 +730,437 @@ def index_ragged_list(ragged_list: list) -> np.ndarray:
     return indices
 
 
-class MGFReader(MSReaderBase):
-    """MGF Reader (MS2)"""
+_BEGIN_IONS = np.frombuffer(b"BEGIN IONS", dtype=np.uint8)
+_END_IONS = np.frombuffer(b"END IONS", dtype=np.uint8)
+_SCAN = np.frombuffer(b"SCAN=", dtype=np.uint8)
+_RTINSECOND = np.frombuffer(b"RTINSECOND", dtype=np.uint8)
+_TITLE = np.frombuffer(b"TITLE=", dtype=np.uint8)
+_PEPMASS = np.frombuffer(b"PEPMASS=", dtype=np.uint8)
+_CHARGE = np.frombuffer(b"CHARGE=", dtype=np.uint8)
 
-    def load(self, mgf):
-        if isinstance(mgf, str):
-            f = open(mgf)
+
+@numba.njit(nogil=True)
+def _is_space(c) -> bool:
+    return c == 32 or c == 9 or c == 13 or c == 10
+
+
+@numba.njit(nogil=True)
+def _startswith(buf: np.ndarray, start: int, end: int, prefix: np.ndarray) -> bool:
+    if end - start < len(prefix):
+        return False
+    for k in range(len(prefix)):
+        if buf[start + k] != prefix[k]:
+            return False
+    return True
+
+
+@numba.njit(nogil=True)
+def _parse_float(buf: np.ndarray, start: int, end: int):
+    """Parse a float in `buf[start:end]` (ASCII bytes). The decimal digits are
+    collected into an integer mantissa, so the result is correctly rounded
+    (same as Python's `float()`) for up to 15 significant digits.
+
+    Returns
+    -------
+    tuple
+        (value, stop position), stop==start if there is no number.
+    """
+    i = start
+    negative = False
+    if i < end and (buf[i] == 45 or buf[i] == 43):  # '-' or '+'
+        negative = buf[i] == 45
+        i += 1
+    mantissa = 0
+    exp10 = 0
+    digit_num = 0
+    while i < end and 48 <= buf[i] <= 57:
+        if mantissa < 100000000000000000:
+            mantissa = mantissa * 10 + (buf[i] - 48)
         else:
-            f = mgf
-        scanset = set()
-        masses_list = []
-        intens_list = []
-        scan_list = []
-        rt_list = []
-        while True:
-            line = f.readline()
-            if not line:
+            exp10 += 1
+        digit_num += 1
+        i += 1
+    if i < end and buf[i] == 46:  # '.'
+        i += 1
+        while i < end and 48 <= buf[i] <= 57:
+            if mantissa < 100000000000000000:
+                mantissa = mantissa * 10 + (buf[i] - 48)
+                exp10 -= 1
+            digit_num += 1
+            i += 1
+    if digit_num == 0:
+        return 0.0, start
+    if i < end and (buf[i] == 101 or buf[i] == 69):  # 'e' or 'E'
+        j = i + 1
+        exp_negative = False
+        if j < end and (buf[j] == 45 or buf[j] == 43):
+            exp_negative = buf[j] == 45
+            j += 1
+        exp = 0
+        exp_num = 0
+        while j < end and 48 <= buf[j] <= 57:
+            exp = exp * 10 + (buf[j] - 48)
+            exp_num += 1
+            j += 1
+        if exp_num > 0:
+            exp10 += -exp if exp_negative else exp
+            i = j
+    value = float(mantissa)
+    if exp10 < 0:
+        value /= 10.0 ** (-exp10)
+    elif exp10 > 0:
+        value *= 10.0**exp10
+    return -value if negative else value, i
+
+
+@numba.njit(nogil=True)
+def _parse_mgf_buffer(buf: np.ndarray):
+    """Parse all spectra in the MGF bytes `buf`.
+    It follows the same rules as the line-based parsing: lines are stripped,
+    a spectrum starts from 'BEGIN IONS' and ends at 'END IONS',
+    an empty line or the end of the buffer; peak lines start with a digit.
+
+    Returns
+    -------
+    tuple
+        mzs, intensities, peak_nums, scans (0 if no 'SCAN='),
+        rts (minutes), precursor_mzs ('PEPMASS=', NaN if missing),
+        charges ('CHARGE=', 0 if missing),
+        title_starts, title_ends (-1 if no 'TITLE=')
+    """
+    n = len(buf)
+    max_line_num = 1
+    for k in range(n):
+        if buf[k] == 10:
+            max_line_num += 1
+    mzs = np.empty(max_line_num, dtype=np.float64)
+    intens = np.empty(max_line_num, dtype=np.float64)
+    max_spec_num = max_line_num // 2 + 1
+    peak_nums = np.empty(max_spec_num, dtype=np.int64)
+    scans = np.empty(max_spec_num, dtype=np.int64)
+    rts = np.empty(max_spec_num, dtype=np.float64)
+    precursor_mzs = np.empty(max_spec_num, dtype=np.float64)
+    charges = np.empty(max_spec_num, dtype=np.int64)
+    title_starts = np.empty(max_spec_num, dtype=np.int64)
+    title_ends = np.empty(max_spec_num, dtype=np.int64)
+
+    spec_num = 0
+    peak_num = 0
+    spec_peak_start = 0
+    in_spec = False
+    scan = 0
+    rt = 0.0
+    precursor_mz = np.nan
+    charge = 0
+    title_start = -1
+    title_end = -1
+    i = 0
+    while i < n:
+        j = i
+        while j < n and buf[j] != 10:
+            j += 1
+        start = i
+        end = j
+        i = j + 1
+        while start < end and _is_space(buf[start]):
+            start += 1
+        while end > start and _is_space(buf[end - 1]):
+            end -= 1
+        if not in_spec:
+            if _startswith(buf, start, end, _BEGIN_IONS):
+                in_spec = True
+                spec_peak_start = peak_num
+                scan = 0
+                rt = 0.0
+                precursor_mz = np.nan
+                charge = 0
+                title_start = -1
+                title_end = -1
+        elif start == end or _startswith(buf, start, end, _END_IONS):
+            in_spec = False
+            peak_nums[spec_num] = peak_num - spec_peak_start
+            scans[spec_num] = scan
+            rts[spec_num] = rt
+            precursor_mzs[spec_num] = precursor_mz
+            charges[spec_num] = charge
+            title_starts[spec_num] = title_start
+            title_ends[spec_num] = title_end
+            spec_num += 1
+        elif 48 <= buf[start] <= 57:
+            mz, k = _parse_float(buf, start, end)
+            while k < end and _is_space(buf[k]):
+                k += 1
+            inten, k = _parse_float(buf, k, end)
+            mzs[peak_num] = mz
+            intens[peak_num] = inten
+            peak_num += 1
+        elif _startswith(buf, start, end, _SCAN):
+            value, k = _parse_float(buf, start + len(_SCAN), end)
+            scan = int(value)
+        elif _startswith(buf, start, end, _RTINSECOND):
+            k = start
+            while k < end and buf[k] != 61:  # '='
+                k += 1
+            value, k = _parse_float(buf, k + 1, end)
+            rt = value / 60
+        elif _startswith(buf, start, end, _PEPMASS):
+            value, k = _parse_float(buf, start + len(_PEPMASS), end)
+            if k > start + len(_PEPMASS):
+                precursor_mz = value
+        elif _startswith(buf, start, end, _CHARGE):
+            # e.g. '2+', the first charge of '2+ and 3+' is used
+            value, k = _parse_float(buf, start + len(_CHARGE), end)
+            if k < end and buf[k] == 45:  # '-'
+                value = -value
+            charge = int(value)
+        elif title_start < 0 and _startswith(buf, start, end, _TITLE):
+            title_start = start
+            title_end = end
+    if in_spec:
+        peak_nums[spec_num] = peak_num - spec_peak_start
+        scans[spec_num] = scan
+        rts[spec_num] = rt
+        precursor_mzs[spec_num] = precursor_mz
+        charges[spec_num] = charge
+        title_starts[spec_num] = title_start
+        title_ends[spec_num] = title_end
+        spec_num += 1
+    return (
+        mzs[:peak_num],
+        intens[:peak_num],
+        peak_nums[:spec_num],
+        scans[:spec_num],
+        rts[:spec_num],
+        precursor_mzs[:spec_num],
+        charges[:spec_num],
+        title_starts[:spec_num],
+        title_ends[:spec_num],
+    )
+
+
+def _parse_mgf_bytes(data: bytes) -> tuple:
+    """Parse MGF bytes, scans without 'SCAN=' are parsed from the pFind TITLE"""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    (
+        mzs,
+        intens,
+        peak_nums,
+        scans,
+        rts,
+        precursor_mzs,
+        charges,
+        title_starts,
+        title_ends,
+    ) = _parse_mgf_buffer(buf)
+    for i in np.nonzero(scans == 0)[0]:
+        if title_starts[i] < 0:
+            raise ValueError("MGF spectrum has neither `SCAN=` nor `TITLE=`")
+        scans[i] = parse_pfind_scan_from_TITLE(
+            data[title_starts[i] : title_ends[i]].decode(errors="replace")
+        )
+    return mzs, intens, peak_nums, scans, rts, precursor_mzs, charges
+
+
+def _concat_mgf_results(results: list) -> tuple:
+    if len(results) == 1:
+        return results[0]
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def _iter_mgf_range(mgf_path: str, start: int, stop: int, block_size: int):
+    """Parse and yield the spectra in the byte range [start, stop)
+    of an MGF file block by block,
+    each block is cut after its last 'END IONS' line."""
+    carry = b""
+    with open(mgf_path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < stop:
+            data = f.read(min(block_size, stop - pos))
+            if not data:
                 break
-            if line.startswith("BEGIN IONS"):
-                lines = read_until(f, "END IONS")
-                masses = []
-                intens = []
-                scan = None
-                RT = 0
-                for line in lines:
-                    if line[0].isdigit():
-                        mass, inten = [float(i) for i in line.strip().split()]
-                        masses.append(mass)
-                        intens.append(inten)
-                    elif line.startswith("SCAN="):
-                        scan = int(line.split("=")[1])
-                    elif line.startswith("RTINSECOND"):
-                        RT = float(line.split("=")[1]) / 60
-                if not scan:
-                    title = find_line(lines, "TITLE=")
-                    scan = parse_pfind_scan_from_TITLE(title)
-                if scan in scanset:
+            pos += len(data)
+            data = carry + data
+            if pos < stop:
+                end_idx = data.rfind(b"END IONS")
+                if end_idx < 0:
+                    carry = data
                     continue
-                scanset.add(scan)
-                scan_list.append(scan)
-                rt_list.append(RT)
-                masses_list.append(np.array(masses))
-                intens_list.append(np.array(intens))
+                cut = data.find(b"\n", end_idx)
+                cut = len(data) if cut < 0 else cut + 1
+                data, carry = data[:cut], data[cut:]
+            else:
+                carry = b""
+            yield _parse_mgf_bytes(data)
+    if carry:
+        yield _parse_mgf_bytes(carry)
+
+
+def _parse_mgf_range(mgf_path: str, start: int, stop: int, block_size: int) -> tuple:
+    """Parse the spectra in the byte range [start, stop) of an MGF file,
+    see `_iter_mgf_range`."""
+    results = list(_iter_mgf_range(mgf_path, start, stop, block_size))
+    if not results:
+        return _parse_mgf_bytes(b"")
+    return _concat_mgf_results(results)
+
+
+def _find_next_spectrum_start(f, offset: int, window: int = 1 << 20) -> int:
+    """Position of the first line starting with 'BEGIN IONS' after `offset`,
+    -1 if not found."""
+    pattern = b"\nBEGIN IONS"
+    f.seek(offset)
+    data_start = offset
+    tail = b""
+    while True:
+        chunk = f.read(window)
+        if not chunk:
+            return -1
+        data = tail + chunk
+        idx = data.find(pattern)
+        if idx >= 0:
+            return data_start + idx + 1
+        tail = data[-len(pattern) + 1 :]
+        data_start += len(data) - len(tail)
+
+
+class MGFReader(MSReaderBase):
+    """MGF Reader (MS2)
+
+    The file is read in binary blocks of `block_size` bytes and parsed with
+    numba. Files larger than `min_range_size` are split into byte ranges
+    (aligned to 'BEGIN IONS') which are parsed by up to `thread_num` threads,
+    `thread_num=None` means `global_settings['thread_num']`.
+    """
+
+    block_size: int = 64 * 1024 * 1024
+    min_range_size: int = 32 * 1024 * 1024
+    thread_num: int = None
+
+    def _get_byte_ranges(self, mgf_path: str) -> list:
+        file_size = os.path.getsize(mgf_path)
+        thread_num = self.thread_num or global_settings["thread_num"]
+        range_num = max(1, min(thread_num, file_size // self.min_range_size))
+        starts = [0]
+        with open(mgf_path, "rb") as f:
+            for k in range(1, range_num):
+                start = _find_next_spectrum_start(f, file_size * k // range_num)
+                if start < 0:
+                    break
+                if start > starts[-1]:
+                    starts.append(start)
+        return list(zip(starts, starts[1:] + [file_size]))
+
+    def load(self, mgf):
         if isinstance(mgf, str):
-            f.close()
-        self.build_spectrum_df(scan_list, index_ragged_list(masses_list), rt_list)
-        self.peak_df["mz"] = np.concatenate(masses_list)
-        self.peak_df["intensity"] = np.concatenate(intens_list)
+            byte_ranges = self._get_byte_ranges(mgf)
+            if len(byte_ranges) == 1:
+                results = [_parse_mgf_range(mgf, 0, byte_ranges[0][1], self.block_size)]
+            else:
+                with ThreadPoolExecutor(len(byte_ranges)) as executor:
+                    results = list(
+                        executor.map(
+                            lambda byte_range: _parse_mgf_range(
+                                mgf, *byte_range, self.block_size
+                            ),
+                            byte_ranges,
+                        )
+                    )
+            (mzs, intens, peak_nums, scans, rts, precursor_mzs, charges) = (
+                _concat_mgf_results(results)
+            )
+        else:
+            data = mgf.read()
+            if isinstance(data, str):
+                data = data.encode()
+            (mzs, intens, peak_nums, scans, rts, precursor_mzs, charges) = (
+                _parse_mgf_bytes(data)
+            )
+
+        # only keep the first spectrum of each scan
+        _, first_idxes = np.unique(scans, return_index=True)
+        if len(first_idxes) < len(scans):
+            keep = np.zeros(len(scans), dtype=np.bool_)
+            keep[first_idxes] = True
+            peak_keep = np.repeat(keep, peak_nums)
+            mzs = mzs[peak_keep]
+            intens = intens[peak_keep]
+            peak_nums = peak_nums[keep]
+            scans = scans[keep]
+            rts = rts[keep]
+            precursor_mzs = precursor_mzs[keep]
+            charges = charges[keep]
+
+        scan_indices = np.zeros(len(peak_nums) + 1, dtype=np.int64)
+        np.cumsum(peak_nums, out=scan_indices[1:])
+        self.build_spectrum_df(
+            scans,
+            scan_indices,
+            rts,
+            precursor_mz_list=precursor_mzs,
+            charge_list=charges,
+        )
+        self.peak_df["mz"] = mzs
+        self.peak_df["intensity"] = intens
+
+    def load_blocks(self, mgf, block_spectrum_num: int = 10000):
+        """The file is parsed `block_size` bytes at a time, and the parsed
+        spectra are yielded in blocks of `block_spectrum_num` spectra,
+        see :meth:`MSReaderBase.load_blocks`. As the scans of the whole
+        file are unknown, scans are converted into spec_idx as `scan-1`
+        unless the first parsed block contains scan 0.
+        Only the first spectrum of each scan is kept."""
+        if not isinstance(mgf, str):
+            yield from super().load_blocks(mgf, block_spectrum_num)
+            return
+        block_spectrum_num = max(1, block_spectrum_num)
+        scan_offset = None
+        seen_scans = []
+        for (
+            mzs,
+            intens,
+            peak_nums,
+            scans,
+            rts,
+            precursor_mzs,
+            charges,
+        ) in _iter_mgf_range(mgf, 0, os.path.getsize(mgf), self.block_size):
+            if len(scans) == 0:
+                continue
+            if scan_offset is None:
+                scan_offset = 1 if scans.min() > 0 else 0
+            keep = np.zeros(len(scans), dtype=np.bool_)
+            keep[np.unique(scans, return_index=True)[1]] = True
+            if seen_scans:
+                keep &= ~np.isin(scans, np.concatenate(seen_scans))
+            keep &= scans >= scan_offset
+            if not keep.all():
+                peak_keep = np.repeat(keep, peak_nums)
+                mzs = mzs[peak_keep]
+                intens = intens[peak_keep]
+                peak_nums = peak_nums[keep]
+                scans = scans[keep]
+                rts = rts[keep]
+                precursor_mzs = precursor_mzs[keep]
+                charges = charges[keep]
+            seen_scans.append(scans)
+            spec_idxes = scans - scan_offset
+            scan_indices = np.zeros(len(peak_nums) + 1, dtype=np.int64)
+            np.cumsum(peak_nums, out=scan_indices[1:])
+            for start in range(0, len(spec_idxes), block_spectrum_num):
+                stop = min(start + block_spectrum_num, len(spec_idxes))
+                yield self._make_block(
+                    _scatter_spectrum_df(
+                        spec_idxes[start:stop],
+                        scan_indices[start : stop + 1] - scan_indices[start],
+                        spec_idxes[start:stop].min(),
+                        rts[start:stop],
+                        precursor_mz_list=precursor_mzs[start:stop],
+                        charge_list=charges[start:stop],
+                    ),
+                    mzs[scan_indices[start] : scan_indices[stop]],
+                    intens[scan_indices[start] : scan_indices[stop]],
+                )
 
 
 class MSReaderProvider:
@@ -326,6 +1188,14 @@ ms2_reader_provider.register_reader("mgf", MGFReader)
 ms2_reader_provider.register_reader("alphapept", AlphaPept_HDF_MS2_Reader)
 ms2_reader_provider.register_reader("alphapept_hdf", AlphaPept_HDF_MS2_Reader)
 ms2_reader_provider.register_reader("mzml", MZMLReader)
+ms2_reader_provider.register_reader("mzml_fast", FastMZMLReader)
+# profile spectra are matched by their profile points
+ms2_reader_provider.register_reader(
+    "mzml_profile", functools.partial(MZMLReader, profile_mode=True)
+)
+ms2_reader_provider.register_reader(
+    "mzml_fast_profile", functools.partial(FastMZMLReader, profile_mode=True)
+)
 
 ms1_reader_provider = MSReaderProvider()
 ms1_reader_provider.register_reader("alphapept", AlphaPept_HDF_MS1_Reader)
@@ -345,9 +1215,8 @@ else:
     class ThermoRawMS1Reader(MSReaderBase):
         """Thermo Raw MS1 Reader"""
 
-        def __init__(self):
-            super().__init__()
-            self.profile_mode = False
+        def __init__(self, profile_mode: bool = False):
+            super().__init__(profile_mode)
 
         def load(self, raw_path):
             rawfile = RawFileReader(raw_path)
@@ -392,9 +1261,8 @@ else:
     class ThermoRawMS2Reader(MSReaderBase):
         """Thermo RAW MS2 Reader"""
 
-        def __init__(self):
-            super().__init__()
-            self.profile_mode = False
+        def __init__(self, profile_mode: bool = False):
+            super().__init__(profile_mode)
 
         def load(self, raw_path):
             rawfile = RawFileReader(raw_path)
@@ -406,6 +1274,8 @@ else:
             rt_list = []
             masses_list = []
             intens_list = []
+            precursor_mz_list = []
+            charge_list = []
             for i in spec_indices:
                 try:
                     ms_order = rawfile.GetMSOrderForScanNum(i)
@@ -419,6 +1289,14 @@ else:
                         rt_list.append(rawfile.RTFromScanNum(i))
                         masses_list.append(masses)
                         intens_list.append(intens)
+                        try:
+                            precursor_mz, charge = (
+                                rawfile.GetMS2MonoMzAndChargeFromScanNum(i)
+                            )
+                        except Exception:  # no trailer information
+                            precursor_mz, charge = np.nan, 0
+                        precursor_mz_list.append(precursor_mz)
+                        charge_list.append(charge)
 
                 except KeyboardInterrupt as e:
                     raise e
@@ -431,6 +1309,8 @@ else:
                 scan_list,
                 index_ragged_list(masses_list),
                 rt_list,
+                precursor_mz_list=precursor_mz_list,
+                charge_list=charge_list,
             )
             self.peak_df["mz"] = np.concatenate(masses_list)
             self.peak_df["intensity"] = np.concatenate(intens_list)
@@ -440,3 +1320,307 @@ else:
     ms2_reader_provider.register_reader("thermo_raw", ThermoRawMS2Reader)
     ms1_reader_provider.register_reader("thermo", ThermoRawMS1Reader)
     ms1_reader_provider.register_reader("thermo_raw", ThermoRawMS1Reader)
+    ms2_reader_provider.register_reader(
+        "thermo_profile", functools.partial(ThermoRawMS2Reader, profile_mode=True)
+    )
+    ms2_reader_provider.register_reader(
+        "thermo_raw_profile", functools.partial(ThermoRawMS2Reader, profile_mode=True)
+    )
+
+
+class SpectrumStoreReader(MSReaderBase):
+    """MS2 reader of the peptdeep spectrum store.
+
+    The MS file is loaded once by the reader of `ms_file_type` and converted
+    into a store folder (see :meth:`get_store_folder`) containing contiguous
+    float32 m/z and intensity arrays (`peaks.npy` with shape (2, peak_num)),
+    one `.npy` file for each column of `spectrum_df`
+    (RT, mobility, NCE, precursor m/z ...) and `meta.yaml`.
+    Later loads memory-map the peaks if the store is still fresh, i.e.
+    the size and mtime of the MS file are the same as in `meta.yaml`.
+
+    It is registered as `cached_<ms_file_type>` in `ms2_reader_provider`,
+    e.g. `cached_mgf` or `cached_thermo_raw`.
+
+    Parameters
+    ----------
+    ms_file_type : str
+        The MS2 reader type in `ms2_reader_provider` to convert the MS files.
+
+    cache_folder : str, optional
+        Folder of the stores, "" means the folder of each MS file.
+        By default None (`global_settings['spectrum_store']['cache_folder']`).
+    """
+
+    store_version: int = 1
+
+    def __init__(self, ms_file_type: str, cache_folder: str = None):
+        super().__init__()
+        self.ms_file_type = ms_file_type.lower()
+        if cache_folder is None:
+            cache_folder = global_settings["spectrum_store"]["cache_folder"]
+        self.cache_folder = cache_folder
+
+    def get_store_folder(self, file_path: str) -> str:
+        """`{file_path}.spec_store` if `cache_folder` is empty, otherwise
+        `{cache_folder}/{file_name}.{path_hash}.spec_store`"""
+        if not self.cache_folder:
+            return file_path + ".spec_store"
+        path_hash = hashlib.md5(os.path.abspath(file_path).encode()).hexdigest()[:8]
+        return os.path.join(
+            os.path.expanduser(self.cache_folder),
+            f"{os.path.basename(file_path)}.{path_hash}.spec_store",
+        )
+
+    def is_store_fresh(self, store_folder: str, file_path: str) -> bool:
+        meta_path = os.path.join(store_folder, "meta.yaml")
+        if not os.path.isfile(meta_path):
+            return False
+        meta = load_yaml(meta_path)
+        stat = os.stat(file_path)
+        return (
+            meta.get("store_version") == self.store_version
+            and meta.get("ms_file_type") == self.ms_file_type
+            and meta.get("source_size") == stat.st_size
+            and meta.get("source_mtime_ns") == stat.st_mtime_ns
+        )
+
+    def save_store(self, store_folder: str, file_path: str, reader: MSReaderBase):
+        """Save the spectra of a loaded `reader` into `store_folder`,
+        `meta.yaml` is written at last to mark the store as complete."""
+        os.makedirs(store_folder, exist_ok=True)
+        meta_path = os.path.join(store_folder, "meta.yaml")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        peaks = np.empty((2, len(reader.peak_df)), dtype=np.float32)
+        peaks[0] = reader.peak_df.mz.values
+        peaks[1] = reader.peak_df.intensity.values
+        np.save(os.path.join(store_folder, "peaks.npy"), peaks)
+        for col in reader.spectrum_df.columns:
+            np.save(
+                os.path.join(store_folder, f"spectrum_{col}.npy"),
+                reader.spectrum_df[col].values,
+            )
+        stat = os.stat(file_path)
+        save_yaml(
+            meta_path,
+            {
+                "store_version": self.store_version,
+                "ms_file_type": self.ms_file_type,
+                "source_path": os.path.abspath(file_path),
+                "source_size": stat.st_size,
+                "source_mtime_ns": stat.st_mtime_ns,
+                "spectrum_columns": list(reader.spectrum_df.columns),
+                "profile_mode": bool(reader.profile_mode),
+                "peak_num": len(reader.peak_df),
+            },
+        )
+
+    def load_store(self, store_folder: str):
+        """Load `store_folder`, the peaks are memory-mapped"""
+        meta = load_yaml(os.path.join(store_folder, "meta.yaml"))
+        self.profile_mode = meta.get("profile_mode", False)
+        peaks = np.load(os.path.join(store_folder, "peaks.npy"), mmap_mode="r")
+        self.peak_df = pd.DataFrame(peaks.T, columns=["mz", "intensity"], copy=False)
+        self.spectrum_df = pd.DataFrame(
+            {
+                col: np.load(os.path.join(store_folder, f"spectrum_{col}.npy"))
+                for col in meta["spectrum_columns"]
+            }
+        )
+
+    def load(self, file_path):
+        if not isinstance(file_path, str):
+            reader = ms2_reader_provider.get_reader(self.ms_file_type)
+            reader.load(file_path)
+            self.profile_mode = reader.profile_mode
+            self.spectrum_df = reader.spectrum_df
+            self.peak_df = reader.peak_df
+            return
+        store_folder = self.get_store_folder(file_path)
+        if not self.is_store_fresh(store_folder, file_path):
+            logging.info(f"Converting `{file_path}` into `{store_folder}` ...")
+            reader = ms2_reader_provider.get_reader(self.ms_file_type)
+            reader.load(file_path)
+            try:
+                self.save_store(store_folder, file_path, reader)
+            except OSError as e:
+                logging.warning(f"Cannot save spectrum store `{store_folder}`: {e}")
+                self.profile_mode = reader.profile_mode
+                self.spectrum_df = reader.spectrum_df
+                self.peak_df = reader.peak_df
+                return
+        self.load_store(store_folder)
+
+
+def register_spectrum_store_readers():
+    """Register `cached_<ms_file_type>` for all MS2 readers
+    in `ms2_reader_provider`, see :class:`SpectrumStoreReader`."""
+    for ms_file_type in list(ms2_reader_provider.reader_dict):
+        if ms_file_type.startswith("cached_"):
+            continue
+        ms2_reader_provider.register_reader(
+            "cached_" + ms_file_type,
+            functools.partial(SpectrumStoreReader, ms_file_type),
+        )
+
+
+register_spectrum_store_readers()
+
+
+@numba.njit(nogil=True)
+def _query_precursor_index(
+    sorted_mzs: np.ndarray,
+    sorted_rts: np.ndarray,
+    sorted_charges: np.ndarray,
+    query_mzs: np.ndarray,
+    query_tols: np.ndarray,
+    rt_starts: np.ndarray,
+    rt_stops: np.ndarray,
+    query_charges: np.ndarray,
+) -> tuple:
+    """Positions in the sorted arrays of the candidates of each query,
+    the m/z range of each query is found by binary search.
+    Counted in the first pass and filled in the second one."""
+    los = np.searchsorted(sorted_mzs, query_mzs - query_tols)
+    his = np.searchsorted(sorted_mzs, query_mzs + query_tols, side="right")
+    total = 0
+    for i in range(len(query_mzs)):
+        for k in range(los[i], his[i]):
+            if rt_starts[i] <= sorted_rts[k] <= rt_stops[i] and (
+                query_charges[i] == 0
+                or sorted_charges[k] == 0
+                or sorted_charges[k] == query_charges[i]
+            ):
+                total += 1
+    query_idxes = np.empty(total, dtype=np.int64)
+    positions = np.empty(total, dtype=np.int64)
+    n = 0
+    for i in range(len(query_mzs)):
+        for k in range(los[i], his[i]):
+            if rt_starts[i] <= sorted_rts[k] <= rt_stops[i] and (
+                query_charges[i] == 0
+                or sorted_charges[k] == 0
+                or sorted_charges[k] == query_charges[i]
+            ):
+                query_idxes[n] = i
+                positions[n] = k
+                n += 1
+    return query_idxes, positions
+
+
+class PrecursorMzIndex:
+    """Spectra of a loaded MS2 reader sorted by precursor m/z, to find the
+    candidate spectra of precursors (e.g. of a predicted library) without
+    search-engine PSMs. The m/z range of a query is found by binary search
+    (O(log n)), and the candidates in the range are filtered by RT and charge.
+    Only spectra with peaks and a known precursor m/z are indexed.
+
+    Parameters
+    ----------
+    ms2_reader : MSReaderBase
+        Loaded reader, its spectrum_df must contain 'precursor_mz'.
+    """
+
+    def __init__(self, ms2_reader: MSReaderBase):
+        spectrum_df = ms2_reader.spectrum_df
+        if "precursor_mz" not in spectrum_df.columns:
+            raise ValueError("The spectra of the MS2 reader have no precursor m/z")
+        precursor_mzs = spectrum_df.precursor_mz.values
+        valid = (spectrum_df.peak_start_idx.values >= 0) & np.isfinite(precursor_mzs)
+        order = np.argsort(precursor_mzs[valid], kind="stable")
+        self.spec_idxes = spectrum_df.spec_idx.values[valid][order]
+        self.precursor_mzs = precursor_mzs[valid][order].astype(np.float64)
+        self.rts = spectrum_df.rt.values[valid][order].astype(np.float64)
+        if "charge" in spectrum_df.columns:
+            self.charges = spectrum_df.charge.values[valid][order].astype(np.int64)
+        else:
+            self.charges = np.zeros(len(self.spec_idxes), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.spec_idxes)
+
+    def query(
+        self,
+        precursor_mz: float,
+        tol: float = 20.0,
+        ppm: bool = True,
+        rt_start: float = -np.inf,
+        rt_stop: float = np.inf,
+        charge: int = 0,
+    ) -> np.ndarray:
+        """spec_idx values of the spectra of which the precursor m/z is within
+        the tolerance of `precursor_mz` and RT is in [rt_start, rt_stop].
+        Spectra with unknown charge (0) match any `charge`,
+        `charge=0` matches all spectra."""
+        query_idxes, spec_idxes = self.query_many(
+            np.array([precursor_mz]),
+            tol,
+            ppm,
+            np.array([rt_start]),
+            np.array([rt_stop]),
+            np.array([charge]),
+        )
+        return spec_idxes
+
+    def query_many(
+        self,
+        precursor_mzs: np.ndarray,
+        tol: float = 20.0,
+        ppm: bool = True,
+        rt_starts: np.ndarray = None,
+        rt_stops: np.ndarray = None,
+        charges: np.ndarray = None,
+    ) -> tuple:
+        """Query many precursors at once, see :meth:`query`.
+
+        Parameters
+        ----------
+        precursor_mzs : np.ndarray
+            Precursor m/z values.
+
+        tol : float, optional
+            Tolerance of the precursor m/z. Defaults to 20.0.
+
+        ppm : bool, optional
+            If `tol` is in ppm (of the query m/z), otherwise in Da.
+            Defaults to True.
+
+        rt_starts : np.ndarray, optional
+            Start of the RT window of each query (the same unit as
+            spectrum_df.rt, i.e. minutes). Defaults to None (no limit).
+
+        rt_stops : np.ndarray, optional
+            Stop of the RT window of each query. Defaults to None (no limit).
+
+        charges : np.ndarray, optional
+            Precursor charges, 0 means any charge. Defaults to None (any).
+
+        Returns
+        -------
+        tuple
+            np.ndarray: int64, index of the query (in precursor_mzs)
+            of each candidate.
+
+            np.ndarray: int64, spec_idx of each candidate.
+        """
+        precursor_mzs = np.asarray(precursor_mzs, dtype=np.float64)
+        query_num = len(precursor_mzs)
+        if rt_starts is None:
+            rt_starts = np.full(query_num, -np.inf)
+        if rt_stops is None:
+            rt_stops = np.full(query_num, np.inf)
+        if charges is None:
+            charges = np.zeros(query_num, dtype=np.int64)
+        query_tols = precursor_mzs * tol * 1e-6 if ppm else np.full(query_num, tol)
+        query_idxes, positions = _query_precursor_index(
+            self.precursor_mzs,
+            self.rts,
+            self.charges,
+            precursor_mzs,
+            query_tols,
+            np.asarray(rt_starts, dtype=np.float64),
+            np.asarray(rt_stops, dtype=np.float64),
+            np.asarray(charges, dtype=np.int64),
+        )
+        return query_idxes, self.spec_idxes[positions]
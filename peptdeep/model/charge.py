@@ -1,5 +1,14 @@
+import functools
 import pandas as pd
 import numpy as np
+import torch.multiprocessing as mp
+
+from peptdeep.settings import global_settings
+from peptdeep.utils import process_bar
+from peptdeep.model.model_interface import (
+    append_nAA_column_if_missing,
+    _inference_mode,
+)
 
 from peptdeep.model.generic_property_prediction import (
     ModelInterface_for_Generic_AASeq_MultiLabelClassification,
@@ -13,37 +22,101 @@ class _ChargeModelInterface:
     def __init__(self, *args, **kwargs):
         raise TypeError("Interface class cannot be instantiated.")
 
+    def _predict_charge_probs_of_df(
+        self, df: pd.DataFrame, batch_size: int
+    ) -> np.ndarray:
+        """Predict `df` batch by batch into a preallocated
+        (n_peptides, n_charges) float32 matrix in the row order of `df`.
+        Rows are scattered by position, so the index of `df` is not used.
+        """
+        probs = np.zeros((len(df), len(self.charge_range)), dtype=np.float32)
+        if len(df) == 0:
+            return probs
+        self.model.eval()
+        with _inference_mode():
+            for _, group_rows in df.groupby("nAA").indices.items():
+                for i in range(0, len(group_rows), batch_size):
+                    batch_rows = group_rows[i : i + batch_size]
+                    batch_df = df.iloc[batch_rows]
+                    features = self._get_features_from_batch_df(batch_df)
+                    if isinstance(features, tuple):
+                        predicts = self._predict_one_batch(*features)
+                    else:
+                        predicts = self._predict_one_batch(features)
+                    probs[batch_rows] = predicts
+        return probs
+
+    def _predict_charge_prob_matrix(
+        self,
+        df: pd.DataFrame,
+        mp_batch_size: int = 100000,
+        process_num: int = global_settings["thread_num"],
+    ) -> np.ndarray:
+        """Predict the charge probabilities of `df` as a (n_peptides, n_charges)
+        float32 matrix without the object column of arrays of :meth:`predict_mp`.
+        Rows of the matrix follow the row order of `df`, whatever its index.
+        If `nAA` is missing, it is appended to `df` and `df` is sorted by it
+        inplace (see :func:`append_nAA_column_if_missing`).
+        `df` is predicted in multiprocessing on CPUs
+        if it has more than `mp_batch_size` peptides.
+        """
+        append_nAA_column_if_missing(df)
+        self._pad_zeros_if_fixed_len(df)
+        self._check_predict_in_order(df)
+        if self.device_type != "cpu" or len(df) <= mp_batch_size:
+            return self._predict_charge_probs_of_df(df, self.predict_batch_size)
+
+        self.model.share_memory()
+        prob_list = []
+        with mp.get_context("spawn").Pool(process_num) as p:
+            for probs in process_bar(
+                p.imap(
+                    functools.partial(
+                        self._predict_charge_probs_of_df,
+                        batch_size=self.predict_batch_size,
+                    ),
+                    (
+                        df.iloc[i : i + mp_batch_size]
+                        for i in range(0, len(df), mp_batch_size)
+                    ),
+                ),
+                (len(df) + mp_batch_size - 1) // mp_batch_size,
+            ):
+                prob_list.append(probs)
+        return np.concatenate(prob_list)
+
+    def _expand_df_by_charges(
+        self,
+        df: pd.DataFrame,
+        row_idxes: np.ndarray,
+        charges: np.ndarray,
+        charge_probs: np.ndarray,
+    ) -> pd.DataFrame:
+        df = df.iloc[row_idxes].reset_index(drop=True)
+        df["charge_prob"] = charge_probs
+        df["charge"] = charges.astype(np.int8)
+        return df
+
     def predict_charges_as_prob(
         self,
         pep_df: pd.DataFrame,
         min_precursor_charge: int,
         max_precursor_charge: int,
     ):
-        df = self.predict_mp(
-            pep_df.copy(),
-            batch_size=self.predict_batch_size,
-        )
-        df.rename(columns={"charge_probs": "charge_prob"}, inplace=True)
-        df["charge"] = [
-            self.charge_range[
-                min_precursor_charge - self.min_predict_charge : max_precursor_charge
-                - self.min_predict_charge
-                + 1
-            ]
-        ] * len(df)
-        df["charge_prob"] = df.charge_prob.apply(
-            lambda x: x[
-                min_precursor_charge - self.min_predict_charge : max_precursor_charge
-                - self.min_predict_charge
-                + 1
-            ]
+        df = pep_df.copy()
+        probs = self._predict_charge_prob_matrix(df)
+        charge_slice = slice(
+            min_precursor_charge - self.min_predict_charge,
+            max_precursor_charge - self.min_predict_charge + 1,
         )
-        df = df.explode(["charge", "charge_prob"], ignore_index=True).dropna(
-            subset=["charge"]
+        charges = self.charge_range[charge_slice]
+        charge_idxes = np.arange(len(self.charge_range))[charge_slice]
+        return self._expand_df_by_charges(
+            df,
+            np.repeat(np.arange(len(df)), len(charges)),
+            np.tile(charges, len(df)),
+            probs[:, charge_idxes].reshape(-1),
         )
-        df["charge"] = df.charge.astype(np.int8)
-        df["charge_prob"] = df.charge_prob.astype(np.float32)
-        return df
 
     def predict_prob_for_charge(
         self,
@@ -51,16 +124,12 @@ class _ChargeModelInterface:
     ):
         if "charge" not in precursor_df.columns:
             raise KeyError("precursor_df must contain `charge` column")
-        precursor_df = self.predict_mp(
-            precursor_df,
-            batch_size=self.predict_batch_size,
-        )
-        precursor_df["charge_prob"] = (
-            precursor_df[["charge_probs", "charge"]]
-            .apply(lambda x: x.iloc[0][x.iloc[1] - self.min_predict_charge], axis=1)
-            .astype(np.float32)
-        )
-        precursor_df.drop(columns="charge_probs", inplace=True)
+        precursor_df = precursor_df.copy()
+        probs = self._predict_charge_prob_matrix(precursor_df)
+        precursor_df["charge_prob"] = probs[
+            np.arange(len(precursor_df)),
+            precursor_df.charge.values.astype(np.int64) - self.min_predict_charge,
+        ]
         return precursor_df
 
     def predict_and_clip_charges(
@@ -70,22 +139,21 @@ class _ChargeModelInterface:
         max_precursor_charge: int,
         charge_prob_cutoff: float,
     ):
-        df = self.predict_mp(
-            pep_df.copy(),
-            batch_size=self.predict_batch_size,
+        df = pep_df.copy()
+        probs = self._predict_charge_prob_matrix(df)
+        # charges out of [min_precursor_charge, max_precursor_charge] are masked
+        charge_mask = (self.charge_range >= min_precursor_charge) & (
+            self.charge_range <= max_precursor_charge
         )
-        df.rename(columns={"charge_probs": "charge_prob"}, inplace=True)
-        df["charge"] = df.charge_prob.apply(
-            lambda x: self.charge_range[x > charge_prob_cutoff]
+        row_idxes, charge_idxes = np.nonzero(
+            (probs > charge_prob_cutoff) & charge_mask[None, :]
+        )
+        return self._expand_df_by_charges(
+            df,
+            row_idxes,
+            self.charge_range[charge_idxes],
+            probs[row_idxes, charge_idxes],
         )
-        df["charge_prob"] = df.charge_prob.apply(lambda x: x[x > charge_prob_cutoff])
-        df = df.explode(["charge", "charge_prob"]).dropna(subset=["charge"])
-        df["charge"] = df.charge.astype(np.int8)
-        df = df.query(
-            f"charge>={min_precursor_charge} and charge<={max_precursor_charge}"
-        ).reset_index(drop=True)
-        df["charge_prob"] = df.charge_prob.astype(np.float32)
-        return df
 
 
 class ChargeModelForModAASeq(
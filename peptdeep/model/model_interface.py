@@ -1,4 +1,5 @@
 import os
+import hashlib
 import numpy as np
 import pandas as pd
 import torch
@@ -246,6 +247,7 @@ class ModelInterface(object):
         self.model: torch.nn.Module = None
         self.optimizer = None
         self.model_params: dict = {}
+        self._model_hash: str = None
         self.set_device(device)
         self.fixed_sequence_len = fixed_sequence_len
         self.min_pred_value = min_pred_value
@@ -376,6 +378,7 @@ class ModelInterface(object):
         """
         if self.model is None:
             return
+        self._model_hash = None
         if self.device_type != "cuda":
             self.model.to(self.device)
         else:
@@ -391,6 +394,7 @@ class ModelInterface(object):
         the parameters, the device, the loss function ...
         """
         self.model = model_class(**kwargs)
+        self._model_hash = None
         self.model_params.update(**kwargs)
         self._model_to_device()
         self._init_for_training()
@@ -639,6 +643,20 @@ class ModelInterface(object):
         else:
             self._load_model_from_stream(model_file)
 
+    def get_model_hash(self) -> str:
+        """
+        Get the md5 hash of the model parameters (state_dict).
+        It identifies the model weights no matter where they were loaded from.
+        The hash is cached until the model is built, loaded or trained again.
+        """
+        if getattr(self, "_model_hash", None) is None:
+            md5 = hashlib.md5()
+            for name, tensor in self.model.state_dict().items():
+                md5.update(name.encode())
+                md5.update(tensor.detach().cpu().numpy().tobytes())
+            self._model_hash = md5.hexdigest()
+        return self._model_hash
+
     def get_parameter_num(self):
         """
         Get total number of parameters in model.
@@ -684,6 +702,7 @@ class ModelInterface(object):
                     kwargs[key] = val
 
         self.model = _module.Model(**kwargs)
+        self._model_hash = None
         self.model_params = kwargs
         self.model.to(self.device)
         self._init_for_training()
@@ -730,6 +749,7 @@ class ModelInterface(object):
         (missing_keys, unexpect_keys) = self.model.load_state_dict(
             torch.load(stream, map_location=self.device), strict=False
         )
+        self._model_hash = None
         if len(missing_keys) > 0:
             logging.warn(
                 f"nn parameters {missing_keys} are MISSING while loading models in {self.__class__}"
@@ -821,6 +841,7 @@ class ModelInterface(object):
         cost.backward()
         torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
         self.optimizer.step()
+        self._model_hash = None
         return cost.item()
 
     def _predict_one_batch(self, *features):
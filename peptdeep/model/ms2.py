@@ -1,9 +1,10 @@
 import torch
+import numba
 import pandas as pd
 import numpy as np
 import warnings
 
-from typing import List, Tuple, IO
+from typing import List, Tuple, IO, Union
 
 from tqdm import tqdm
 
@@ -12,7 +13,12 @@ from alphabase.peptide.fragment import (
     update_sliced_fragment_dataframe,
     get_sliced_fragment_dataframe,
     get_charged_frag_types,
+    parse_charged_frag_type,
+    FRAGMENT_TYPES,
 )
+from alphabase.constants.atom import MASS_PROTON
+from alphabase.constants.modification import calc_modloss_mass
+from alphabase.peptide.mass_calc import calc_b_y_and_peptide_masses_for_same_len_seqs
 
 from peptdeep.utils import get_available_device
 
@@ -376,6 +382,90 @@ max_frag_charge = settings["model"]["max_frag_charge"]
 num_ion_types = len(frag_types) * max_frag_charge
 
 
+def _get_frag_type_mz_params(
+    frag_types: list,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Get the parameters to calculate the m/z values of each charged fragment type,
+    the same as `alphabase.peptide.fragment.create_fragment_mz_dataframe`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        ref ion (0 for b, 1 for y), delta mass, charge and
+        modloss type (0 for no modloss, 1 for b_modloss, 2 for y_modloss)
+        of each charged fragment type.
+    """
+    ref_ions = np.zeros(len(frag_types), dtype=np.int8)
+    delta_masses = np.zeros(len(frag_types), dtype=np.float64)
+    charges = np.zeros(len(frag_types), dtype=np.float64)
+    modloss_types = np.zeros(len(frag_types), dtype=np.int8)
+    for i, charged_frag_type in enumerate(frag_types):
+        frag_type, charge = parse_charged_frag_type(charged_frag_type)
+        if frag_type not in FRAGMENT_TYPES:
+            raise KeyError(f'Fragment type "{frag_type}" is not supported')
+        ref_ion = FRAGMENT_TYPES[frag_type].ref_ion
+        if ref_ion not in ("b", "y"):
+            raise KeyError(f"ref_ion only allows `b` and `y`, but {ref_ion} is given")
+        ref_ions[i] = 0 if ref_ion == "b" else 1
+        charges[i] = charge
+        if frag_type == "b_modloss":
+            modloss_types[i] = 1
+        elif frag_type == "y_modloss":
+            modloss_types[i] = 2
+        else:
+            delta_masses[i] = FRAGMENT_TYPES[frag_type].delta_mass
+    return ref_ions, delta_masses, charges, modloss_types
+
+
+def _calc_b_y_and_modloss_masses(
+    df: pd.DataFrame, nAA: int, b_modloss: bool, y_modloss: bool
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Calculate the b/y masses and the modloss masses of the peptides with the same length.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        ref masses of shape (2, len(df), nAA-1) for b and y,
+        and modloss masses of shape (3, len(df), nAA-1) for
+        no modloss (zeros), b_modloss and y_modloss.
+    """
+    mod_list = [[mod for mod in mods.split(";") if mod] for mods in df.mods.values]
+    site_list = [
+        [int(site) for site in sites.split(";") if site]
+        for sites in df.mod_sites.values
+    ]
+    if "aa_mass_diffs" in df.columns:
+        mod_diff_list = [
+            [float(diff) for diff in diffs.split(";") if diff]
+            for diffs in df.aa_mass_diffs.values
+        ]
+        mod_diff_site_list = [
+            [int(site) for site in sites.split(";") if site]
+            for sites in df.aa_mass_diff_sites.values
+        ]
+    else:
+        mod_diff_list = None
+        mod_diff_site_list = None
+    b_mass, y_mass, _ = calc_b_y_and_peptide_masses_for_same_len_seqs(
+        df.sequence.values.astype("U"),
+        mod_list,
+        site_list,
+        mod_diff_list,
+        mod_diff_site_list,
+    )
+    modloss_masses = np.zeros((3, len(df), nAA - 1))
+    if b_modloss:
+        for i, (mods, sites) in enumerate(zip(mod_list, site_list)):
+            modloss_masses[1, i] = calc_modloss_mass(nAA, mods, sites, True)
+    if y_modloss:
+        for i, (mods, sites) in enumerate(zip(mod_list, site_list)):
+            modloss_masses[2, i] = calc_modloss_mass(nAA, mods, sites, False)
+    return (
+        np.stack([b_mass.reshape(len(df), -1), y_mass.reshape(len(df), -1)]),
+        modloss_masses,
+    )
+
+
 class pDeepModel(model_interface.ModelInterface):
     """
     `ModelInterface` for MS2 prediction models
@@ -601,6 +691,179 @@ class pDeepModel(model_interface.ModelInterface):
             "for MS2 prediction with multiprocessing"
         )
 
+    def predict_sparse(
+        self,
+        precursor_df: pd.DataFrame,
+        *,
+        frag_types: list = None,
+        batch_size: int = 1024,
+        min_fragment_intensity: float = 0.001,
+        keep_top_k_fragments: int = 1000,
+        verbose: bool = False,
+    ) -> pd.DataFrame:
+        """Predict MS2 and only keep the top-k fragments with
+        intensity >= `min_fragment_intensity` for each precursor,
+        the same selection as `alphabase.peptide.fragment.flatten_fragments`.
+        The selection is done on the model device for each mini batch,
+        and m/z values are only calculated for the kept fragments,
+        so no dense fragment intensity or m/z dataframe is created.
+
+        Parameters
+        ----------
+        precursor_df : pd.DataFrame
+            Precursor dataframe with 'sequence', 'mods', 'mod_sites',
+            'charge', 'nce' and 'instrument' columns.
+            'flat_frag_start_idx' and 'flat_frag_stop_idx' columns
+            pointing to the returned fragment dataframe will be inserted inplace.
+
+        frag_types : list, optional
+            Charged fragment types to keep, by default None
+            (`self.charged_frag_types`).
+
+        batch_size : int, optional
+            Mini batch size, by default 1024.
+
+        min_fragment_intensity : float, optional
+            Minimal relative intensity to keep, by default 0.001.
+
+        keep_top_k_fragments : int, optional
+            Top k highest fragments to keep for each precursor, by default 1000.
+
+        verbose : bool, optional
+            Show progress bar or not, by default False.
+
+        Returns
+        -------
+        pd.DataFrame
+            Fragment dataframe with columns:
+            'precursor_idx' (row position in `precursor_df`),
+            'frag_position' (0 to nAA-2), 'frag_type' (index of `frag_types`),
+            'intensity' and 'mz'; sorted by
+            'precursor_idx', 'frag_position' and 'frag_type'.
+        """
+        precursor_df = model_interface.append_nAA_column_if_missing(precursor_df)
+        if frag_types is None:
+            frag_types = self.charged_frag_types
+        frag_types = [
+            frag_type
+            for frag_type in frag_types
+            if frag_type in self.charged_frag_types
+        ]
+        frag_type_idxes = torch.tensor(
+            [self.charged_frag_types.index(frag_type) for frag_type in frag_types],
+            dtype=torch.long,
+            device=self.device,
+        )
+        ref_ions, delta_masses, charges, modloss_types = _get_frag_type_mz_params(
+            frag_types
+        )
+        self.model.eval()
+        precursor_idx_list = []
+        position_list = []
+        frag_type_list = []
+        intensity_list = []
+        mz_list = []
+        _grouped = precursor_df.groupby("nAA").indices.items()
+        if verbose:
+            _grouped = tqdm(_grouped)
+        with model_interface._inference_mode():
+            for nAA, group_idxes in _grouped:
+                for i in range(0, len(group_idxes), batch_size):
+                    batch_idxes = group_idxes[i : i + batch_size]
+                    batch_df = precursor_df.iloc[batch_idxes]
+
+                    predicts = self.model(*self._get_features_from_batch_df(batch_df))
+                    predicts = predicts.reshape(len(batch_df), nAA - 1, -1)
+                    apex_intens = predicts.reshape(len(batch_df), -1).max(dim=1)[0]
+                    apex_intens[apex_intens <= 0] = 1
+                    predicts = predicts / apex_intens.reshape(-1, 1, 1)
+                    predicts[predicts < self.min_inten] = 0.0
+                    predicts = predicts[:, :, frag_type_idxes]
+
+                    ref_masses, modloss_masses = _calc_b_y_and_modloss_masses(
+                        batch_df, nAA, 1 in modloss_types, 2 in modloss_types
+                    )
+                    # fragments with charges larger than the precursor charge,
+                    # and modloss fragments without modloss masses are invalid
+                    precursor_charges = batch_df.charge.values
+                    for j in range(len(frag_types)):
+                        predicts[
+                            self._as_tensor(
+                                precursor_charges < charges[j], dtype=torch.bool
+                            ),
+                            :,
+                            j,
+                        ] = 0.0
+                        if modloss_types[j] > 0:
+                            predicts[:, :, j][
+                                self._as_tensor(
+                                    modloss_masses[modloss_types[j]] == 0,
+                                    dtype=torch.bool,
+                                )
+                            ] = 0.0
+                    predicts = predicts.reshape(len(batch_df), -1)
+
+                    top_intens, top_idxes = torch.topk(
+                        predicts,
+                        min(keep_top_k_fragments, predicts.shape[1]),
+                        dim=1,
+                    )
+                    rows, cols = torch.nonzero(
+                        top_intens >= min_fragment_intensity, as_tuple=True
+                    )
+                    flat_idxes = top_idxes[rows, cols].cpu().numpy()
+                    intens = top_intens[rows, cols].cpu().numpy()
+                    rows = rows.cpu().numpy()
+                    positions = flat_idxes // len(frag_types)
+                    type_idxes = flat_idxes % len(frag_types)
+
+                    # only calculate m/z values of the kept fragments
+                    modlosses = modloss_masses[
+                        modloss_types[type_idxes], rows, positions
+                    ]
+                    valid = ((modloss_types[type_idxes] == 0) | (modlosses != 0)) & (
+                        charges[type_idxes] <= precursor_charges[rows]
+                    )
+                    mzs = (
+                        ref_masses[ref_ions[type_idxes], rows, positions]
+                        + delta_masses[type_idxes]
+                        - modlosses
+                    ) / charges[type_idxes] + MASS_PROTON
+
+                    precursor_idx_list.append(batch_idxes[rows[valid]])
+                    position_list.append(positions[valid])
+                    frag_type_list.append(type_idxes[valid])
+                    intensity_list.append(intens[valid])
+                    mz_list.append(mzs[valid])
+
+        torch.cuda.empty_cache()
+
+        def _concat(array_list, dtype):
+            if not array_list:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate(array_list).astype(dtype)
+
+        precursor_idxes = _concat(precursor_idx_list, np.int64)
+        positions = _concat(position_list, np.int32)
+        frag_types_in_df = _concat(frag_type_list, np.int8)
+        order = np.lexsort((frag_types_in_df, positions, precursor_idxes))
+        frag_df = pd.DataFrame(
+            {
+                "precursor_idx": precursor_idxes[order],
+                "frag_position": positions[order],
+                "frag_type": frag_types_in_df[order],
+                "intensity": _concat(intensity_list, np.float32)[order],
+                "mz": _concat(mz_list, np.float32)[order],
+            }
+        )
+
+        frag_nums = np.bincount(precursor_idxes, minlength=len(precursor_df))
+        precursor_df["flat_frag_stop_idx"] = np.cumsum(frag_nums)
+        precursor_df["flat_frag_start_idx"] = (
+            precursor_df.flat_frag_stop_idx.values - frag_nums
+        )
+        return frag_df
+
     def bootstrap_nce_search(
         self,
         psm_df: pd.DataFrame,
@@ -884,3 +1147,227 @@ def calc_ms2_similarity(
 
     torch.cuda.empty_cache()
     return psm_df, metrics_describ
+
+
+# Metric names of `calc_ms2_similarity_multi`, in the order of `_calc_metrics`
+similarity_metric_ids = {"PCC": 0, "COS": 1, "SA": 2, "SPC": 3}
+_cos_eps = 1e-8  # the same as torch.cosine_similarity
+
+
+@numba.njit(nogil=True, inline="always", error_model="numpy")
+def _cosine(x: np.ndarray, y: np.ndarray) -> float:
+    xy = 0.0
+    xx = 0.0
+    yy = 0.0
+    for k in range(len(x)):
+        xy += x[k] * y[k]
+        xx += x[k] * x[k]
+        yy += y[k] * y[k]
+    return xy / (max(np.sqrt(xx), _cos_eps) * max(np.sqrt(yy), _cos_eps))
+
+
+@numba.njit(nogil=True)
+def _get_ranks_np(x: np.ndarray) -> np.ndarray:
+    """See `_get_ranks`, zeros are ranked as 0"""
+    ranks = np.empty(len(x), dtype=np.float64)
+    ranks[np.argsort(x, kind="mergesort")] = np.arange(len(x))
+    ranks[x == 0] = 0
+    return ranks
+
+
+@numba.njit(nogil=True, error_model="numpy")
+def _calc_metrics(
+    x: np.ndarray,
+    y: np.ndarray,
+    metric_ids: np.ndarray,
+    spc_top_k: int,
+    out: np.ndarray,
+):
+    """Similarity metrics between the predicted `x` and the observed `y`
+    of one PSM, the same as `calc_ms2_similarity`"""
+    cos = _cosine(x, y)
+    for m in range(len(metric_ids)):
+        metric_id = metric_ids[m]
+        if metric_id == 0:
+            out[m] = _cosine(x - x.mean(), y - y.mean())
+        elif metric_id == 1:
+            out[m] = cos
+        elif metric_id == 2:
+            out[m] = 1 - 2 * np.arccos(min(cos, 1.0)) / np.pi
+        else:
+            if spc_top_k > 1 and spc_top_k < len(y):
+                top_idxes = np.argsort(-y, kind="mergesort")[:spc_top_k]
+                x_ranks = _get_ranks_np(x[top_idxes])
+                y_ranks = _get_ranks_np(y[top_idxes])
+            else:
+                x_ranks = _get_ranks_np(x)
+                y_ranks = _get_ranks_np(y)
+            n = len(x_ranks)
+            out[m] = 1.0 - 6 * np.sum((x_ranks - y_ranks) ** 2) / (n * (n**2 - 1.0))
+
+
+@numba.njit(parallel=True, nogil=True, error_model="numpy")
+def _calc_ms2_similarity_multi(
+    frag_starts: np.ndarray,
+    frag_stops: np.ndarray,
+    predict_intens: np.ndarray,
+    fragment_intens: np.ndarray,
+    predict_cols: np.ndarray,
+    fragment_cols: np.ndarray,
+    subset_starts: np.ndarray,
+    metric_ids: np.ndarray,
+    spc_top_ks: np.ndarray,
+) -> np.ndarray:
+    subset_num = len(subset_starts) - 1
+    metric_num = len(metric_ids)
+    ret = np.empty((len(frag_starts), subset_num * metric_num), dtype=np.float32)
+    for i in numba.prange(len(frag_starts)):
+        frag_start = frag_starts[i]
+        row_num = frag_stops[i] - frag_start
+        # read each fragment value of the PSM once
+        x_all = predict_intens[frag_start : frag_stops[i]][:, predict_cols].astype(
+            np.float32
+        )
+        y_all = fragment_intens[frag_start : frag_stops[i]][:, fragment_cols].astype(
+            np.float32
+        )
+        out = np.empty(metric_num, dtype=np.float64)
+        for s in range(subset_num):
+            col_start = subset_starts[s]
+            col_num = subset_starts[s + 1] - col_start
+            x = np.empty(row_num * col_num, dtype=np.float64)
+            y = np.empty(row_num * col_num, dtype=np.float64)
+            for j in range(row_num):
+                for k in range(col_num):
+                    x[j * col_num + k] = x_all[j, col_start + k]
+                    y[j * col_num + k] = y_all[j, col_start + k]
+            _calc_metrics(x, y, metric_ids, spc_top_ks[s], out)
+            ret[i, s * metric_num : (s + 1) * metric_num] = out
+    return ret
+
+
+def calc_ms2_similarity_multi(
+    psm_df: pd.DataFrame,
+    predict_intensity_df: pd.DataFrame,
+    fragment_intensity_df: pd.DataFrame,
+    frag_type_subsets: List[List[str]] = None,
+    metrics: List[str] = ["PCC", "COS", "SA", "SPC"],
+    spc_top_k: Union[int, List[int]] = 0,
+) -> np.ndarray:
+    """Compute all `metrics` of all fragment type subsets at once.
+    Unlike :func:`calc_ms2_similarity`, the fragments of each PSM are read
+    only once for all subsets and metrics, and PSMs are not grouped by nAA.
+
+    Parameters
+    ----------
+    psm_df : pd.DataFrame
+        PSM DataFrame with 'frag_start_idx' and 'frag_stop_idx' columns.
+
+    predict_intensity_df : pd.DataFrame
+        Predicted fragment intensities.
+
+    fragment_intensity_df : pd.DataFrame
+        Observed (e.g. matched) fragment intensities.
+
+    frag_type_subsets : List[List[str]], optional
+        Fragment type (column) subsets, e.g.
+        `[["b_z1","y_z1"], ["b_z1"], ["y_z1"]]`.
+        By default None (one subset of all columns of `fragment_intensity_df`).
+
+    metrics : List[str], optional
+        Metrics in "PCC", "COS", "SA" and "SPC",
+        by default ["PCC", "COS", "SA", "SPC"].
+
+    spc_top_k : Union[int, List[int]], optional
+        SPC only uses the top-k observed fragments if > 1,
+        can be a list for each subset. By default 0 (all fragments).
+
+    Returns
+    -------
+    np.ndarray
+        float32 with shape (len(psm_df), len(frag_type_subsets)*len(metrics)),
+        the columns are the metrics of the first subset, then the metrics of
+        the second subset, and so on.
+    """
+    if frag_type_subsets is None:
+        frag_type_subsets = [list(fragment_intensity_df.columns)]
+    if isinstance(spc_top_k, int):
+        spc_top_k = [spc_top_k] * len(frag_type_subsets)
+    frag_types = [_t for _types in frag_type_subsets for _t in _types]
+    for df in [predict_intensity_df, fragment_intensity_df]:
+        missing = set(frag_types) - set(df.columns)
+        if missing:
+            raise KeyError(f"Fragment types `{sorted(missing)}` are not in the columns")
+    return _calc_ms2_similarity_multi(
+        psm_df.frag_start_idx.values.astype(np.int64),
+        psm_df.frag_stop_idx.values.astype(np.int64),
+        predict_intensity_df.values,
+        fragment_intensity_df.values,
+        predict_intensity_df.columns.get_indexer(frag_types).astype(np.int64),
+        fragment_intensity_df.columns.get_indexer(frag_types).astype(np.int64),
+        np.cumsum([0] + [len(_types) for _types in frag_type_subsets]).astype(np.int64),
+        np.array([similarity_metric_ids[met] for met in metrics], dtype=np.int64),
+        np.array(spc_top_k, dtype=np.int64),
+    )
+
+
+@numba.njit(parallel=True, nogil=True)
+def _calc_pccs_between_blocks(
+    frag_starts: np.ndarray,
+    frag_stops: np.ndarray,
+    intens: np.ndarray,
+    block_len: int,
+    block_num: int,
+) -> np.ndarray:
+    ret = np.ones((len(frag_starts), block_num, block_num), dtype=np.float32)
+    for i in numba.prange(len(frag_starts)):
+        frag_start = frag_starts[i]
+        frag_stop = frag_stops[i]
+        blocks = np.empty(
+            (block_num, (frag_stop - frag_start) * intens.shape[1]), dtype=np.float64
+        )
+        for b in range(block_num):
+            block = intens[b * block_len + frag_start : b * block_len + frag_stop]
+            blocks[b] = block.astype(np.float32).ravel()
+            blocks[b] -= blocks[b].mean()
+        for b1 in range(block_num):
+            for b2 in range(b1 + 1, block_num):
+                ret[i, b1, b2] = ret[i, b2, b1] = _cosine(blocks[b1], blocks[b2])
+    return ret
+
+
+def calc_pccs_between_blocks(
+    psm_df: pd.DataFrame,
+    fragment_intensity_df: pd.DataFrame,
+    block_num: int,
+) -> np.ndarray:
+    """PCCs between the fragment intensities of all pairs of blocks, e.g.
+    the intensities of the same precursors matched against
+    `block_num` DIA scans (see `PepSpecMatch_DIA.max_spec_per_query`).
+    The fragments of each PSM are read once for all pairs.
+
+    Parameters
+    ----------
+    psm_df : pd.DataFrame
+        PSM DataFrame of the first block, 'frag_start_idx' and
+        'frag_stop_idx' point to the fragments in the first block.
+
+    fragment_intensity_df : pd.DataFrame
+        `block_num` blocks of the same length.
+
+    block_num : int
+        Number of blocks.
+
+    Returns
+    -------
+    np.ndarray
+        float32 with shape (len(psm_df), block_num, block_num),
+        symmetric with ones on the diagonal.
+    """
+    return _calc_pccs_between_blocks(
+        psm_df.frag_start_idx.values.astype(np.int64),
+        psm_df.frag_stop_idx.values.astype(np.int64),
+        fragment_intensity_df.values,
+        len(fragment_intensity_df) // block_num,
+        block_num,
+    )
@@ -1,7 +1,10 @@
 import torch
+import hashlib
 import pandas as pd
 import numpy as np
 
+from alphabase.yaml_utils import save_yaml, load_yaml
+
 from peptdeep.model.featurize import get_batch_aa_indices, get_batch_mod_feature
 
 from peptdeep.settings import model_const
@@ -35,6 +38,78 @@ IRT_PEPTIDE_DF["nAA"] = IRT_PEPTIDE_DF.sequence.str.len()
 irt_pep = IRT_PEPTIDE_DF
 
 
+def get_irt_pep_df_hash(irt_pep_df: pd.DataFrame) -> str:
+    """md5 hash of the peptides and iRT values in an iRT peptide dataframe"""
+    irt_col = "irt" if "irt" in irt_pep_df.columns else "rt"
+    return hashlib.md5(
+        pd.util.hash_pandas_object(
+            irt_pep_df[["sequence", "mods", "mod_sites", irt_col]], index=False
+        ).values.tobytes()
+    ).hexdigest()
+
+
+class IRTCalibration:
+    """
+    Linear calibration from predicted RT to iRT: `irt_pred = rt_pred*slope+intercept`.
+    It is identified by the hash of the RT model weights and
+    the hash of the iRT peptide dataframe used to fit it.
+    """
+
+    def __init__(
+        self,
+        slope: float,
+        intercept: float,
+        model_hash: str = "",
+        irt_pep_hash: str = "",
+        regression: dict = None,
+    ):
+        self.slope = float(slope)
+        self.intercept = float(intercept)
+        self.model_hash = model_hash
+        self.irt_pep_hash = irt_pep_hash
+        self.regression = {} if regression is None else regression
+
+    @property
+    def key(self) -> tuple:
+        return (self.model_hash, self.irt_pep_hash)
+
+    def apply(self, precursor_df: pd.DataFrame) -> pd.DataFrame:
+        """Add 'irt_pred' column into `precursor_df` based on 'rt_pred'"""
+        precursor_df["irt_pred"] = precursor_df.rt_pred * self.slope + self.intercept
+        return precursor_df
+
+    def to_dict(self) -> dict:
+        return {
+            "slope": self.slope,
+            "intercept": self.intercept,
+            "model_hash": self.model_hash,
+            "irt_pep_hash": self.irt_pep_hash,
+            "regression": self.regression,
+        }
+
+    @classmethod
+    def from_dict(cls, calibration_dict: dict) -> "IRTCalibration":
+        return cls(**calibration_dict)
+
+    def save(self, yaml_file: str):
+        save_yaml(yaml_file, self.to_dict())
+
+    @classmethod
+    def load(cls, yaml_file: str) -> "IRTCalibration":
+        return cls.from_dict(load_yaml(yaml_file))
+
+
+_irt_calibration_cache = {}
+
+
+def register_irt_calibration(calibration: IRTCalibration):
+    """Register a (loaded) calibration, it will be used by
+    :meth:`AlphaRTModel.get_irt_calibration` if both the RT model
+    and the iRT peptides match.
+    """
+    _irt_calibration_cache[calibration.key] = calibration
+
+
 class Model_RT_Bert(torch.nn.Module):
     """Transformer model for RT prediction"""
 
@@ -162,13 +237,31 @@ class AlphaRTModel(model_interface.ModelInterface):
             self._get_mod_features(batch_df),
         )
 
-    def add_irt_column_to_precursor_df(
+    def get_irt_calibration(
         self,
-        precursor_df: pd.DataFrame,
         irt_pep_df: pd.DataFrame = None,
-    ):
+    ) -> IRTCalibration:
+        """Get the RT-to-iRT calibration of this model. The calibration is
+        cached by (model weights hash, iRT peptide hash), the iRT peptides are
+        predicted and fitted only if there is no cached calibration.
+
+        Parameters
+        ----------
+        irt_pep_df : pd.DataFrame, optional
+            iRT peptides with 'irt' (or 'rt') column, by default None
+            (use `IRT_PEPTIDE_DF`).
+
+        Returns
+        -------
+        IRTCalibration
+            The calibration.
+        """
         if irt_pep_df is None:
             irt_pep_df = IRT_PEPTIDE_DF
+        key = (self.get_model_hash(), get_irt_pep_df_hash(irt_pep_df))
+        if key in _irt_calibration_cache:
+            return _irt_calibration_cache[key]
+
         print(f"Predict RT for {len(irt_pep_df)} iRT precursors.")
         self.predict(irt_pep_df)
         if "irt" not in irt_pep_df.columns:
@@ -184,7 +277,19 @@ class AlphaRTModel(model_interface.ModelInterface):
         # slope = np.sum(x*y)/np.sum(x*x)
         # intercept = irt_mean - slope*rt_pred_mean
         # end linear regression
-        slope = eval_df.slope.values[0]
-        intercept = eval_df.intercept.values[0]
-        precursor_df["irt_pred"] = precursor_df.rt_pred * slope + intercept
-        return precursor_df
+        calibration = IRTCalibration(
+            slope=eval_df.slope.values[0],
+            intercept=eval_df.intercept.values[0],
+            model_hash=key[0],
+            irt_pep_hash=key[1],
+            regression={col: float(val) for col, val in eval_df.iloc[0].items()},
+        )
+        register_irt_calibration(calibration)
+        return calibration
+
+    def add_irt_column_to_precursor_df(
+        self,
+        precursor_df: pd.DataFrame,
+        irt_pep_df: pd.DataFrame = None,
+    ):
+        return self.get_irt_calibration(irt_pep_df).apply(precursor_df)
@@ -20,6 +20,8 @@ from peptdeep.utils import logging, set_logger, show_platform_info, show_python_
 
 # from peptdeep.rescore.percolator import Percolator
 from peptdeep.spec_lib.library_factory import library_maker_provider
+from peptdeep.spec_lib.checkpoint import get_checkpoint_folder, remove_checkpoint
+from peptdeep.spec_lib.window_shard import save_library_window_shards
 
 from peptdeep.pretrained_models import ModelManager
 
@@ -31,7 +33,7 @@ from alpharaw.match.psm_match import (
     get_ion_count_scores,
 )
 
-from peptdeep.model.ms2 import calc_ms2_similarity
+from peptdeep.model.ms2 import calc_pccs_between_blocks, add_cutoff_metric
 import peptdeep.model.rt as rt_module
 
 DIA_max_spec_per_query = 3
@@ -86,25 +88,23 @@ def get_median_pccs_for_dia_psms(
     fragment_intensity_df: pd.DataFrame,
 ):
     _frag_df = fragment_intensity_df.mask(fragment_mz_df < psm_match.min_frag_mz, 0.0)
-    frag_len = len(_frag_df) // psm_match.max_spec_per_query
-    psm_len = len(psm_match.psm_df) // psm_match.max_spec_per_query
-    _df = psm_match.psm_df.iloc[:psm_len].copy()
+    spec_num = psm_match.max_spec_per_query
+    psm_len = len(psm_match.psm_df) // spec_num
+    _df = psm_match.psm_df.iloc[:psm_len]
+    # PCCs between all pairs of the DIA scans of each precursor in one pass
+    pccs = calc_pccs_between_blocks(_df, _frag_df, spec_num)
     median_pccs = np.zeros(len(psm_df))
     metrics_list = []
-    for i in range(psm_match.max_spec_per_query):
-        pcc_list = []
-        for j in range(psm_match.max_spec_per_query):
-            if i == j:
-                continue
-            _df, metrics_df = calc_ms2_similarity(
-                _df,
-                _frag_df[i * frag_len : (i + 1) * frag_len],
-                _frag_df[j * frag_len : (j + 1) * frag_len],
-            )
-            pcc_list.append(_df.PCC.values)
-            metrics_list.append(metrics_df)
-        pccs = np.median(np.array(pcc_list), axis=0)
-        median_pccs[i * psm_len : (i + 1) * psm_len] = pccs
+    for i in range(spec_num):
+        median_pccs[i * psm_len : (i + 1) * psm_len] = np.median(
+            np.delete(pccs[:, i], i, axis=1), axis=1
+        )
+        for j in range(i + 1, spec_num):
+            metrics_df = pd.DataFrame({"PCC": pccs[:, i, j]})
+            metrics_describ = metrics_df.describe()
+            add_cutoff_metric(metrics_describ, metrics_df, thres=0.9)
+            add_cutoff_metric(metrics_describ, metrics_df, thres=0.75)
+            metrics_list.append(metrics_describ)
 
     logging.info(
         f"Average MS2 similarity metrics among {psm_match.max_spec_per_query} DIA scans at frag_mz>={psm_match.min_frag_mz}:\n"
@@ -371,6 +371,9 @@ def generate_library():
     lib_settings['infile_type'] # str. Input type for the library, could be 'fasta', 'sequence', 'peptide', or 'precursor'
     lib_settings['infiles'] # list of str. Input files to generate librarys
     lib_settings['output_tsv']['enabled'] # bool. If output tsv for diann/spectronaut
+    lib_settings['incremental']['enabled'] # bool. If only predict new precursors against a previous library
+    lib_settings['checkpoint']['enabled'] # bool. If save/resume predicted batches in output_folder
+    lib_settings['output_window_shards']['enabled'] # bool. If save one library shard per DIA isolation window
     ```
     Raises
     ------
@@ -421,23 +424,55 @@ def generate_library():
                 f"{lib_settings['irt_library']} does not exist, use default IRT_PEPTIDE_DF to translate irt"
             )
 
+        irt_calibration_file = os.path.join(output_folder, "irt_calibration.yaml")
+        if lib_settings["rt_to_irt"] and os.path.isfile(irt_calibration_file):
+            # reused only if both the RT model and iRT peptides are unchanged
+            rt_module.register_irt_calibration(
+                rt_module.IRTCalibration.load(irt_calibration_file)
+            )
+
         if (
             lib_settings["infile_type"].lower()
             in library_maker_provider.library_maker_dict
         ):
-            lib_maker.make_library(lib_settings["infiles"])
+            infiles = lib_settings["infiles"]
         else:  # PSMReaderLibraryMaker
-            lib_maker.make_library(
-                (lib_settings["infile_type"], lib_settings["infiles"])
+            infiles = (lib_settings["infile_type"], lib_settings["infiles"])
+
+        if lib_settings["checkpoint"]["enabled"]:
+            lib_maker.checkpoint_folder = get_checkpoint_folder(output_folder)
+
+        if lib_settings["incremental"]["enabled"]:
+            lib_maker.make_library_incrementally(
+                infiles,
+                lib_settings["incremental"]["previous_output_folder"] or output_folder,
             )
+        else:
+            lib_maker.make_library(infiles)
 
         save_yaml(
             os.path.join(output_folder, "peptdeep_settings.yaml"), global_settings
         )
+        with open(os.path.join(output_folder, "model_hash.txt"), "w") as f:
+            f.write(model_mgr.get_model_hash())
+        if lib_settings["rt_to_irt"]:
+            model_mgr.rt_model.get_irt_calibration().save(irt_calibration_file)
 
         hdf_path = os.path.join(output_folder, "predict.speclib.hdf")
         logging.info(f"Saving HDF library to {hdf_path} ...")
         lib_maker.spec_lib.save_hdf(hdf_path)
+        if lib_maker.checkpoint_folder:
+            remove_checkpoint(output_folder)
+        if lib_settings["output_window_shards"]["enabled"]:
+            save_library_window_shards(
+                lib_maker.spec_lib,
+                lib_settings["output_window_shards"]["windows"],
+                os.path.join(output_folder, "window_shards"),
+                file_format=lib_settings["output_window_shards"]["file_format"],
+                min_fragment_intensity=lib_settings["output_tsv"][
+                    "min_relative_intensity"
+                ],
+            )
         if lib_settings["output_tsv"]["enabled"]:
             tsv_path = os.path.join(output_folder, "predict.speclib.tsv")
             lib_maker.translate_to_tsv(
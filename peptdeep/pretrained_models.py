@@ -1,8 +1,10 @@
 import os
+import hashlib
 import pathlib
 import io
 import sys
 import pandas as pd
+import numpy as np
 import torch
 import urllib
 import socket
@@ -24,12 +26,18 @@ from typing import Union
 from alphabase.peptide.fragment import (
     create_fragment_mz_dataframe,
     concat_precursor_fragment_dataframes,
+    parse_charged_frag_type,
+    FRAGMENT_TYPES,
 )
 from alphabase.peptide.precursor import refine_precursor_df, update_precursor_mz
 from alphabase.peptide.mobility import mobility_to_ccs_for_df, ccs_to_mobility_for_df
 
 from peptdeep.settings import global_settings, add_user_defined_modifications
-from peptdeep.utils import logging, process_bar
+from peptdeep.utils import (
+    logging,
+    process_bar,
+    concat_precursor_flat_fragment_dataframes,
+)
 from peptdeep.settings import global_settings
 
 from peptdeep.model.ms2 import (
@@ -41,6 +49,8 @@ from peptdeep.model.rt import AlphaRTModel
 from peptdeep.model.ccs import AlphaCCSModel
 from peptdeep.model.charge import ChargeModelForAASeq, ChargeModelForModAASeq
 from peptdeep.utils import uniform_sampling, evaluate_linear_regression
+from peptdeep.utils import AdaptiveBatchSizer, estimate_precursor_bytes
+from peptdeep.mass_spec.match import SparseMatchedFragments
 
 from peptdeep.settings import global_settings, update_global_settings
 
@@ -285,6 +295,7 @@ class ModelManager(object):
             Defaults to 'gpu'
         """
         self._train_psm_logging = True
+        self._batch_sizers = {}
 
         self.ms2_model: pDeepModel = pDeepModel(
             mask_modloss=mask_modloss, device=device
@@ -419,6 +430,20 @@ class ModelManager(object):
             os.makedirs(folder)
             self.save_models(folder)
 
+    def get_model_hash(self) -> str:
+        """Get a combined md5 hash of the MS2/RT/CCS (and charge) model weights.
+
+        Returns
+        -------
+        str
+            md5 hex digest, it changes if any of the models are changed.
+        """
+        md5 = hashlib.md5()
+        for model in [self.ms2_model, self.rt_model, self.ccs_model, self.charge_model]:
+            if model is not None:
+                md5.update(model.get_model_hash().encode())
+        return md5.hexdigest()
+
     def load_installed_models(self, model_type: str = "generic"):
         """Load built-in MS2/CCS/RT models.
 
@@ -693,8 +718,17 @@ class ModelManager(object):
             PSM dataframe for fine-tuning
 
         matched_intensity_df : pd.DataFrame
-            The matched fragment intensities for `psm_df`.
+            The matched fragment intensities for `psm_df`, can also be
+            :class:`peptdeep.mass_spec.match.SparseMatchedFragments`.
         """
+        if isinstance(matched_intensity_df, SparseMatchedFragments):
+            matched_intensity_df = matched_intensity_df.to_intensity_df(
+                [
+                    frag_type
+                    for frag_type in self.ms2_model.charged_frag_types
+                    if frag_type in matched_intensity_df.columns
+                ]
+            )
         if self.psm_num_to_train_ms2 > 0:
             if self.psm_num_to_train_ms2 < len(psm_df):
                 tr_df = psm_sampling_with_important_mods(
@@ -825,6 +859,166 @@ class ModelManager(object):
             verbose=self.verbose,
         )
 
+    def predict_ms2_sparse(
+        self,
+        precursor_df: pd.DataFrame,
+        *,
+        frag_types: list = None,
+        batch_size: int = 512,
+        min_fragment_intensity: float = 0.001,
+        keep_top_k_fragments: int = 1000,
+    ) -> pd.DataFrame:
+        """Predict MS2 for the given precursor_df and only keep
+        the top-k fragments above `min_fragment_intensity`,
+        see :meth:`peptdeep.model.ms2.pDeepModel.predict_sparse`.
+
+        Parameters
+        ----------
+        precursor_df : pd.DataFrame
+            Precursor dataframe for MS2 prediction
+
+        frag_types : list, optional
+            Fragment types to keep. If it is None, it then depends on
+            `self.ms2_model.charged_frag_types` and `self.ms2_model.model._mask_modloss`.
+            Defaults to None.
+
+        batch_size : int, optional
+            Batch size for prediction.
+            Defaults to 512.
+
+        min_fragment_intensity : float, optional
+            Defaults to 0.001.
+
+        keep_top_k_fragments : int, optional
+            Defaults to 1000.
+
+        Returns
+        -------
+        pd.DataFrame
+            The sparse fragment dataframe with 'precursor_idx', 'frag_position',
+            'frag_type' (index of `frag_types`), 'intensity' and 'mz' columns.
+        """
+        self.set_default_nce_instrument(precursor_df)
+        if frag_types is None:
+            frag_types = [
+                frag
+                for frag in self.ms2_model.charged_frag_types
+                if not self.ms2_model.model._mask_modloss or "modloss" not in frag
+            ]
+        if self.verbose:
+            logging.info("Predicting sparse MS2 ...")
+        return self.ms2_model.predict_sparse(
+            precursor_df,
+            frag_types=frag_types,
+            batch_size=batch_size,
+            min_fragment_intensity=min_fragment_intensity,
+            keep_top_k_fragments=keep_top_k_fragments,
+            verbose=self.verbose,
+        )
+
+    def predict_ms2_flat(
+        self,
+        precursor_df: pd.DataFrame,
+        *,
+        frag_types: list = None,
+        batch_size: int = 512,
+        min_fragment_intensity: float = -1,
+        keep_top_k_fragments: int = 1000,
+        custom_columns: list = ["type", "number", "position", "charge", "loss_type"],
+    ) -> pd.DataFrame:
+        """Predict MS2 for the given precursor_df into the flat fragment format
+        of `alphabase.spectral_library.flat.SpecLibFlat`.
+        It gives the same fragments as `alphabase.peptide.fragment.flatten_fragments`
+        on the dense predictions, but the fragments are selected by
+        :meth:`predict_ms2_sparse`, so no dense dataframe is created.
+        Only invalid fragments (m/z of 0 in the dense format) are handled
+        differently: they never take one of the `keep_top_k_fragments` slots.
+
+        Parameters
+        ----------
+        precursor_df : pd.DataFrame
+            Precursor dataframe for MS2 prediction.
+            'flat_frag_start_idx' and 'flat_frag_stop_idx' columns
+            will be inserted inplace.
+
+        frag_types : list, optional
+            See :meth:`predict_ms2_sparse`. Defaults to None.
+
+        batch_size : int, optional
+            Batch size for prediction.
+            Defaults to 512.
+
+        min_fragment_intensity : float, optional
+            Defaults to -1.
+
+        keep_top_k_fragments : int, optional
+            Defaults to 1000.
+
+        custom_columns : list, optional
+            Columns besides 'mz' and 'intensity', see
+            `alphabase.peptide.fragment.flatten_fragments`.
+            Defaults to ['type','number','position','charge','loss_type'].
+
+        Returns
+        -------
+        pd.DataFrame
+            The flat fragment dataframe.
+        """
+        if frag_types is None:
+            frag_types = [
+                frag
+                for frag in self.ms2_model.charged_frag_types
+                if not self.ms2_model.model._mask_modloss or "modloss" not in frag
+            ]
+        frag_types = [
+            frag for frag in frag_types if frag in self.ms2_model.charged_frag_types
+        ]
+        sparse_df = self.predict_ms2_sparse(
+            precursor_df,
+            frag_types=frag_types,
+            batch_size=batch_size,
+            min_fragment_intensity=min_fragment_intensity,
+            keep_top_k_fragments=keep_top_k_fragments,
+        )
+        frag_type_list = [parse_charged_frag_type(frag) for frag in frag_types]
+        type_idxes = sparse_df.frag_type.values
+        positions = sparse_df.frag_position.values.astype(np.uint32)
+
+        fragment_df = {
+            "mz": sparse_df.mz.values,
+            "intensity": sparse_df.intensity.values,
+        }
+        if "type" in custom_columns:
+            fragment_df["type"] = np.array(
+                [FRAGMENT_TYPES[frag].series_id for frag, _ in frag_type_list],
+                dtype=np.int8,
+            )[type_idxes]
+        if "loss_type" in custom_columns:
+            fragment_df["loss_type"] = np.array(
+                [FRAGMENT_TYPES[frag].loss_id for frag, _ in frag_type_list],
+                dtype=np.int16,
+            )[type_idxes]
+        if "charge" in custom_columns:
+            fragment_df["charge"] = np.array(
+                [charge for _, charge in frag_type_list], dtype=np.int8
+            )[type_idxes]
+        if "number" in custom_columns:
+            directions = np.array(
+                [FRAGMENT_TYPES[frag].direction_id for frag, _ in frag_type_list],
+                dtype=np.int8,
+            )[type_idxes]
+            row_counts = (
+                precursor_df.nAA.values[sparse_df.precursor_idx.values] - 1
+            ).astype(np.uint32)
+            fragment_df["number"] = np.where(
+                directions == 1,
+                positions + 1,
+                np.where(directions == -1, row_counts - positions, 0),
+            ).astype(np.uint32)
+        if "position" in custom_columns:
+            fragment_df["position"] = positions
+        return pd.DataFrame(fragment_df)
+
     def predict_rt(
         self, precursor_df: pd.DataFrame, *, batch_size: int = 1024
     ) -> pd.DataFrame:
@@ -878,6 +1072,40 @@ class ModelManager(object):
         )
         return self.ccs_model.ccs_to_mobility_pred(precursor_df)
 
+    def get_predict_batch_size(self, key: str, bytes_per_item: float = 0) -> int:
+        """Get the batch size `global_settings['model_mgr']['predict'][key]`.
+        If `model_mgr:predict:adaptive_batch_size:enabled` and the models are
+        on CPU, it is adapted to the current memory usage by an
+        :class:`peptdeep.utils.AdaptiveBatchSizer`. On GPUs, the mini batches
+        are limited by the GPU memory rather than the RSS of the process,
+        so the batch size is not adapted.
+
+        Parameters
+        ----------
+        key : str
+            'batch_size_ms2' or 'batch_size_rt_ccs'.
+
+        bytes_per_item : float, optional
+            See :meth:`peptdeep.utils.AdaptiveBatchSizer.update`, by default 0.
+
+        Returns
+        -------
+        int
+            The batch size.
+        """
+        predict_settings = model_mgr_settings["predict"]
+        adaptive_settings = predict_settings["adaptive_batch_size"]
+        if not adaptive_settings["enabled"] or self.ms2_model.device_type != "cpu":
+            return predict_settings[key]
+        if key not in self._batch_sizers:
+            self._batch_sizers[key] = AdaptiveBatchSizer(
+                predict_settings[key],
+                max_batch_size=predict_settings[key] * adaptive_settings["max_scale"],
+                memory_ceiling_gb=adaptive_settings["memory_ceiling_gb"],
+                name=key,
+            )
+        return self._batch_sizers[key].update(bytes_per_item)
+
     def _predict_func_for_mp(self, arg_dict: dict):
         """Internal function, for multiprocessing"""
         update_global_settings(arg_dict.pop("mp_global_settings"))
@@ -891,6 +1119,7 @@ class ModelManager(object):
         frag_types: list = None,
         process_num: int = 8,
         mp_batch_size: int = 100000,
+        flatten_kwargs: dict = None,
     ):
         self.ms2_model.model.share_memory()
         self.rt_model.model.share_memory()
@@ -916,6 +1145,7 @@ class ModelManager(object):
                         "precursor_df": df.iloc[i : i + mp_batch_size, :],
                         "predict_items": predict_items,
                         "frag_types": frag_types,
+                        "flatten_kwargs": flatten_kwargs,
                         "mp_global_settings": mp_global_settings,
                     }
 
@@ -925,6 +1155,8 @@ class ModelManager(object):
             fragment_intensity_df_list = []
         else:
             fragment_mz_df_list = None
+        flatten = flatten_kwargs is not None and fragment_mz_df_list is not None
+        fragment_df_list = []
 
         if self.verbose:
             logging.info(f'Predicting {",".join(predict_items)} ...')
@@ -939,12 +1171,20 @@ class ModelManager(object):
                 get_batch_num_mp(df_groupby),
             ):
                 precursor_df_list.append(ret_dict["precursor_df"])
-                if fragment_mz_df_list is not None:
+                if flatten:
+                    # fragments were flattened in the worker
+                    fragment_df_list.append(ret_dict["fragment_df"])
+                elif fragment_mz_df_list is not None:
                     fragment_mz_df_list.append(ret_dict["fragment_mz_df"])
                     fragment_intensity_df_list.append(ret_dict["fragment_intensity_df"])
         self.verbose = verbose_bak
 
-        if fragment_mz_df_list is not None:
+        if flatten:
+            precursor_df, fragment_df = concat_precursor_flat_fragment_dataframes(
+                precursor_df_list, fragment_df_list
+            )
+            return {"precursor_df": precursor_df, "fragment_df": fragment_df}
+        elif fragment_mz_df_list is not None:
             (precursor_df, fragment_mz_df, fragment_intensity_df) = (
                 concat_precursor_fragment_dataframes(
                     precursor_df_list,
@@ -974,6 +1214,7 @@ class ModelManager(object):
         min_required_precursor_num_for_mp: int = 3000,
         process_num: int = 8,
         mp_batch_size: int = 100000,
+        flatten_kwargs: dict = None,
     ) -> Dict[str, pd.DataFrame]:
         """
         Predict all items defined by `predict_items`,
@@ -1011,6 +1252,15 @@ class ModelManager(object):
             Splitting data into batches for multiprocessing.
             Defaults to 100000.
 
+        flatten_kwargs : dict, optional
+            If not None and 'ms2' in predict_items, the fragments are predicted
+            into the flat format by :meth:`predict_ms2_flat` with these kwargs
+            (`min_fragment_intensity`, `keep_top_k_fragments` and
+            `custom_columns`), as `alphabase.peptide.fragment.flatten_fragments`
+            does for dense fragments. With multiprocessing, this is done
+            in the workers, so only the flat dataframes are sent back.
+            Defaults to None.
+
         Returns
         -------
         Dict[str, pd.DataFrame]
@@ -1022,6 +1272,7 @@ class ModelManager(object):
             'fragment_intensity_df': fragment_intensity_df
             }
             ```
+            or `{'fragment_df': fragment_df}` if `flatten_kwargs` is not None.
         """
 
         def refine_df(df):
@@ -1050,15 +1301,30 @@ class ModelManager(object):
             or len(precursor_df) < min_required_precursor_num_for_mp
         ):
             refine_df(precursor_df)
+            # Estimated memory of each precursor for the adaptive batch sizes,
+            # RT and CCS do not predict fragments.
+            if len(precursor_df) > 0:
+                rt_ccs_bytes_per_item = estimate_precursor_bytes(
+                    precursor_df.nAA.values, 0
+                ).mean()
+                ms2_bytes_per_item = estimate_precursor_bytes(
+                    precursor_df.nAA.values, len(frag_types)
+                ).mean()
+            else:
+                rt_ccs_bytes_per_item = ms2_bytes_per_item = 0
             if "rt" in predict_items:
                 self.predict_rt(
                     precursor_df,
-                    batch_size=model_mgr_settings["predict"]["batch_size_rt_ccs"],
+                    batch_size=self.get_predict_batch_size(
+                        "batch_size_rt_ccs", rt_ccs_bytes_per_item
+                    ),
                 )
             if "mobility" in predict_items:
                 self.predict_mobility(
                     precursor_df,
-                    batch_size=model_mgr_settings["predict"]["batch_size_rt_ccs"],
+                    batch_size=self.get_predict_batch_size(
+                        "batch_size_rt_ccs", rt_ccs_bytes_per_item
+                    ),
                 )
             if "ms2" in predict_items:
                 if "frag_start_idx" in precursor_df.columns:
@@ -1066,11 +1332,27 @@ class ModelManager(object):
                         columns=["frag_start_idx", "frag_stop_idx"], inplace=True
                     )
 
+                if flatten_kwargs is not None:
+                    fragment_df = self.predict_ms2_flat(
+                        precursor_df,
+                        frag_types=frag_types,
+                        batch_size=self.get_predict_batch_size(
+                            "batch_size_ms2", ms2_bytes_per_item
+                        ),
+                        **flatten_kwargs,
+                    )
+                    return {
+                        "precursor_df": precursor_df,
+                        "fragment_df": fragment_df,
+                    }
+
                 fragment_mz_df = create_fragment_mz_dataframe(precursor_df, frag_types)
 
                 fragment_intensity_df = self.predict_ms2(
                     precursor_df,
-                    batch_size=model_mgr_settings["predict"]["batch_size_ms2"],
+                    batch_size=self.get_predict_batch_size(
+                        "batch_size_ms2", ms2_bytes_per_item
+                    ),
                 )
 
                 fragment_intensity_df.drop(
@@ -1096,6 +1378,8 @@ class ModelManager(object):
             return self.predict_all_mp(
                 precursor_df,
                 predict_items=predict_items,
+                frag_types=frag_types,
                 process_num=process_num,
                 mp_batch_size=mp_batch_size,
+                flatten_kwargs=flatten_kwargs,
             )
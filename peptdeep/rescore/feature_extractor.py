@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+import numba
 import os
 
 import torch
@@ -10,8 +11,8 @@ from alphabase.peptide.precursor import refine_precursor_df
 from alphabase.peptide.fragment import concat_precursor_fragment_dataframes
 
 from peptdeep.pretrained_models import ModelManager
-from peptdeep.model.ms2 import calc_ms2_similarity
-from peptdeep.mass_spec.match import PepSpecMatch
+from peptdeep.model.ms2 import calc_ms2_similarity_multi
+from peptdeep.mass_spec.match import PepSpecMatch, SparseMatchedFragments
 
 from peptdeep.rescore.fdr import calc_fdr_for_df
 from peptdeep.utils import process_bar, logging
@@ -27,9 +28,17 @@ def match_one_raw(
     ms2_ppm,
     ms2_tol,
     calibrate_frag_mass_error,
+    matched_format=None,
 ):
     """Internal function"""
-    match = PepSpecMatch(charged_frag_types=frag_types_to_match)
+    if matched_format is None:
+        matched_format = global_settings["peak_matching"]["matched_format"]
+    match = PepSpecMatch(
+        charged_frag_types=frag_types_to_match,
+        matched_format=matched_format,
+        profile_intensity=global_settings["peak_matching"]["profile_intensity"],
+        block_spectrum_num=global_settings["peak_matching"]["block_spectrum_num"],
+    )
 
     (psm_df, fragment_mz_df, matched_intensity_df, matched_mz_err_df) = (
         match.match_ms2_one_raw(
@@ -53,11 +62,73 @@ def match_one_raw(
     return (psm_df, fragment_mz_df, matched_intensity_df, matched_mz_err_df)
 
 
+@numba.njit(parallel=True, nogil=True)
+def _get_max_abs_mass_err(
+    frag_starts: np.ndarray,
+    frag_stops: np.ndarray,
+    mass_errs: np.ndarray,
+    merr_cols: np.ndarray,
+) -> float:
+    """Max abs mass error of the PSM fragments, unmatched errors (> 1e6) are 0"""
+    psm_max_errs = np.zeros(len(frag_starts), dtype=np.float64)
+    for i in numba.prange(len(frag_starts)):
+        max_err = 0.0
+        for j in range(frag_starts[i], frag_stops[i]):
+            for col in merr_cols:
+                if mass_errs[j, col] <= 1000000:
+                    max_err = max(max_err, abs(mass_errs[j, col]))
+        psm_max_errs[i] = max_err
+    return psm_max_errs.max() if len(psm_max_errs) > 0 else 0.0
+
+
+@numba.njit(parallel=True, nogil=True)
+def _get_psm_scores(
+    frag_starts: np.ndarray,
+    frag_stops: np.ndarray,
+    matched_intens: np.ndarray,
+    predicted_intens: np.ndarray,
+    mass_errs: np.ndarray,
+    matched_cols: np.ndarray,
+    pred_cols: np.ndarray,
+    merr_cols: np.ndarray,
+    max_merr: float,
+) -> tuple:
+    """Segmented sums of peak scores (log matched intensities weighted by
+    mass errors) over the fragments of each PSM, see :func:`get_psm_scores`.
+    The k-th fragment type is the column `matched_cols[k]` of `matched_intens`,
+    `pred_cols[k]` of `predicted_intens` and `merr_cols[k]` of `mass_errs`."""
+    merr_weighted_scores = np.zeros(len(frag_starts), dtype=np.float32)
+    pred_weighted_scores = np.zeros(len(frag_starts), dtype=np.float32)
+    for i in numba.prange(len(frag_starts)):
+        peak_score_sum = 0.0
+        pred_score_sum = 0.0
+        scored_num = 0
+        for j in range(frag_starts[i], frag_stops[i]):
+            for k in range(len(matched_cols)):
+                mass_err = mass_errs[j, merr_cols[k]]
+                mass_err = 0.0 if mass_err > 1000000 else abs(mass_err)
+                if max_merr > 0:
+                    mass_err /= max_merr
+                peak_score = np.log(matched_intens[j, matched_cols[k]] + 1.0) * (
+                    1 - mass_err**4
+                )
+                if peak_score > 0:
+                    scored_num += 1
+                peak_score_sum += peak_score
+                pred_score_sum += peak_score * predicted_intens[j, pred_cols[k]]
+        frag_num = len(matched_cols) * (frag_stops[i] - frag_starts[i])
+        frag_ratio = np.sqrt(scored_num / frag_num) if frag_num > 0 else np.nan
+        merr_weighted_scores[i] = peak_score_sum * frag_ratio
+        pred_weighted_scores[i] = pred_score_sum * frag_ratio
+    return merr_weighted_scores, pred_weighted_scores
+
+
 def get_psm_scores(
     psm_df: pd.DataFrame,
     predict_intensity_df: pd.DataFrame,
     matched_intensity_df: pd.DataFrame,
     matched_mass_err_df: pd.DataFrame,
+    charged_frag_types: list = None,
 ) -> pd.DataFrame:
     """
     AlphaPeptDeep has a built-in score for PSMs,
@@ -73,55 +144,138 @@ def get_psm_scores(
         Matched intensity DataFrame
     matched_mass_err_df : pd.DataFrame
         Matched mass error DataFrame
+    charged_frag_types : list, optional
+        Fragment columns to score, by default None (all columns of
+        `matched_intensity_df`)
 
     Returns
     -------
     DataFrame
         `psm_df` with "*_score" columns appended inplace
     """
-    matched_norm_intensity_df = pd.DataFrame(
-        np.log(matched_intensity_df.values + 1),
-        columns=matched_intensity_df.columns.values,
-    )
-    matched_merr_weight_df = matched_mass_err_df.mask(
-        matched_mass_err_df > 1000000, 0
-    ).abs()
-    max_merr = matched_merr_weight_df.values.max()
-    if max_merr > 0:
-        matched_merr_weight_df /= max_merr
-    matched_merr_weight_df = 1 - matched_merr_weight_df.pow(4)
-
-    peak_score_df = matched_norm_intensity_df * matched_merr_weight_df
-
-    pred_weighted_score_df = peak_score_df * predict_intensity_df
-
-    def _get_one_score(
-        frag_start_end,
-        peak_score_values,
-        pred_weighted_score_values,
-    ):
-        frag_start, frag_end = frag_start_end
-        frag_ratio = (peak_score_values[frag_start:frag_end] > 0).mean() ** 0.5
-        return (
-            peak_score_values[frag_start:frag_end].sum() * frag_ratio,
-            pred_weighted_score_values[frag_start:frag_end].sum() * frag_ratio,
-        )
+    if charged_frag_types is None:
+        charged_frag_types = list(matched_intensity_df.columns)
+
+    def _get_values_and_cols(df):
+        cols = df.columns.get_indexer(charged_frag_types)
+        if np.any(cols < 0):
+            raise KeyError(
+                f"Fragment types `{charged_frag_types}` are not in the columns"
+            )
+        return df.values, cols.astype(np.int64)
+
+    matched_intens, matched_cols = _get_values_and_cols(matched_intensity_df)
+    predicted_intens, pred_cols = _get_values_and_cols(predict_intensity_df)
+    mass_errs, merr_cols = _get_values_and_cols(matched_mass_err_df)
 
+    frag_starts = psm_df.frag_start_idx.values.astype(np.int64)
+    frag_stops = psm_df.frag_stop_idx.values.astype(np.int64)
+    max_merr = _get_max_abs_mass_err(frag_starts, frag_stops, mass_errs, merr_cols)
     (
         psm_df["merr_weighted_score"],
         psm_df["pred_weighted_score"],
-    ) = zip(
-        *psm_df[["frag_start_idx", "frag_stop_idx"]].apply(
-            _get_one_score,
-            axis=1,
-            peak_score_values=peak_score_df.values,
-            pred_weighted_score_values=pred_weighted_score_df.values,
-        )
+    ) = _get_psm_scores(
+        frag_starts,
+        frag_stops,
+        matched_intens,
+        predicted_intens,
+        mass_errs,
+        matched_cols,
+        pred_cols,
+        merr_cols,
+        max_merr,
     )
-
     return psm_df
 
 
+# Fragment-count features of each fragment subset ("frag", "bion" or "yion"),
+# in the column order of `_get_frag_features`.
+_frag_feature_templates = [
+    "matched_{}_num",
+    "matched_{}_ratio",
+    "both_matched_pred_{}_num",
+    "both_matched_pred_{}_to_matched",
+    "both_matched_pred_{}_to_pred",
+    "matched_not_pred_{}_num",
+    "matched_not_pred_{}_ratio",
+    "pred_not_matched_{}_num",
+    "pred_not_matched_{}_ratio",
+    "matched_{}_rel_to_pred",
+    "pred_{}_rel_to_matched",
+]
+_frag_feature_num = len(_frag_feature_templates)
+
+
+@numba.njit(parallel=True, nogil=True)
+def _get_frag_features(
+    frag_starts: np.ndarray,
+    frag_stops: np.ndarray,
+    matched_intens: np.ndarray,
+    predicted_intens: np.ndarray,
+    subset_cols: np.ndarray,
+    subset_starts: np.ndarray,
+    pred_thresholds: np.ndarray,
+) -> np.ndarray:
+    """Fragment-count features of all PSMs and fragment subsets in one pass.
+    Subset `s` uses the columns `subset_cols[subset_starts[s]:subset_starts[s+1]]`,
+    a fragment is predicted if its predicted intensity > `pred_thresholds[s]`.
+    Features of empty subsets are 0.
+
+    Returns
+    -------
+    np.ndarray
+        float32 with shape (psm_num, subset_num*11), see `_frag_feature_templates`.
+    """
+    subset_num = len(subset_starts) - 1
+    n_feat = _frag_feature_num
+    features = np.zeros((len(frag_starts), subset_num * n_feat), dtype=np.float32)
+    for i in numba.prange(len(frag_starts)):
+        for s in range(subset_num):
+            cols = subset_cols[subset_starts[s] : subset_starts[s + 1]]
+            if len(cols) == 0:
+                continue
+            matched_num = 0
+            pred_num = 0
+            both_num = 0
+            matched_sum = 0.0
+            pred_sum = 0.0
+            matched_of_pred_sum = 0.0
+            pred_of_matched_sum = 0.0
+            for j in range(frag_starts[i], frag_stops[i]):
+                for col in cols:
+                    matched = matched_intens[j, col]
+                    predicted = predicted_intens[j, col]
+                    matched_sum += matched
+                    pred_sum += predicted
+                    if matched > 0:
+                        matched_num += 1
+                        pred_of_matched_sum += predicted
+                    if predicted > pred_thresholds[s]:
+                        pred_num += 1
+                        matched_of_pred_sum += matched
+                        if matched > 0:
+                            both_num += 1
+            frag_num = len(cols) * (frag_stops[i] - frag_starts[i])
+
+            ret = features[i, s * n_feat : (s + 1) * n_feat]
+            ret[0] = matched_num
+            ret[1] = matched_num / frag_num if frag_num > 0 else np.nan
+            ret[2] = both_num
+            ret[5] = matched_num - both_num
+            ret[7] = pred_num - both_num
+            if matched_num > 0:
+                ret[3] = both_num / matched_num
+                ret[6] = (matched_num - both_num) / matched_num
+            if pred_num > 0:
+                ret[4] = both_num / pred_num
+                ret[8] = (pred_num - both_num) / pred_num
+            if matched_of_pred_sum > 0:
+                ret[9] = matched_of_pred_sum / matched_sum
+            if pred_of_matched_sum > 0:
+                ret[10] = pred_of_matched_sum / pred_sum
+    return features
+
+
 def get_ms2_features(
     psm_df,
     frag_types,
@@ -148,314 +302,99 @@ def get_ms2_features(
     - matched_bion_ratio: # matched b fragments / # total b fragments
     - matched_yion_ratio: # matched y fragments / # total y fragments
     - and more ...
+
+    matched_intensity_df and matched_mass_err_df can also be
+    :class:`peptdeep.mass_spec.match.SparseMatchedFragments`, only
+    `frag_types` are densified (float32).
     """
     used_frag_types = frag_types
+    if isinstance(matched_intensity_df, SparseMatchedFragments):
+        matched_intensity_df = matched_intensity_df.to_intensity_df(used_frag_types)
+    if isinstance(matched_mass_err_df, SparseMatchedFragments):
+        matched_mass_err_df = matched_mass_err_df.to_mz_err_df(used_frag_types)
     predict_intensity_df = predict_intensity_df[used_frag_types]
 
-    def _get_frag_features(
-        frag_start_end,
-        matched_inten_values,
-        predicted_inten_values,
-        has_matched_intens,
-        has_predicted_intens,
-        has_both_matched_predicted,
-    ):
-        frag_start, frag_end = frag_start_end
-        matched_frag_num = has_matched_intens[frag_start:frag_end].sum(dtype=np.float32)
-
-        pred_frag_num = has_predicted_intens[frag_start:frag_end].sum(dtype=np.float32)
-
-        matched_frag_ratio = matched_frag_num / (
-            matched_inten_values.shape[1] * (frag_end - frag_start)
-        )
-
-        both_matched_pred_frag_num = has_both_matched_predicted[
-            frag_start:frag_end
-        ].sum(dtype=np.float32)
-
-        matched_not_pred_frag_num = (
-            has_matched_intens[frag_start:frag_end]
-            & ~has_both_matched_predicted[frag_start:frag_end]
-        ).sum(dtype=np.float32)
-
-        pred_not_matched_frag_num = (
-            has_predicted_intens[frag_start:frag_end]
-            & ~has_both_matched_predicted[frag_start:frag_end]
-        ).sum(dtype=np.float32)
-
-        if matched_frag_num > 0:
-            both_matched_pred_frag_to_matched = (
-                both_matched_pred_frag_num / matched_frag_num
-            )
-            matched_not_pred_frag_ratio = matched_not_pred_frag_num / matched_frag_num
-        else:
-            both_matched_pred_frag_to_matched = 0
-            matched_not_pred_frag_ratio = 0
-
-        if pred_frag_num > 0:
-            both_matched_pred_frag_to_pred = both_matched_pred_frag_num / pred_frag_num
-            pred_not_matched_frag_ratio = pred_not_matched_frag_num / pred_frag_num
-        else:
-            both_matched_pred_frag_to_pred = 0
-            pred_not_matched_frag_ratio = 0
-
-        matched_frag_rel_to_pred = matched_inten_values[frag_start:frag_end][
-            has_predicted_intens[frag_start:frag_end]
-        ].sum()
-        if matched_frag_rel_to_pred > 0:
-            matched_frag_rel_to_pred /= matched_inten_values[frag_start:frag_end].sum()
-
-        pred_frag_rel_to_matched = predicted_inten_values[frag_start:frag_end][
-            has_matched_intens[frag_start:frag_end]
-        ].sum()
-        if pred_frag_rel_to_matched > 0:
-            pred_frag_rel_to_matched /= predicted_inten_values[
-                frag_start:frag_end
-            ].sum()
-
-        return (
-            matched_frag_num,
-            matched_frag_ratio,
-            both_matched_pred_frag_num,
-            both_matched_pred_frag_to_matched,
-            both_matched_pred_frag_to_pred,
-            matched_not_pred_frag_num,
-            matched_not_pred_frag_ratio,
-            pred_not_matched_frag_num,
-            pred_not_matched_frag_ratio,
-            matched_frag_rel_to_pred,
-            pred_frag_rel_to_matched,
-        )
+    b_frag_types = [_t for _t in used_frag_types if _t.startswith("b")]
+    y_frag_types = [_t for _t in used_frag_types if _t.startswith("y")]
 
-    psm_df, ms2_metrics_df = calc_ms2_similarity(
+    # cos, sa, spc and pcc of all, b and y fragments in one pass
+    similarity_subsets = [
+        ("", used_frag_types, perc_settings["top_k_frags_to_calc_spc"])
+    ]
+    if len(b_frag_types) > 0:
+        similarity_subsets.append(("_bion", b_frag_types, 0))
+    if len(y_frag_types) > 0:
+        similarity_subsets.append(("_yion", y_frag_types, 0))
+    similarity_metrics = ["COS", "SA", "SPC", "PCC"]
+    psm_df[
+        [
+            metric.lower() + suffix
+            for suffix, _, _ in similarity_subsets
+            for metric in similarity_metrics
+        ]
+    ] = calc_ms2_similarity_multi(
         psm_df,
         predict_intensity_df,
         matched_intensity_df,
-        charged_frag_types=used_frag_types,
-        metrics=["COS", "SA", "SPC", "PCC"],
-        spc_top_k=perc_settings["top_k_frags_to_calc_spc"],
-    )
-    psm_df.rename(
-        columns={
-            "COS": "cos",
-            "SA": "sa",
-            "SPC": "spc",
-            "PCC": "pcc",
-        },
-        inplace=True,
+        [_types for _, _types, _ in similarity_subsets],
+        similarity_metrics,
+        spc_top_k=[top_k for _, _, top_k in similarity_subsets],
     )
 
-    psm_df = get_psm_scores(
-        psm_df,
-        predict_intensity_df=predict_intensity_df[used_frag_types],
-        matched_intensity_df=matched_intensity_df[used_frag_types],
-        matched_mass_err_df=matched_mass_err_df[used_frag_types],
-    )
-    psm_df.rename(
-        columns={
-            "merr_weighted_score": "merr_weighted_frag_score",
-            "pred_weighted_score": "pred_weighted_frag_score",
-        },
-        inplace=True,
-    )
-
-    has_matched_intens = matched_intensity_df[used_frag_types].values > 0
-    has_predicted_intens = predict_intensity_df[used_frag_types].values > 0.001
-    has_both_matched_predicted = has_matched_intens & has_predicted_intens
-
-    (
-        psm_df["matched_frag_num"],
-        psm_df["matched_frag_ratio"],
-        psm_df["both_matched_pred_frag_num"],
-        psm_df["both_matched_pred_frag_to_matched"],
-        psm_df["both_matched_pred_frag_to_pred"],
-        psm_df["matched_not_pred_frag_num"],
-        psm_df["matched_not_pred_frag_ratio"],
-        psm_df["pred_not_matched_frag_num"],
-        psm_df["pred_not_matched_frag_ratio"],
-        psm_df["matched_frag_rel_to_pred"],
-        psm_df["pred_frag_rel_to_matched"],
-    ) = zip(
-        *psm_df[["frag_start_idx", "frag_stop_idx"]].apply(
-            _get_frag_features,
-            axis=1,
-            matched_inten_values=matched_intensity_df[used_frag_types].values,
-            predicted_inten_values=predict_intensity_df[used_frag_types].values,
-            has_matched_intens=has_matched_intens,
-            has_predicted_intens=has_predicted_intens,
-            has_both_matched_predicted=has_both_matched_predicted,
-        )
-    )
-
-    b_frag_types = [_t for _t in used_frag_types if _t.startswith("b")]
-    if len(b_frag_types) > 0:
-        psm_df, ms2_metrics_df = calc_ms2_similarity(
-            psm_df,
-            predict_intensity_df,
-            matched_intensity_df,
-            charged_frag_types=b_frag_types,
-            metrics=["COS", "SA", "SPC", "PCC"],
-        )
-        psm_df.rename(
-            columns={
-                "COS": "cos_bion",
-                "SA": "sa_bion",
-                "SPC": "spc_bion",
-                "PCC": "pcc_bion",
-            },
-            inplace=True,
-        )
+    for name, score_frag_types in [
+        ("frag", used_frag_types),
+        ("bion", b_frag_types),
+        ("yion", y_frag_types),
+    ]:
+        if len(score_frag_types) == 0:
+            continue
         psm_df = get_psm_scores(
             psm_df,
-            predict_intensity_df=predict_intensity_df[b_frag_types],
-            matched_intensity_df=matched_intensity_df[b_frag_types],
-            matched_mass_err_df=matched_mass_err_df[b_frag_types],
+            predict_intensity_df=predict_intensity_df,
+            matched_intensity_df=matched_intensity_df,
+            matched_mass_err_df=matched_mass_err_df,
+            charged_frag_types=score_frag_types,
         )
         psm_df.rename(
             columns={
-                "merr_weighted_score": "merr_weighted_bion_score",
-                "pred_weighted_score": "pred_weighted_bion_score",
+                "merr_weighted_score": f"merr_weighted_{name}_score",
+                "pred_weighted_score": f"pred_weighted_{name}_score",
             },
             inplace=True,
         )
 
-        has_matched_intens = matched_intensity_df[b_frag_types].values > 0
-        has_predicted_intens = predict_intensity_df[b_frag_types].values > 0
-        has_both_matched_predicted = has_matched_intens & has_predicted_intens
-
-        (
-            psm_df["matched_bion_num"],
-            psm_df["matched_bion_ratio"],
-            psm_df["both_matched_pred_bion_num"],
-            psm_df["both_matched_pred_bion_to_matched"],
-            psm_df["both_matched_pred_bion_to_pred"],
-            psm_df["matched_not_pred_bion_num"],
-            psm_df["matched_not_pred_bion_ratio"],
-            psm_df["pred_not_matched_bion_num"],
-            psm_df["pred_not_matched_bion_ratio"],
-            psm_df["matched_bion_rel_to_pred"],
-            psm_df["pred_bion_rel_to_matched"],
-        ) = zip(
-            *psm_df[["frag_start_idx", "frag_stop_idx"]].apply(
-                _get_frag_features,
-                axis=1,
-                matched_inten_values=matched_intensity_df[b_frag_types].values,
-                predicted_inten_values=predict_intensity_df[b_frag_types].values,
-                has_matched_intens=has_matched_intens,
-                has_predicted_intens=has_predicted_intens,
-                has_both_matched_predicted=has_both_matched_predicted,
-            )
-        )
-    else:
-        psm_df[
-            [
-                "matched_bion_num",
-                "matched_bion_ratio",
-                "both_matched_pred_bion_num",
-                "both_matched_pred_bion_to_matched",
-                "both_matched_pred_bion_to_pred",
-                "matched_not_pred_bion_num",
-                "matched_not_pred_bion_ratio",
-                "pred_not_matched_bion_num",
-                "pred_not_matched_bion_ratio",
-                "matched_bion_rel_to_pred",
-                "pred_bion_rel_to_matched",
-            ]
-        ] = 0
-
-    y_frag_types = [_t for _t in used_frag_types if _t.startswith("y")]
-    if len(y_frag_types) > 0:
-        psm_df, ms2_metrics_df = calc_ms2_similarity(
-            psm_df,
-            predict_intensity_df,
-            matched_intensity_df,
-            charged_frag_types=y_frag_types,
-            metrics=["COS", "SA", "SPC", "PCC"],
-        )
-        psm_df.rename(
-            columns={
-                "COS": "cos_yion",
-                "SA": "sa_yion",
-                "SPC": "spc_yion",
-                "PCC": "pcc_yion",
-            },
-            inplace=True,
-        )
-        psm_df = get_psm_scores(
-            psm_df,
-            predict_intensity_df=predict_intensity_df[b_frag_types],
-            matched_intensity_df=matched_intensity_df[b_frag_types],
-            matched_mass_err_df=matched_mass_err_df[b_frag_types],
-        )
-        psm_df.rename(
-            columns={
-                "merr_weighted_score": "merr_weighted_yion_score",
-                "pred_weighted_score": "pred_weighted_yion_score",
-            },
-            inplace=True,
-        )
-
-        has_matched_intens = matched_intensity_df[y_frag_types].values > 0
-        has_predicted_intens = predict_intensity_df[y_frag_types].values > 0
-        has_both_matched_predicted = has_matched_intens & has_predicted_intens
-
-        (
-            psm_df["matched_yion_num"],
-            psm_df["matched_yion_ratio"],
-            psm_df["both_matched_pred_yion_num"],
-            psm_df["both_matched_pred_yion_to_matched"],
-            psm_df["both_matched_pred_yion_to_pred"],
-            psm_df["matched_not_pred_yion_num"],
-            psm_df["matched_not_pred_yion_ratio"],
-            psm_df["pred_not_matched_yion_num"],
-            psm_df["pred_not_matched_yion_ratio"],
-            psm_df["matched_yion_rel_to_pred"],
-            psm_df["pred_yion_rel_to_matched"],
-        ) = zip(
-            *psm_df[["frag_start_idx", "frag_stop_idx"]].apply(
-                _get_frag_features,
-                axis=1,
-                matched_inten_values=matched_intensity_df[y_frag_types].values,
-                predicted_inten_values=predict_intensity_df[y_frag_types].values,
-                has_matched_intens=has_matched_intens,
-                has_predicted_intens=has_predicted_intens,
-                has_both_matched_predicted=has_both_matched_predicted,
-            )
-        )
-    else:
-        psm_df[
-            [
-                "matched_yion_num",
-                "matched_yion_ratio",
-                "both_matched_pred_yion_num",
-                "both_matched_pred_yion_to_matched",
-                "both_matched_pred_yion_to_pred",
-                "matched_not_pred_yion_num",
-                "matched_not_pred_yion_ratio",
-                "pred_not_matched_yion_num",
-                "pred_not_matched_yion_ratio",
-                "matched_yion_rel_to_pred",
-                "pred_yion_rel_to_matched",
-            ]
-        ] = 0
-
-    def _charge_one_hot(ch):
-        x = [0] * 7
-        if ch > 6:
-            x[-1] = 1
-        else:
-            x[ch - 1] = 1
-        return tuple(x)
+    # all fragments count as predicted above 0.001, b/y ions above 0
+    subsets = [
+        ("frag", used_frag_types, 0.001),
+        ("bion", b_frag_types, 0.0),
+        ("yion", y_frag_types, 0.0),
+    ]
+    frag_features = _get_frag_features(
+        psm_df.frag_start_idx.values.astype(np.int64),
+        psm_df.frag_stop_idx.values.astype(np.int64),
+        matched_intensity_df[used_frag_types].values,
+        predict_intensity_df.values,
+        np.array(
+            [used_frag_types.index(_t) for _, _types, _ in subsets for _t in _types],
+            dtype=np.int64,
+        ),
+        np.cumsum([0] + [len(_types) for _, _types, _ in subsets]).astype(np.int64),
+        np.array([_thres for _, _, _thres in subsets], dtype=np.float64),
+    )
+    psm_df[
+        [
+            _template.format(name)
+            for name, _, _ in subsets
+            for _template in _frag_feature_templates
+        ]
+    ] = frag_features
 
-    (
-        psm_df["pep_z1"],
-        psm_df["pep_z2"],
-        psm_df["pep_z3"],
-        psm_df["pep_z4"],
-        psm_df["pep_z5"],
-        psm_df["pep_z6"],
-        psm_df["pep_z_gt_6"],
-    ) = zip(*psm_df.charge.astype(np.int8).apply(_charge_one_hot))
+    # charge 1-6 to pep_z1-pep_z6, otherwise pep_z_gt_6
+    charge_idxes = psm_df.charge.values.astype(np.int8).astype(np.int64) - 1
+    charge_idxes[(charge_idxes < 0) | (charge_idxes > 5)] = 6
+    psm_df[
+        ["pep_z1", "pep_z2", "pep_z3", "pep_z4", "pep_z5", "pep_z6", "pep_z_gt_6"]
+    ] = np.eye(7, dtype=np.int64)[charge_idxes]
 
     def _mod_count(mods):
         if not mods:
@@ -466,7 +405,7 @@ def get_ms2_features(
                 mod_count += 1
         return mod_count
 
-    psm_df["mod_num"] = psm_df.mods.apply(_mod_count)
+    psm_df["mod_num"] = [_mod_count(mods) for mods in psm_df.mods.values]
 
     return psm_df
 
@@ -662,6 +601,8 @@ class ScoreFeatureExtractor:
                 self.calibrate_frag_mass_error,
             )
             psm_df_list.append(df)
+            if isinstance(inten_df, SparseMatchedFragments):
+                inten_df = inten_df.to_intensity_df()
             matched_intensity_df_list.append(inten_df)
 
         logging.info("Fine-tuning ...")
@@ -779,7 +720,12 @@ class ScoreFeatureExtractor:
         ms2_ppm=True,
         ms2_tol=20,
     ):
-        self.match = PepSpecMatch(charged_frag_types=frag_types_to_match)
+        self.match = PepSpecMatch(
+            charged_frag_types=frag_types_to_match,
+            matched_format=global_settings["peak_matching"]["matched_format"],
+            profile_intensity=global_settings["peak_matching"]["profile_intensity"],
+            block_spectrum_num=global_settings["peak_matching"]["block_spectrum_num"],
+        )
 
         self.match.match_ms2_centroid(
             refine_precursor_df(psm_df),
@@ -787,6 +733,9 @@ class ScoreFeatureExtractor:
             ms2_file_type=ms2_file_type,
             ppm=ms2_ppm,
             tol=ms2_tol,
+            thread_num=global_settings["thread_num"],
+            prefetch_file_num=global_settings["peak_matching"]["prefetch_file_num"],
+            max_loaded_file_num=global_settings["peak_matching"]["max_loaded_file_num"],
         )
 
     def _get_model_frag_types(self, frag_types):
@@ -961,6 +910,8 @@ class ScoreFeatureExtractorMP(ScoreFeatureExtractor):
                 df_groupby_raw.ngroups,
             ):
                 psm_df_list.append(df)
+                if isinstance(inten_df, SparseMatchedFragments):
+                    inten_df = inten_df.to_intensity_df()
                 matched_intensity_df_list.append(inten_df)
 
         logging.info("Fine-tuning ...")
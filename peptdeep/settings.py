@@ -91,6 +91,10 @@ def _refine_global_settings():
     global_settings["library"]["output_folder"] = global_settings["library"][
         "output_folder"
     ].format(PEPTDEEP_HOME=global_settings["PEPTDEEP_HOME"])
+    incremental_settings = global_settings["library"]["incremental"]
+    incremental_settings["previous_output_folder"] = incremental_settings[
+        "previous_output_folder"
+    ].format(PEPTDEEP_HOME=global_settings["PEPTDEEP_HOME"])
     global_settings["model_mgr"]["transfer"]["model_output_folder"] = global_settings[
         "model_mgr"
     ]["transfer"]["model_output_folder"].format(
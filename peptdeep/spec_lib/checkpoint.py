@@ -0,0 +1,172 @@
+import os
+import time
+import shutil
+
+from alphabase.yaml_utils import save_yaml, load_yaml
+
+checkpoint_folder_name = "checkpoint"
+manifest_file_name = "manifest.yaml"
+
+
+def get_checkpoint_folder(output_folder: str) -> str:
+    return os.path.join(output_folder, checkpoint_folder_name)
+
+
+def load_checkpoint_manifest(output_folder: str) -> dict:
+    """Load the checkpoint manifest of a library run in `output_folder`.
+
+    Parameters
+    ----------
+    output_folder : str
+        Output folder of the library run.
+
+    Returns
+    -------
+    dict
+        The manifest dict, or an empty dict if there is no (readable) manifest.
+    """
+    manifest_file = os.path.join(
+        get_checkpoint_folder(output_folder), manifest_file_name
+    )
+    if not os.path.isfile(manifest_file):
+        return {}
+    try:
+        return load_yaml(manifest_file) or {}
+    except Exception:
+        # the manifest may be being replaced by the running job
+        return {}
+
+
+def remove_checkpoint(output_folder: str):
+    """Remove the checkpoint folder after the library is successfully saved"""
+    checkpoint_folder = get_checkpoint_folder(output_folder)
+    if os.path.isdir(checkpoint_folder):
+        shutil.rmtree(checkpoint_folder)
+
+
+class LibraryCheckpoint:
+    """
+    Batch-level checkpoint of library prediction. Each predicted precursor
+    batch is saved as an hdf file in `checkpoint_folder`, and the manifest
+    file (`manifest.yaml`) records completed batches, progress and throughput.
+    A rerun with the same `run_hash` skips the completed batches.
+
+    Parameters
+    ----------
+    checkpoint_folder : str
+        Folder to save the batch files and the manifest.
+
+    run_hash : str
+        Identifies the precursors, settings and models of the run.
+        The existing checkpoint will be discarded if the hash changes.
+
+    precursor_num : int
+        Total number of precursors to predict.
+
+    batch_size : int
+        Number of precursors in each batch.
+
+    unit : str, optional
+        What the batches are made of, by default "precursors".
+        If the batches are made of other items, e.g. "proteins"
+        for protein chunks, `precursor_num`, `batch_size` and the
+        progress in the manifest count these items instead.
+    """
+
+    def __init__(
+        self,
+        checkpoint_folder: str,
+        run_hash: str,
+        precursor_num: int,
+        batch_size: int,
+        unit: str = "precursors",
+    ):
+        self.checkpoint_folder = checkpoint_folder
+        self.manifest_file = os.path.join(checkpoint_folder, manifest_file_name)
+
+        manifest = {}
+        if os.path.isfile(self.manifest_file):
+            manifest = load_yaml(self.manifest_file) or {}
+        if (
+            manifest.get("run_hash") != run_hash
+            or manifest.get("batch_size") != batch_size
+            or manifest.get("precursor_num") != precursor_num
+            or manifest.get("unit", "precursors") != unit
+        ):
+            if os.path.isdir(checkpoint_folder):
+                shutil.rmtree(checkpoint_folder)
+            manifest = {
+                "run_hash": run_hash,
+                "batch_size": batch_size,
+                "precursor_num": precursor_num,
+                "unit": unit,
+                "batch_num": (precursor_num + batch_size - 1) // batch_size,
+                "completed_batches": {},
+                "completed_precursor_num": 0,
+                "elapsed_seconds": 0.0,
+                "precursors_per_second": 0.0,
+                "eta_seconds": -1.0,
+            }
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        self.manifest = manifest
+        self._save_manifest()
+
+    @property
+    def batch_num(self) -> int:
+        return self.manifest["batch_num"]
+
+    @property
+    def completed_batch_num(self) -> int:
+        return len(self.manifest["completed_batches"])
+
+    def get_batch_file(self, batch_id: int) -> str:
+        return os.path.join(self.checkpoint_folder, f"batch_{batch_id}.speclib.hdf")
+
+    def is_batch_completed(self, batch_id: int) -> bool:
+        return batch_id in self.manifest["completed_batches"] and os.path.isfile(
+            self.get_batch_file(batch_id)
+        )
+
+    def complete_batch(self, batch_id: int, precursor_num: int, seconds: float):
+        """Record a finished batch whose file has been saved.
+
+        Parameters
+        ----------
+        batch_id : int
+            Batch index.
+
+        precursor_num : int
+            Number of input precursors (or `unit` items) of the batch.
+
+        seconds : float
+            Time used to predict and save the batch.
+        """
+        manifest = self.manifest
+        manifest["completed_batches"][batch_id] = {
+            "file": os.path.basename(self.get_batch_file(batch_id)),
+            "precursor_num": int(precursor_num),
+            "seconds": float(seconds),
+        }
+        manifest["completed_precursor_num"] = int(
+            sum(
+                batch["precursor_num"]
+                for batch in manifest["completed_batches"].values()
+            )
+        )
+        manifest["elapsed_seconds"] = float(
+            sum(batch["seconds"] for batch in manifest["completed_batches"].values())
+        )
+        if manifest["elapsed_seconds"] > 0:
+            manifest["precursors_per_second"] = (
+                manifest["completed_precursor_num"] / manifest["elapsed_seconds"]
+            )
+            manifest["eta_seconds"] = (
+                manifest["precursor_num"] - manifest["completed_precursor_num"]
+            ) / manifest["precursors_per_second"]
+        self._save_manifest()
+
+    def _save_manifest(self):
+        self.manifest["update_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        tmp_file = self.manifest_file + ".tmp"
+        save_yaml(tmp_file, self.manifest)
+        os.replace(tmp_file, self.manifest_file)
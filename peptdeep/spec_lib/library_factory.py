@@ -1,14 +1,29 @@
 import os
+import json
+import time
+import shutil
+import hashlib
 import psutil
+import tempfile
+import torch.multiprocessing as mp
 
 import pandas as pd
 import numpy as np
 from typing import Union, Tuple
 
-from alphabase.peptide.fragment import get_charged_frag_types
+from alphabase.peptide.fragment import (
+    get_charged_frag_types,
+    remove_unused_fragments,
+    concat_precursor_fragment_dataframes,
+)
+from alphabase.peptide.precursor import hash_precursor_df
+from alphabase.protein.fasta import load_all_proteins
 from alphabase.psm_reader import psm_reader_provider
+from alphabase.spectral_library.base import SpecLibBase
+from alphabase.io.hdf import HDF_File
+from alphabase.yaml_utils import load_yaml
 
-from peptdeep.settings import global_settings
+from peptdeep.settings import global_settings, update_global_settings
 from peptdeep.protein.fasta import PredictSpecLibFasta
 from peptdeep.spec_lib.translate import (
     speclib_to_single_df,
@@ -16,8 +31,82 @@ from peptdeep.spec_lib.translate import (
     translate_to_tsv,
 )
 
+from peptdeep.spec_lib.checkpoint import LibraryCheckpoint
 from peptdeep.pretrained_models import ModelManager
-from peptdeep.utils import logging, read_peptide_table
+from peptdeep.utils import logging, read_peptide_table, process_bar
+
+
+previous_library_file = "predict.speclib.hdf"
+previous_settings_file = "peptdeep_settings.yaml"
+previous_model_hash_file = "model_hash.txt"
+
+# Settings that do not change the predicted values of a precursor.
+_incremental_ignored_library_settings = [
+    "infile_type",
+    "infiles",
+    "output_folder",
+    "output_tsv",
+    "output_window_shards",
+    "incremental",
+    "checkpoint",
+]
+
+
+def _get_incremental_relevant_settings(settings: dict) -> dict:
+    relevant = {
+        "model": settings.get("model", {}),
+        "common": settings.get("common", {}),
+        "library": {
+            key: val
+            for key, val in settings.get("library", {}).items()
+            if key not in _incremental_ignored_library_settings
+        },
+        "model_mgr": {
+            key: val
+            for key, val in settings.get("model_mgr", {}).items()
+            if key not in ["predict", "transfer"]
+        },
+    }
+    return relevant
+
+
+def check_previous_library(previous_folder: str, model_hash: str) -> str:
+    """Check if the library in `previous_folder` can be incrementally updated
+    with the current models and `global_settings`.
+
+    Parameters
+    ----------
+    previous_folder : str
+        Output folder of a previous library run, it must contain
+        "predict.speclib.hdf", "peptdeep_settings.yaml" and "model_hash.txt".
+
+    model_hash : str
+        Hash of the current models, see `ModelManager.get_model_hash()`.
+
+    Returns
+    -------
+    str
+        The reason why the previous library cannot be used,
+        or "" if it is compatible.
+    """
+    for file_name in [
+        previous_library_file,
+        previous_settings_file,
+        previous_model_hash_file,
+    ]:
+        if not os.path.isfile(os.path.join(previous_folder, file_name)):
+            return f"`{file_name}` does not exist in `{previous_folder}`"
+
+    with open(os.path.join(previous_folder, previous_model_hash_file)) as f:
+        if f.read().strip() != model_hash:
+            return "the models have been changed"
+
+    previous_settings = load_yaml(os.path.join(previous_folder, previous_settings_file))
+    if _get_incremental_relevant_settings(
+        previous_settings
+    ) != _get_incremental_relevant_settings(global_settings):
+        return "the library-relevant settings have been changed"
+    return ""
 
 
 class PredictLibraryMakerBase(object):
@@ -64,6 +153,11 @@ class PredictLibraryMakerBase(object):
             generate_precursor_isotope=lib_settings["generate_precursor_isotope"],
             rt_to_irt=lib_settings["rt_to_irt"],
         )
+        self.checkpoint_folder: str = None
+        """
+        If not None, predict in batches of `library:checkpoint:batch_size` and
+        save/resume the batches in this folder, see :class:`LibraryCheckpoint`.
+        """
 
     def _check_df(self) -> str:
         pass
@@ -72,8 +166,108 @@ class PredictLibraryMakerBase(object):
         """Virtual method to be re-implemented by sub-classes"""
         raise NotImplementedError("All sub-classes must re-implement '_input()' method")
 
+    def _input_incrementally(
+        self, infiles, previous_hashes: np.ndarray
+    ) -> pd.DataFrame:
+        """Input `infiles` and keep only the precursors whose `mod_seq_charge_hash`
+        values are not in `previous_hashes` in `self.spec_lib` to predict.
+
+        Returns
+        -------
+        pd.DataFrame
+            The (unpredicted) precursors which are in `previous_hashes`.
+        """
+        self._input(infiles)
+        self._check_df()
+        df = self.spec_lib.precursor_df
+        hash_precursor_df(df)
+        in_previous = df.mod_seq_charge_hash.isin(previous_hashes).values
+        self.spec_lib._precursor_df = df[~in_previous].reset_index(drop=True)
+        return df[in_previous]
+
     def _predict(self):
-        self.spec_lib.predict_all()
+        if self.checkpoint_folder:
+            self._predict_with_checkpoint()
+        else:
+            self.spec_lib.predict_all()
+
+    def _get_run_hash(self, *key_arrays: np.ndarray) -> str:
+        """Hash of the input, settings and models of the run.
+        The input is identified by `key_arrays`,
+        by default the `mod_seq_charge_hash` of all precursors.
+        """
+        if not key_arrays:
+            key_arrays = (self.spec_lib.precursor_df.mod_seq_charge_hash.values,)
+        md5 = hashlib.md5()
+        for values in key_arrays:
+            md5.update(np.ascontiguousarray(values).tobytes())
+        md5.update(
+            json.dumps(
+                _get_incremental_relevant_settings(global_settings),
+                sort_keys=True,
+                default=str,
+            ).encode()
+        )
+        md5.update(self.spec_lib.model_manager.get_model_hash().encode())
+        return md5.hexdigest()
+
+    def _predict_with_checkpoint(self):
+        """Predict in batches, the completed batches of a previous (killed) run
+        with the same precursors, settings and models will not be predicted again.
+        """
+        batch_size = global_settings["library"]["checkpoint"]["batch_size"]
+        df = self.spec_lib.precursor_df
+        hash_precursor_df(df)
+        checkpoint = LibraryCheckpoint(
+            self.checkpoint_folder,
+            self._get_run_hash(),
+            len(df),
+            batch_size,
+        )
+        if checkpoint.completed_batch_num > 0:
+            logging.info(
+                f"Resuming from checkpoint `{self.checkpoint_folder}`, "
+                f"{checkpoint.completed_batch_num} of {checkpoint.batch_num} "
+                "batches have been completed."
+            )
+
+        for batch_id, start in enumerate(range(0, len(df), batch_size)):
+            if checkpoint.is_batch_completed(batch_id):
+                continue
+            start_time = time.time()
+            batch_df = df.iloc[start : start + batch_size].reset_index(drop=True)
+            self.spec_lib._precursor_df = batch_df
+            self.spec_lib.predict_all()
+            # protein_df is not needed in the batch files
+            SpecLibBase.save_hdf(self.spec_lib, checkpoint.get_batch_file(batch_id))
+            checkpoint.complete_batch(batch_id, len(batch_df), time.time() - start_time)
+            logging.info(
+                f"Checkpoint batch {batch_id+1}/{checkpoint.batch_num} saved, "
+                f"{checkpoint.manifest['precursors_per_second']:.1f} precursors/s, "
+                f"ETA {checkpoint.manifest['eta_seconds']/60:.1f} min"
+            )
+
+        precursor_df_list = []
+        fragment_mz_df_list = []
+        fragment_intensity_df_list = []
+        for batch_id in range(checkpoint.batch_num):
+            batch_lib = SpecLibBase(self.spec_lib.charged_frag_types)
+            batch_lib.load_hdf(checkpoint.get_batch_file(batch_id))
+            precursor_df_list.append(batch_lib.precursor_df)
+            fragment_mz_df_list.append(batch_lib.fragment_mz_df)
+            fragment_intensity_df_list.append(batch_lib.fragment_intensity_df)
+        precursor_df, fragment_mz_df, fragment_intensity_df = (
+            concat_precursor_fragment_dataframes(
+                precursor_df_list,
+                fragment_mz_df_list,
+                fragment_intensity_df_list,
+            )
+        )
+        self.spec_lib.set_precursor_and_fragment(
+            precursor_df=precursor_df,
+            fragment_mz_df=fragment_mz_df,
+            fragment_intensity_df=fragment_intensity_df,
+        )
 
     @property
     def precursor_df(self) -> pd.DataFrame:
@@ -121,6 +315,111 @@ class PredictLibraryMakerBase(object):
         except ValueError as e:
             raise e
 
+    def make_library_incrementally(
+        self,
+        infiles: Union[str, list, pd.DataFrame],
+        previous_folder: str,
+    ) -> bool:
+        """Update the library of a previous run in `previous_folder` for `infiles`.
+        Only the precursors which are not in the previous library will be predicted,
+        and precursors which are not in `infiles` any more will be removed.
+
+        If the models or the library-relevant settings
+        have been changed (see :func:`check_previous_library`),
+        it falls back to `self.make_library(infiles)` to rebuild the full library.
+
+        Parameters
+        ----------
+        infiles : Union[str, list, pd.DataFrame]
+            Input files or source, see :meth:`make_library`.
+
+        previous_folder : str
+            Output folder of the previous run.
+
+        Returns
+        -------
+        bool
+            If the library was updated incrementally.
+        """
+        reason = check_previous_library(
+            previous_folder, self.spec_lib.model_manager.get_model_hash()
+        )
+        if reason:
+            logging.warning(
+                f"Cannot update the previous library incrementally: {reason}. "
+                "Rebuilding the full library ..."
+            )
+            self.make_library(infiles)
+            return False
+
+        logging.info(
+            f"Updating the spectral library in `{previous_folder}` incrementally ..."
+        )
+        previous_lib = SpecLibBase(self.spec_lib.charged_frag_types)
+        previous_lib.load_hdf(os.path.join(previous_folder, previous_library_file))
+        previous_df = previous_lib.precursor_df
+        if "mod_seq_charge_hash" not in previous_df.columns:
+            hash_precursor_df(previous_df)
+        previous_df = previous_df.drop_duplicates("mod_seq_charge_hash")
+
+        shared_df = self._input_incrementally(
+            infiles, previous_df.mod_seq_charge_hash.values
+        )
+        new_num = len(self.spec_lib.precursor_df)
+
+        if len(shared_df) == 0:
+            logging.info("No precursors are shared with the previous library.")
+            self._predict()
+            return True
+
+        # Annotations (proteins, decoy, ...) come from the new input,
+        # predicted values and fragments come from the previous library.
+        kept_df = shared_df.merge(
+            previous_df[
+                ["mod_seq_charge_hash"]
+                + [col for col in previous_df.columns if col not in shared_df.columns]
+            ],
+            on="mod_seq_charge_hash",
+            how="left",
+        )
+        kept_df, (kept_mz_df, kept_intensity_df) = remove_unused_fragments(
+            kept_df,
+            (
+                previous_lib.fragment_mz_df[self.spec_lib.charged_frag_types],
+                previous_lib.fragment_intensity_df[self.spec_lib.charged_frag_types],
+            ),
+        )
+        logging.info(
+            f"{len(kept_df)} precursors are kept, "
+            f"{len(previous_df)-len(kept_df)} precursors are removed, "
+            f"{new_num} new precursors will be predicted."
+        )
+
+        if new_num == 0:
+            self.spec_lib.set_precursor_and_fragment(
+                precursor_df=kept_df,
+                fragment_mz_df=kept_mz_df,
+                fragment_intensity_df=kept_intensity_df,
+            )
+        else:
+            self._predict()
+            precursor_df, fragment_mz_df, fragment_intensity_df = (
+                concat_precursor_fragment_dataframes(
+                    [kept_df, self.precursor_df],
+                    [kept_mz_df, self.fragment_mz_df],
+                    [kept_intensity_df, self.fragment_intensity_df],
+                )
+            )
+            self.spec_lib.set_precursor_and_fragment(
+                precursor_df=precursor_df,
+                fragment_mz_df=fragment_mz_df,
+                fragment_intensity_df=fragment_intensity_df,
+            )
+        logging.info(
+            f"Updated the spectral library with {len(self.precursor_df)} precursors"
+        )
+        return True
+
     def translate_to_tsv(self, tsv_path: str, translate_mod_dict: dict = None):
         """Translate the predicted DataFrames into a TSV file"""
         logging.info(f"Translating to {tsv_path} for DiaNN/Spectronaut...")
@@ -277,10 +576,345 @@ class SequenceLibraryMaker(PeptideLibraryMaker):
         self.spec_lib.add_charge()
 
 
+def _merge_protein_idxes(protein_idxes_list: list) -> str:
+    idxes = set()
+    for protein_idxes in protein_idxes_list:
+        idxes.update(protein_idxes.split(";"))
+    return ";".join(sorted(idxes, key=int))
+
+
+# Folds the decoy flag into `mod_seq_charge_hash` (golden ratio constant),
+# so targets and decoys with the same hash have different keys.
+_decoy_hash_multiplier = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _get_decoy_values(precursor_df: pd.DataFrame) -> np.ndarray:
+    if "decoy" in precursor_df.columns:
+        return precursor_df.decoy.values.astype(np.int8)
+    return np.zeros(len(precursor_df), dtype=np.int8)
+
+
+class PredictedChunkWriter:
+    """
+    Streams predicted chunks of `FastaLibraryMaker` to hdf files
+    in a spool folder as they arrive, only a sorted uint64 array of
+    `mod_seq_charge_hash` (with the `decoy` flag folded in) and the unique
+    (`decoy`, `sequence`, `protein_idxes`) of each chunk are kept in memory.
+    Precursors which have been written by previous chunks are removed
+    from the new chunks by the hash array.
+    :meth:`finish` reads the written chunks back one by one into
+    preallocated fragment arrays, and as for the whole proteome,
+    it removes the decoys whose sequences are targets of other chunks
+    and merges the `protein_idxes` of a peptide sequence in all chunks.
+
+    Chunks of incremental updates also contain the precursors
+    which are in the previous library (`previous_precursor_df`, not predicted),
+    they are deduplicated in the same way and returned by :meth:`finish_previous`.
+
+    Parameters
+    ----------
+    spool_folder : str, optional
+        The spool folder is created in this folder.
+        Defaults to None (the system temporary folder).
+    """
+
+    def __init__(self, spool_folder: str = None):
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._sequence_protein_df_list = []
+        self._sequence_protein_df: pd.DataFrame = None
+        self._merged_protein_idxes: pd.Series = None
+        self._target_sequences: pd.Index = None
+        self._spool_folder = tempfile.mkdtemp(prefix="chunks_", dir=spool_folder)
+        self._chunk_files = []
+        self._fragment_num = 0
+        self._previous_precursor_df_list = []
+
+    def _dedup(self, precursor_df: pd.DataFrame) -> np.ndarray:
+        decoys = _get_decoy_values(precursor_df)
+        self._sequence_protein_df_list.append(
+            pd.DataFrame(
+                {
+                    "decoy": decoys,
+                    "sequence": precursor_df.sequence.values,
+                    "protein_idxes": precursor_df.protein_idxes.values,
+                }
+            ).drop_duplicates()
+        )
+
+        keys = precursor_df.mod_seq_charge_hash.values.astype(
+            np.uint64
+        ) + decoys.astype(np.uint64) * _decoy_hash_multiplier
+        # the first occurrences in the chunk which are not in previous chunks
+        unique_keys, first_idxes = np.unique(keys, return_index=True)
+        insert_idxes = np.searchsorted(self._hashes, unique_keys)
+        in_previous = insert_idxes < len(self._hashes)
+        in_previous[in_previous] = (
+            self._hashes[insert_idxes[in_previous]] == unique_keys[in_previous]
+        )
+        self._hashes = np.insert(
+            self._hashes, insert_idxes[~in_previous], unique_keys[~in_previous]
+        )
+        keep = np.zeros(len(precursor_df), dtype=bool)
+        keep[first_idxes[~in_previous]] = True
+        return keep
+
+    def append(self, ret_dict: dict):
+        if len(ret_dict.get("previous_precursor_df", [])) > 0:
+            # precursors without fragments, they are small enough to keep
+            previous_df = ret_dict["previous_precursor_df"]
+            self._previous_precursor_df_list.append(
+                previous_df[self._dedup(previous_df)]
+            )
+
+        precursor_df = ret_dict["precursor_df"]
+        if len(precursor_df) == 0:
+            return
+        fragment_mz_df = ret_dict["fragment_mz_df"]
+        fragment_intensity_df = ret_dict["fragment_intensity_df"]
+
+        keep = self._dedup(precursor_df)
+        if not keep.any():
+            return
+        if not keep.all():
+            precursor_df, (fragment_mz_df, fragment_intensity_df) = (
+                remove_unused_fragments(
+                    precursor_df[keep].reset_index(drop=True),
+                    (fragment_mz_df, fragment_intensity_df),
+                )
+            )
+        chunk_file = os.path.join(
+            self._spool_folder, f"chunk_{len(self._chunk_files)}.hdf"
+        )
+        _save_chunk(
+            {
+                "precursor_df": precursor_df,
+                "fragment_mz_df": fragment_mz_df,
+                "fragment_intensity_df": fragment_intensity_df,
+            },
+            chunk_file,
+        )
+        self._chunk_files.append(chunk_file)
+        self._fragment_num += len(fragment_mz_df)
+
+    def _build_sequence_proteins(self):
+        """Concatenate the (`decoy`, `sequence`, `protein_idxes`) of all chunks
+        and merge the `protein_idxes` of sequences shared by chunks, once all
+        chunks are appended."""
+        if self._sequence_protein_df is not None:
+            return
+        if len(self._sequence_protein_df_list) == 0:
+            self._sequence_protein_df = pd.DataFrame(
+                columns=["decoy", "sequence", "protein_idxes"]
+            )
+        else:
+            self._sequence_protein_df = pd.concat(
+                self._sequence_protein_df_list, ignore_index=True
+            ).drop_duplicates()
+        self._sequence_protein_df_list = []
+        df = self._sequence_protein_df
+        shared_df = df[df.duplicated(["decoy", "sequence"], keep=False)]
+        self._merged_protein_idxes = shared_df.groupby(
+            ["decoy", "sequence"]
+        ).protein_idxes.agg(_merge_protein_idxes)
+        # the hash table of the index is built once for all chunks
+        self._target_sequences = pd.Index(
+            df.sequence.values[df.decoy.values == 0]
+        ).unique()
+
+    def _get_decoys_of_targets(self, precursor_df: pd.DataFrame) -> np.ndarray:
+        self._build_sequence_proteins()
+        return (_get_decoy_values(precursor_df) != 0) & (
+            self._target_sequences.get_indexer(precursor_df.sequence.values) >= 0
+        )
+
+    def _merge_shared_protein_idxes(self, precursor_df: pd.DataFrame):
+        self._build_sequence_proteins()
+        if len(self._merged_protein_idxes) == 0:
+            return
+        merged_idxes = self._merged_protein_idxes.reindex(
+            pd.MultiIndex.from_arrays(
+                [_get_decoy_values(precursor_df), precursor_df.sequence.values]
+            )
+        ).values
+        precursor_df["protein_idxes"] = np.where(
+            pd.isna(merged_idxes), precursor_df.protein_idxes.values, merged_idxes
+        )
+
+    def finish(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """Read the written chunks back, the chunk files are removed once read.
+
+        Returns
+        -------
+        Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]
+            precursor_df, fragment_mz_df, fragment_intensity_df
+        """
+        precursor_df_list = []
+        fragment_mz = fragment_intensity = None
+        fragment_num = 0
+        for chunk_file in self._chunk_files:
+            ret_dict = _load_chunk(chunk_file)
+            os.remove(chunk_file)
+            precursor_df = ret_dict["precursor_df"]
+            fragment_mz_df = ret_dict["fragment_mz_df"]
+            fragment_intensity_df = ret_dict["fragment_intensity_df"]
+            decoys_of_targets = self._get_decoys_of_targets(precursor_df)
+            if decoys_of_targets.all():
+                continue
+            if decoys_of_targets.any():
+                precursor_df, (fragment_mz_df, fragment_intensity_df) = (
+                    remove_unused_fragments(
+                        precursor_df[~decoys_of_targets].reset_index(drop=True),
+                        (fragment_mz_df, fragment_intensity_df),
+                    )
+                )
+            if fragment_mz is None:
+                # the size before removing decoys of targets is the upper bound
+                frag_columns = fragment_mz_df.columns
+                fragment_mz = np.empty(
+                    (self._fragment_num, len(frag_columns)),
+                    dtype=fragment_mz_df.values.dtype,
+                )
+                fragment_intensity = np.empty(
+                    (self._fragment_num, len(frag_columns)),
+                    dtype=fragment_intensity_df.values.dtype,
+                )
+            stop = fragment_num + len(fragment_mz_df)
+            fragment_mz[fragment_num:stop] = fragment_mz_df[frag_columns].values
+            fragment_intensity[fragment_num:stop] = fragment_intensity_df[
+                frag_columns
+            ].values
+            precursor_df["frag_start_idx"] += fragment_num
+            precursor_df["frag_stop_idx"] += fragment_num
+            fragment_num = stop
+            precursor_df_list.append(precursor_df)
+        self._chunk_files = []
+        shutil.rmtree(self._spool_folder, ignore_errors=True)
+
+        if len(precursor_df_list) == 0:
+            return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+        precursor_df = pd.concat(precursor_df_list, ignore_index=True)
+        self._merge_shared_protein_idxes(precursor_df)
+        return (
+            precursor_df,
+            pd.DataFrame(fragment_mz[:fragment_num], columns=frag_columns),
+            pd.DataFrame(fragment_intensity[:fragment_num], columns=frag_columns),
+        )
+
+    def finish_previous(self) -> pd.DataFrame:
+        """
+        Returns
+        -------
+        pd.DataFrame
+            The deduplicated `previous_precursor_df` of all chunks.
+        """
+        if len(self._previous_precursor_df_list) == 0:
+            return pd.DataFrame()
+        precursor_df = pd.concat(self._previous_precursor_df_list, ignore_index=True)
+        self._previous_precursor_df_list = []
+        precursor_df = precursor_df[
+            ~self._get_decoys_of_targets(precursor_df)
+        ].reset_index(drop=True)
+        self._merge_shared_protein_idxes(precursor_df)
+        return precursor_df
+
+
+def _save_chunk(ret_dict: dict, hdf_file: str):
+    """Save the non-empty dataframes of a chunk result into an hdf file,
+    e.g. a checkpoint batch file"""
+    _hdf = HDF_File(hdf_file, read_only=False, truncate=True, delete_existing=True)
+    _hdf.chunk = {key: df for key, df in ret_dict.items() if len(df) > 0}
+
+
+def _load_chunk(hdf_file: str) -> dict:
+    _hdf = HDF_File(hdf_file)
+    ret_dict = {"precursor_df": pd.DataFrame()}
+    if "chunk" in _hdf.group_names:
+        for key in _hdf.chunk.dataframe_names:
+            ret_dict[key] = getattr(_hdf.chunk, key).values
+    return ret_dict
+
+
+# Set for each worker process by `_init_chunk_worker`
+_chunk_model_manager: ModelManager = None
+_chunk_previous_hashes: np.ndarray = None
+
+
+def _init_chunk_worker(
+    model_manager: ModelManager,
+    mp_global_settings: dict = None,
+    previous_hashes: np.ndarray = None,
+):
+    """Internal function, set the models (and previous hashes) once for each worker"""
+    global _chunk_model_manager, _chunk_previous_hashes
+    if mp_global_settings is not None:
+        update_global_settings(dict(mp_global_settings))
+        # no nested multiprocessing in the worker processes
+        global_settings["model_mgr"]["predict"]["multiprocessing"] = False
+    _chunk_model_manager = model_manager
+    _chunk_previous_hashes = previous_hashes
+
+
+def _digest_and_predict_protein_chunk(arg_dict: dict) -> dict:
+    """Internal function, digest and predict a protein chunk, for multiprocessing.
+    Precursors in `_chunk_previous_hashes` are returned as `previous_precursor_df`
+    without prediction.
+    """
+    lib_maker = FastaLibraryMaker(_chunk_model_manager)
+    spec_lib = lib_maker.spec_lib
+    spec_lib.get_peptides_from_protein_dict(arg_dict["protein_dict"])
+    if len(spec_lib.precursor_df) == 0:
+        return {"precursor_df": spec_lib.precursor_df}
+
+    protein_offset = arg_dict["protein_offset"]
+    if protein_offset > 0:
+        spec_lib.precursor_df["protein_idxes"] = [
+            ";".join(str(int(idx) + protein_offset) for idx in protein_idxes.split(";"))
+            for protein_idxes in spec_lib.precursor_df.protein_idxes.values
+        ]
+    spec_lib.append_decoy_sequence()
+    spec_lib.add_modifications()
+    spec_lib.add_special_modifications()
+    spec_lib.add_peptide_labeling()
+    spec_lib.add_charge()
+    hash_precursor_df(spec_lib.precursor_df)
+
+    ret_dict = {}
+    if _chunk_previous_hashes is not None:
+        df = spec_lib.precursor_df
+        in_previous = df.mod_seq_charge_hash.isin(_chunk_previous_hashes).values
+        ret_dict["previous_precursor_df"] = df[in_previous].reset_index(drop=True)
+        spec_lib._precursor_df = df[~in_previous].reset_index(drop=True)
+    if len(spec_lib.precursor_df) == 0:
+        ret_dict["precursor_df"] = spec_lib.precursor_df
+        return ret_dict
+
+    spec_lib.predict_all()
+    ret_dict["precursor_df"] = spec_lib.precursor_df
+    ret_dict["fragment_mz_df"] = spec_lib.fragment_mz_df
+    ret_dict["fragment_intensity_df"] = spec_lib.fragment_intensity_df
+    return ret_dict
+
+
 class FastaLibraryMaker(PredictLibraryMakerBase):
-    """For fasta or a list of fasta files"""
+    """For fasta or a list of fasta files.
+
+    If `global_settings['library']['fasta']['protein_chunk_size']` > 0,
+    proteins will be split into chunks, and each chunk is digested,
+    modified, charged and predicted in a worker process
+    (sequentially on GPUs) by :meth:`_digest_and_predict_in_chunks`.
+    With `checkpoint_folder`, each chunk is a checkpoint batch;
+    for incremental updates, only the precursors which are not
+    in the previous library are predicted in the chunks.
+    """
+
+    _predicted_in_chunks = False
 
     def _input(self, fasta: Union[str, list]):
+        protein_chunk_size = global_settings["library"]["fasta"]["protein_chunk_size"]
+        if protein_chunk_size > 0:
+            self._digest_and_predict_in_chunks(fasta, protein_chunk_size)
+            return
+        self._predicted_in_chunks = False
         self.spec_lib.get_peptides_from_fasta(fasta)
         self.spec_lib.append_decoy_sequence()
         self.spec_lib.add_modifications()
@@ -288,6 +922,168 @@ class FastaLibraryMaker(PredictLibraryMakerBase):
         self.spec_lib.add_peptide_labeling()
         self.spec_lib.add_charge()
 
+    def _input_incrementally(
+        self, fasta: Union[str, list], previous_hashes: np.ndarray
+    ) -> pd.DataFrame:
+        protein_chunk_size = global_settings["library"]["fasta"]["protein_chunk_size"]
+        if protein_chunk_size > 0:
+            return self._digest_and_predict_in_chunks(
+                fasta, protein_chunk_size, previous_hashes
+            )
+        return super()._input_incrementally(fasta, previous_hashes)
+
+    def _predict(self):
+        if not self._predicted_in_chunks:
+            super()._predict()
+
+    def _digest_and_predict_in_chunks(
+        self,
+        fasta: Union[str, list],
+        protein_chunk_size: int,
+        previous_hashes: np.ndarray = None,
+    ) -> pd.DataFrame:
+        """Digest and predict proteins in chunks into `self.spec_lib`.
+
+        Returns
+        -------
+        pd.DataFrame
+            The (unpredicted) precursors which are in `previous_hashes`,
+            empty if `previous_hashes` is None.
+        """
+        fasta_list = [fasta] if isinstance(fasta, str) else list(fasta)
+        if global_settings["library"]["fasta"]["add_contaminants"]:
+            from alphabase.constants._const import CONST_FILE_FOLDER
+
+            contaminants_fasta = os.path.join(CONST_FILE_FOLDER, "contaminants.fasta")
+            if os.path.isfile(contaminants_fasta):
+                fasta_list.append(contaminants_fasta)
+            else:
+                logging.warning(f"`{contaminants_fasta}` does not exist, skipped.")
+        protein_dict = load_all_proteins(fasta_list)
+        self.spec_lib.protein_df = pd.DataFrame.from_dict(
+            protein_dict, orient="index"
+        ).reset_index(drop=True)
+
+        protein_keys = list(protein_dict.keys())
+        chunk_starts = range(0, len(protein_keys), protein_chunk_size)
+
+        checkpoint = None
+        if self.checkpoint_folder:
+            key_arrays = [
+                pd.util.hash_pandas_object(
+                    self.spec_lib.protein_df[["protein_id", "sequence"]], index=False
+                ).values
+            ]
+            if previous_hashes is not None:
+                key_arrays.append(np.sort(previous_hashes))
+            checkpoint = LibraryCheckpoint(
+                self.checkpoint_folder,
+                self._get_run_hash(*key_arrays),
+                len(protein_keys),
+                protein_chunk_size,
+                unit="proteins",
+            )
+            if checkpoint.completed_batch_num > 0:
+                logging.info(
+                    f"Resuming from checkpoint `{self.checkpoint_folder}`, "
+                    f"{checkpoint.completed_batch_num} of {checkpoint.batch_num} "
+                    "protein chunks have been completed."
+                )
+
+        writer = PredictedChunkWriter(self.checkpoint_folder)
+        chunk_ids = []
+        for chunk_id in range(len(chunk_starts)):
+            if checkpoint is not None and checkpoint.is_batch_completed(chunk_id):
+                writer.append(_load_chunk(checkpoint.get_batch_file(chunk_id)))
+            else:
+                chunk_ids.append(chunk_id)
+
+        model_manager = self.spec_lib.model_manager
+        process_num = global_settings["thread_num"]
+        logging.info(
+            f"Digesting and predicting {len(protein_keys)} proteins "
+            f"in {len(chunk_ids)} chunks ..."
+        )
+
+        def chunk_generator():
+            for chunk_id in chunk_ids:
+                start = chunk_starts[chunk_id]
+                yield {
+                    "protein_dict": {
+                        key: protein_dict[key]
+                        for key in protein_keys[start : start + protein_chunk_size]
+                    },
+                    "protein_offset": start,
+                }
+
+        def collect(chunk_id: int, ret_dict: dict, start_time: float):
+            if checkpoint is not None:
+                _save_chunk(ret_dict, checkpoint.get_batch_file(chunk_id))
+                checkpoint.complete_batch(
+                    chunk_id,
+                    min(protein_chunk_size, len(protein_keys) - chunk_starts[chunk_id]),
+                    time.time() - start_time,
+                )
+            writer.append(ret_dict)
+
+        verbose_bak = model_manager.verbose
+        model_manager.verbose = False
+        if (
+            model_manager.ms2_model.device_type != "cpu"
+            or process_num <= 1
+            or len(chunk_ids) <= 1
+        ):
+            _init_chunk_worker(model_manager, previous_hashes=previous_hashes)
+            for chunk_id, arg_dict in process_bar(
+                zip(chunk_ids, chunk_generator()), len(chunk_ids)
+            ):
+                start_time = time.time()
+                collect(
+                    chunk_id, _digest_and_predict_protein_chunk(arg_dict), start_time
+                )
+            _init_chunk_worker(None)
+        else:
+            for model in [
+                model_manager.ms2_model,
+                model_manager.rt_model,
+                model_manager.ccs_model,
+                model_manager.charge_model,
+            ]:
+                if model is not None:
+                    model.model.share_memory()
+            with mp.Manager() as mgr:
+                mp_global_settings = mgr.dict()
+                mp_global_settings.update(global_settings)
+                with mp.get_context("spawn").Pool(
+                    process_num,
+                    initializer=_init_chunk_worker,
+                    initargs=(model_manager, mp_global_settings, previous_hashes),
+                ) as p:
+                    # imap keeps the chunk order, so the kept duplicates
+                    # do not depend on the scheduling of the workers
+                    start_time = time.time()
+                    for chunk_id, ret_dict in process_bar(
+                        zip(
+                            chunk_ids,
+                            p.imap(
+                                _digest_and_predict_protein_chunk, chunk_generator()
+                            ),
+                        ),
+                        len(chunk_ids),
+                    ):
+                        collect(chunk_id, ret_dict, start_time)
+                        start_time = time.time()
+        model_manager.verbose = verbose_bak
+
+        precursor_df, fragment_mz_df, fragment_intensity_df = writer.finish()
+        self.spec_lib.set_precursor_and_fragment(
+            precursor_df=precursor_df,
+            fragment_mz_df=fragment_mz_df,
+            fragment_intensity_df=fragment_intensity_df,
+        )
+        self._predicted_in_chunks = True
+        return writer.finish_previous()
+
 
 class LibraryMakerProvider:
     """
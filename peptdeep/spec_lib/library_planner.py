@@ -0,0 +1,318 @@
+import os
+import time
+import psutil
+import torch
+
+import pandas as pd
+import numpy as np
+
+from alphabase.protein.fasta import load_all_proteins
+
+from peptdeep.settings import global_settings
+from peptdeep.pretrained_models import ModelManager
+from peptdeep.spec_lib.library_factory import (
+    library_maker_provider,
+    FastaLibraryMaker,
+)
+from peptdeep.utils import (
+    logging,
+    estimate_precursor_bytes,
+    precursor_row_bytes,
+)
+
+# Approximate bytes of one fragment row in the tsv library.
+tsv_fragment_row_bytes = 150
+# Approximate memory of a prediction process without data
+# (python, torch runtime and the models).
+process_base_bytes = 1.5 * 1024**3
+
+
+def _get_model_bytes(model_mgr: ModelManager) -> int:
+    model_bytes = 0
+    for model in [
+        model_mgr.ms2_model,
+        model_mgr.rt_model,
+        model_mgr.ccs_model,
+        model_mgr.charge_model,
+    ]:
+        if model is None:
+            continue
+        model_bytes += sum(
+            param.numel() * param.element_size() for param in model.model.parameters()
+        )
+    return model_bytes
+
+
+def _sample_precursors_from_fasta(
+    lib_maker: FastaLibraryMaker,
+    fasta_files: list,
+    sample_protein_num: int,
+    seed: int,
+) -> float:
+    """Digest, modify and charge sampled proteins in `lib_maker.spec_lib`.
+
+    Returns
+    -------
+    float
+        The scale factor from the sampled to all proteins (by residue number).
+    """
+    protein_dict = load_all_proteins(fasta_files)
+    protein_keys = list(protein_dict.keys())
+    if len(protein_keys) > sample_protein_num:
+        rng = np.random.default_rng(seed)
+        sampled_keys = rng.choice(len(protein_keys), sample_protein_num, replace=False)
+        sampled_keys = [protein_keys[i] for i in np.sort(sampled_keys)]
+    else:
+        sampled_keys = protein_keys
+    total_residues = sum(len(prot["sequence"]) for prot in protein_dict.values())
+    sampled_residues = sum(len(protein_dict[key]["sequence"]) for key in sampled_keys)
+    logging.info(
+        f"Sampled {len(sampled_keys)} of {len(protein_keys)} proteins "
+        f"({sampled_residues} of {total_residues} residues) for planning ..."
+    )
+
+    spec_lib = lib_maker.spec_lib
+    spec_lib.get_peptides_from_protein_dict(
+        {key: protein_dict[key] for key in sampled_keys}
+    )
+    spec_lib.append_decoy_sequence()
+    spec_lib.add_modifications()
+    spec_lib.add_special_modifications()
+    spec_lib.add_peptide_labeling()
+    spec_lib.add_charge()
+    return total_residues / max(sampled_residues, 1)
+
+
+def _benchmark_prediction(
+    lib_maker, precursor_df: pd.DataFrame, benchmark_precursor_num: int
+) -> float:
+    """Predict a few precursors in a single process,
+    returns the throughput (precursors per second)."""
+    if len(precursor_df) == 0:
+        return 0.0
+    if len(precursor_df) > benchmark_precursor_num:
+        precursor_df = precursor_df.sample(benchmark_precursor_num, random_state=1337)
+    spec_lib = lib_maker.spec_lib
+    multiprocessing_bak = global_settings["model_mgr"]["predict"]["multiprocessing"]
+    global_settings["model_mgr"]["predict"]["multiprocessing"] = False
+    try:
+        # warm up the models
+        spec_lib._precursor_df = precursor_df.iloc[:10].reset_index(drop=True)
+        spec_lib.predict_all()
+        spec_lib._precursor_df = precursor_df.reset_index(drop=True)
+        start_time = time.time()
+        spec_lib.predict_all()
+        seconds = time.time() - start_time
+    finally:
+        global_settings["model_mgr"]["predict"]["multiprocessing"] = multiprocessing_bak
+    return len(precursor_df) / max(seconds, 1e-6)
+
+
+def plan_library(
+    sample_protein_num: int = 500,
+    benchmark_precursor_num: int = 2000,
+    seed: int = 1337,
+    min_required_precursor_num_for_mp: int = 2000,
+) -> dict:
+    """Dry-run of `peptdeep.pipeline_api.generate_library()` based on
+    `global_settings`. For fasta files, it digests, modifies and charges
+    `sample_protein_num` sampled proteins and scales the result by residue
+    number (peptides shared by proteins are counted for each sample, so the
+    estimation is slightly larger than the real number); other input tables
+    are fully loaded. It then predicts `benchmark_precursor_num` precursors
+    to measure the throughput of the configured models and device.
+
+    Parameters
+    ----------
+    sample_protein_num : int, optional
+        Number of proteins to sample from the fasta files, by default 500.
+
+    benchmark_precursor_num : int, optional
+        Number of precursors for the throughput benchmark, by default 2000.
+
+    seed : int, optional
+        Random seed to sample proteins, by default 1337.
+
+    min_required_precursor_num_for_mp : int, optional
+        Multiprocessing is only used for at least this number of precursors,
+        the same as in :meth:`peptdeep.spec_lib.predict_lib.PredictSpecLib.predict_all`,
+        by default 2000.
+
+    Returns
+    -------
+    dict
+        The estimated numbers and recommended settings,
+        see :func:`format_library_plan`.
+    """
+    lib_settings = global_settings["library"]
+    predict_settings = global_settings["model_mgr"]["predict"]
+
+    model_mgr = ModelManager()
+    model_mgr.reset_by_global_settings()
+    model_mgr.verbose = False
+
+    infile_type = lib_settings["infile_type"].lower()
+    lib_maker = library_maker_provider.get_maker(infile_type, model_manager=model_mgr)
+    if isinstance(lib_maker, FastaLibraryMaker):
+        fasta_files = lib_settings["infiles"]
+        if isinstance(fasta_files, str):
+            fasta_files = [fasta_files]
+        scale = _sample_precursors_from_fasta(
+            lib_maker, fasta_files, sample_protein_num, seed
+        )
+    else:
+        if infile_type in library_maker_provider.library_maker_dict:
+            lib_maker._input(lib_settings["infiles"])
+        else:
+            lib_maker._input((infile_type, lib_settings["infiles"]))
+        lib_maker._check_df()
+        scale = 1.0
+
+    precursor_df = lib_maker.spec_lib.precursor_df
+    charged_frag_type_num = len(lib_maker.spec_lib.charged_frag_types)
+    sampled_precursor_num = len(precursor_df)
+    precursor_num = int(sampled_precursor_num * scale)
+    if sampled_precursor_num > 0:
+        mean_nAA = float(precursor_df.nAA.mean())
+        bytes_per_precursor = float(
+            estimate_precursor_bytes(
+                precursor_df.nAA.values, charged_frag_type_num
+            ).mean()
+        )
+    else:
+        mean_nAA = 0.0
+        bytes_per_precursor = float(precursor_row_bytes)
+    library_bytes = precursor_num * bytes_per_precursor
+    fragment_num = int(precursor_num * max(mean_nAA - 1, 0) * charged_frag_type_num)
+
+    precursors_per_second = _benchmark_prediction(
+        lib_maker, precursor_df, benchmark_precursor_num
+    )
+
+    device_type = model_mgr.ms2_model.device_type
+    thread_num = global_settings["thread_num"]
+    cpu_num = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    available_bytes = psutil.virtual_memory().available
+    model_bytes = _get_model_bytes(model_mgr)
+    # the same conditions as `ModelManager.predict_all`
+    use_mp = (
+        device_type == "cpu"
+        and predict_settings["multiprocessing"]
+        and thread_num > 1
+        and precursor_num >= min_required_precursor_num_for_mp
+    )
+    process_num = thread_num if use_mp else 1
+
+    # The parent holds the precursors and the returned fragment batches,
+    # and concatenating them needs another copy of the fragments.
+    peak_bytes = 2 * library_bytes + process_base_bytes + model_bytes
+    mp_batch_size = lib_maker.spec_lib.mp_predict_batch_size
+    adaptive_settings = predict_settings["adaptive_batch_size"]
+    if adaptive_settings["enabled"]:
+        # the adaptive batch size could grow up to this
+        mp_batch_size *= adaptive_settings["max_scale"]
+    if use_mp:
+        peak_bytes += process_num * (
+            process_base_bytes
+            + model_bytes
+            + min(mp_batch_size, precursor_num) * bytes_per_precursor
+        )
+
+    # Recommend settings: the batches in flight use at most 1/4 of the memory
+    # that is left after the library itself.
+    free_bytes = max(available_bytes - 2 * library_bytes, available_bytes * 0.1)
+    recommended_thread_num = int(
+        max(
+            1,
+            min(
+                cpu_num,
+                global_settings["MAX_THREADS"],
+                free_bytes // (2 * (process_base_bytes + model_bytes)),
+            ),
+        )
+    )
+    recommended_mp_batch_size = int(
+        free_bytes / 4 / max(recommended_thread_num, 1) / bytes_per_precursor
+    )
+    recommended_mp_batch_size = int(
+        np.clip(recommended_mp_batch_size // 10000 * 10000, 10000, 1000000)
+    )
+    if device_type in ("gpu", "cuda") and torch.cuda.is_available():
+        gpu_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
+        recommended_batch_size_ms2 = int(np.clip(512 * (gpu_gb // 8), 512, 4096))
+    else:
+        recommended_batch_size_ms2 = predict_settings["batch_size_ms2"]
+
+    # The benchmark process already uses all threads in torch, so
+    # multiprocessing is not supposed to predict much faster.
+    wall_seconds = (
+        precursor_num / precursors_per_second
+        if precursors_per_second > 0
+        else float("nan")
+    )
+
+    disk_bytes = library_bytes
+    if lib_settings["output_tsv"]["enabled"]:
+        disk_bytes += (
+            precursor_num
+            * lib_settings["output_tsv"]["keep_higest_k_peaks"]
+            * tsv_fragment_row_bytes
+        )
+    if lib_settings["output_window_shards"]["enabled"]:
+        disk_bytes += library_bytes
+
+    return {
+        "infile_type": infile_type,
+        "sampled_precursor_num": sampled_precursor_num,
+        "scale": scale,
+        "precursor_num": precursor_num,
+        "mean_nAA": mean_nAA,
+        "charged_frag_type_num": charged_frag_type_num,
+        "fragment_num": fragment_num,
+        "bytes_per_precursor": bytes_per_precursor,
+        "device_type": device_type,
+        "process_num": process_num,
+        "precursors_per_second": precursors_per_second,
+        "peak_memory_gb": peak_bytes / 1024**3,
+        "available_memory_gb": available_bytes / 1024**3,
+        "disk_gb": disk_bytes / 1024**3,
+        "wall_time_minutes": wall_seconds / 60,
+        "recommended_settings": {
+            "mp_batch_size": recommended_mp_batch_size,
+            "batch_size_ms2": recommended_batch_size_ms2,
+            "thread_num": recommended_thread_num,
+        },
+    }
+
+
+def format_library_plan(plan: dict) -> str:
+    """Format the result of :func:`plan_library` as a readable report"""
+    lines = [
+        "Library plan (estimated)",
+        f"  input type:             {plan['infile_type']}",
+        f"  precursors:             {plan['precursor_num']:,}"
+        f" (sampled {plan['sampled_precursor_num']:,} x {plan['scale']:.2f})",
+        f"  mean peptide length:    {plan['mean_nAA']:.1f}",
+        f"  fragments:              {plan['fragment_num']:,}"
+        f" ({plan['charged_frag_type_num']} fragment types)",
+        f"  device:                 {plan['device_type']}"
+        f" ({plan['process_num']} processes)",
+        f"  throughput:             {plan['precursors_per_second']:.1f}"
+        " precursors/s",
+        f"  peak memory:            {plan['peak_memory_gb']:.2f} GB"
+        f" (available {plan['available_memory_gb']:.2f} GB)",
+        f"  disk output:            {plan['disk_gb']:.2f} GB",
+        f"  wall time:              {plan['wall_time_minutes']:.1f} min",
+        "Recommended settings",
+        "  mp_batch_size (PredictSpecLib.mp_predict_batch_size): "
+        f"{plan['recommended_settings']['mp_batch_size']}",
+        "  model_mgr:predict:batch_size_ms2: "
+        f"{plan['recommended_settings']['batch_size_ms2']}",
+        f"  thread_num: {plan['recommended_settings']['thread_num']}",
+    ]
+    if plan["peak_memory_gb"] > plan["available_memory_gb"]:
+        lines.append(
+            "WARNING: the estimated peak memory exceeds the available memory, "
+            "consider `library:checkpoint` or `library:fasta:protein_chunk_size`."
+        )
+    return "\n".join(lines)
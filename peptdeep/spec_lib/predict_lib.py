@@ -3,25 +3,173 @@ import numpy as np
 import torch
 import tqdm
 
+from collections import OrderedDict
+
 from alphabase.peptide.precursor import (
     calc_precursor_isotope_mp,
     calc_precursor_isotope,
+    get_mod_seq_formula,
+    update_precursor_mz,
 )
 from alphabase.spectral_library.base import SpecLibBase
 from alphabase.spectral_library.flat import SpecLibFlat
-from alphabase.peptide.fragment import (
-    flatten_fragments,
-    concat_precursor_fragment_dataframes,
-)
 
 from peptdeep.pretrained_models import ModelManager
 from peptdeep.settings import global_settings
 from peptdeep.utils import logging
 from peptdeep.utils import process_bar
+from peptdeep.utils import AdaptiveBatchSizer, estimate_precursor_bytes
+from peptdeep.utils import concat_precursor_flat_fragment_dataframes
 
 model_mgr_settings = global_settings["model_mgr"]
 
 
+class PrecursorIsotopeCache:
+    """
+    LRU cache of charge-independent isotope information of precursors,
+    keyed by the elemental composition of the modified sequences.
+    `*_mz` values are stored as mass offsets to the mono-isotopic mass,
+    i.e. `(mz - precursor_mz) * charge`, so one entry serves all charge states.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Max number of compositions in the cache, by default 2000000.
+    """
+
+    def __init__(self, max_size: int = 2000000):
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self, columns: list = [], dtypes: list = []):
+        """Clear the cache and set the isotope columns and their dtypes"""
+        self.columns = list(columns)
+        self.dtypes = list(dtypes)
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key: tuple) -> np.ndarray:
+        values = self._cache.get(key)
+        if values is not None:
+            self._cache.move_to_end(key)
+        return values
+
+    def put(self, key: tuple, values: np.ndarray):
+        self._cache[key] = values
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+
+precursor_isotope_cache = PrecursorIsotopeCache()
+"""Global isotope cache used by :func:`calc_precursor_isotope_by_composition`"""
+
+
+def _get_composition_key(sequence: str, mods: str) -> tuple:
+    return tuple(
+        sorted((elem, n) for elem, n in get_mod_seq_formula(sequence, mods) if n != 0)
+    )
+
+
+def calc_precursor_isotope_by_composition(
+    precursor_df: pd.DataFrame,
+    isotope_cache: PrecursorIsotopeCache = None,
+    min_required_precursor_num_for_mp: int = 2000,
+    progress_bar=None,
+) -> pd.DataFrame:
+    """Calculate precursor isotope information with the same columns as
+    `alphabase.peptide.precursor.calc_precursor_isotope`, but
+    the isotope distribution is calculated only once for each
+    elemental composition not in `isotope_cache`, and then broadcast
+    to all precursors (all charge states) with the same composition.
+
+    Parameters
+    ----------
+    precursor_df : pd.DataFrame
+        Precursor dataframe with `sequence`, `mods` and `charge` columns.
+
+    isotope_cache : PrecursorIsotopeCache, optional
+        If None, use the global `precursor_isotope_cache`. By default None.
+
+    min_required_precursor_num_for_mp : int, optional
+        Use `calc_precursor_isotope_mp` if the number of uncached
+        compositions is not smaller than this value. By default 2000.
+
+    progress_bar : optional
+        Progress bar for `calc_precursor_isotope_mp`, by default None.
+
+    Returns
+    -------
+    pd.DataFrame
+        `precursor_df` with isotope columns.
+    """
+    if isotope_cache is None:
+        isotope_cache = precursor_isotope_cache
+    if len(precursor_df) == 0:
+        return calc_precursor_isotope(precursor_df)
+    if "precursor_mz" not in precursor_df.columns:
+        update_precursor_mz(precursor_df)
+
+    pep_codes = precursor_df.groupby(["sequence", "mods"], sort=False).ngroup().values
+    _, pep_first_rows = np.unique(pep_codes, return_index=True)
+    key_to_comp = {}
+    pep_comps = np.array(
+        [
+            key_to_comp.setdefault(_get_composition_key(seq, mods), len(key_to_comp))
+            for seq, mods in precursor_df[["sequence", "mods"]].values[pep_first_rows]
+        ],
+        dtype=np.int64,
+    )
+    precursor_comps = pep_comps[pep_codes]
+    comp_keys = list(key_to_comp)
+
+    comp_values = [isotope_cache.get(key) for key in comp_keys]
+    missing = np.array([values is None for values in comp_values])
+    if missing.any():
+        _, comp_first_rows = np.unique(precursor_comps, return_index=True)
+        rep_df = precursor_df.iloc[comp_first_rows[missing]].reset_index(drop=True)
+        columns_before = set(rep_df.columns)
+        if len(rep_df) < min_required_precursor_num_for_mp:
+            rep_df = calc_precursor_isotope(rep_df)
+        else:
+            rep_df = calc_precursor_isotope_mp(rep_df, progress_bar=progress_bar)
+        isotope_columns = [col for col in rep_df.columns if col not in columns_before]
+        if isotope_columns != isotope_cache.columns:
+            if not missing.all():
+                # cached values were calculated with other columns
+                isotope_cache.clear()
+                return calc_precursor_isotope_by_composition(
+                    precursor_df,
+                    isotope_cache,
+                    min_required_precursor_num_for_mp,
+                    progress_bar,
+                )
+            isotope_cache.clear(
+                isotope_columns, [rep_df[col].dtype for col in isotope_columns]
+            )
+
+        rep_values = rep_df[isotope_columns].values.astype(np.float64)
+        mz_cols = np.array([col.endswith("_mz") for col in isotope_columns])
+        rep_values[:, mz_cols] = (
+            rep_values[:, mz_cols] - rep_df.precursor_mz.values[:, None]
+        ) * rep_df.charge.values[:, None]
+        for comp, values in zip(np.nonzero(missing)[0], rep_values):
+            comp_values[comp] = values
+            isotope_cache.put(comp_keys[comp], values)
+
+    values = np.stack(comp_values)[precursor_comps]
+    mz_cols = np.array([col.endswith("_mz") for col in isotope_cache.columns])
+    values[:, mz_cols] = (
+        precursor_df.precursor_mz.values[:, None]
+        + values[:, mz_cols] / precursor_df.charge.values[:, None]
+    )
+    for i, (col, dtype) in enumerate(zip(isotope_cache.columns, isotope_cache.dtypes)):
+        precursor_df[col] = values[:, i].astype(dtype)
+    return precursor_df
+
+
 class PredictSpecLib(SpecLibBase):
     def __init__(
         self,
@@ -72,7 +220,9 @@ class PredictSpecLib(SpecLibBase):
         self._fragment_mz_df = pd.DataFrame()
 
         self.mp_predict_batch_size: int = 100000
+        self._mp_batch_sizer: AdaptiveBatchSizer = None
         self.rt_to_irt = rt_to_irt
+        self.irt_calibration = None
         self.generate_precursor_isotope = generate_precursor_isotope
 
     def _drop_unused_frag_columns(self):
@@ -109,19 +259,53 @@ class PredictSpecLib(SpecLibBase):
             self._drop_unused_frag_columns()
 
     def translate_rt_to_irt_pred(self, irt_pep_df: pd.DataFrame = None):
-        """Add 'irt_pred' into columns based on 'rt_pred'"""
-        return self.model_manager.rt_model.add_irt_column_to_precursor_df(
-            self._precursor_df, irt_pep_df=irt_pep_df
+        """Add 'irt_pred' into columns based on 'rt_pred'.
+        The calibration used is kept as `self.irt_calibration`.
+        """
+        self.irt_calibration = self.model_manager.rt_model.get_irt_calibration(
+            irt_pep_df=irt_pep_df
+        )
+        return self.irt_calibration.apply(self._precursor_df)
+
+    def _get_mp_predict_batch_size(self) -> int:
+        """`self.mp_predict_batch_size`, or the adaptive one if
+        `model_mgr:predict:adaptive_batch_size:enabled`. Each worker process
+        holds a batch, so the per-precursor cost is multiplied by `thread_num`.
+        """
+        adaptive_settings = model_mgr_settings["predict"]["adaptive_batch_size"]
+        if not adaptive_settings["enabled"] or len(self._precursor_df) == 0:
+            return self.mp_predict_batch_size
+        if self._mp_batch_sizer is None:
+            self._mp_batch_sizer = AdaptiveBatchSizer(
+                self.mp_predict_batch_size,
+                max_batch_size=self.mp_predict_batch_size
+                * adaptive_settings["max_scale"],
+                memory_ceiling_gb=adaptive_settings["memory_ceiling_gb"],
+                name="mp_predict_batch_size",
+            )
+        bytes_per_precursor = estimate_precursor_bytes(
+            self._precursor_df.sequence.str.len().values, len(self.charged_frag_types)
+        ).mean()
+        return self._mp_batch_sizer.update(
+            bytes_per_precursor * global_settings["thread_num"]
         )
 
     def predict_all(
         self,
         min_required_precursor_num_for_mp: int = 2000,
         predict_items: list = ["rt", "mobility", "ms2"],
-    ):
+        flatten_kwargs: dict = None,
+    ) -> dict:
         """
         1. Predict RT/IM/MS2 for self._precursor_df
         2. Calculate isotope information in self._precursor_df
+
+        If `flatten_kwargs` is not None, the fragments are predicted into
+        the flat format without dense fragment dataframes
+        (in the workers for multiprocessing, see `ModelManager.predict_ms2_flat`),
+        and the flat precursor and fragment dataframes are returned
+        as `{'precursor_df': ..., 'fragment_df': ...}` instead of being
+        stored as dense fragment dataframes in this library.
         """
         if "precursor_mz" not in self.precursor_df.columns:
             self.calc_precursor_mz()
@@ -129,12 +313,11 @@ class PredictSpecLib(SpecLibBase):
         if self.generate_precursor_isotope:
             if self.model_manager.verbose:
                 logging.info("Calculating precursor isotope distributions ...")
-            if len(self.precursor_df) < min_required_precursor_num_for_mp:
-                self._precursor_df = calc_precursor_isotope(self._precursor_df)
-            else:
-                self._precursor_df = calc_precursor_isotope_mp(
-                    self._precursor_df, progress_bar=process_bar
-                )
+            self._precursor_df = calc_precursor_isotope_by_composition(
+                self._precursor_df,
+                min_required_precursor_num_for_mp=min_required_precursor_num_for_mp,
+                progress_bar=process_bar,
+            )
         if self.model_manager.verbose:
             logging.info(
                 f"Predicting RT/IM/MS2 for {len(self._precursor_df)} precursors ..."
@@ -145,14 +328,19 @@ class PredictSpecLib(SpecLibBase):
             frag_types=self.charged_frag_types,
             min_required_precursor_num_for_mp=min_required_precursor_num_for_mp,
             multiprocessing=model_mgr_settings["predict"]["multiprocessing"],
-            mp_batch_size=self.mp_predict_batch_size,
+            mp_batch_size=self._get_mp_predict_batch_size(),
             process_num=global_settings["thread_num"],
+            flatten_kwargs=flatten_kwargs,
         )
-        self.set_precursor_and_fragment(**res)
+        if "fragment_df" in res:
+            self._precursor_df = res["precursor_df"]
+        else:
+            self.set_precursor_and_fragment(**res)
         if self.rt_to_irt and "rt_pred" in self._precursor_df.columns:
             self.translate_rt_to_irt_pred()
         if self.model_manager.verbose:
             logging.info("End predicting RT/IM/MS2")
+        return res
 
 
 class PredictSpecLibFlat(SpecLibFlat):
@@ -197,7 +385,10 @@ class PredictSpecLibFlat(SpecLibFlat):
         predict_lib : PredictSpecLib
             spectral library to be predicted and flatten
         batch_size : int, optional
-            the batch size, by default 200000
+            the batch size, by default 200000. If
+            `model_mgr:predict:adaptive_batch_size:enabled`, it is the
+            initial batch size, and is adapted to the memory usage
+            for each batch.
         """
         logging.info(
             f"Flattening {len(predict_lib.precursor_df)} precursors in batch size {batch_size} ..."
@@ -211,22 +402,41 @@ class PredictSpecLibFlat(SpecLibFlat):
             df = predict_lib.precursor_df
             precursor_df_list = []
             fragment_df_list = []
-            for i in tqdm.tqdm(range(0, len(df), batch_size)):
-                predict_lib._precursor_df = df.iloc[i : i + batch_size].copy()
-                predict_lib.predict_all()
-                flat_df, frag_df = flatten_fragments(
-                    predict_lib.precursor_df,
-                    predict_lib.fragment_mz_df,
-                    predict_lib.fragment_intensity_df,
-                    min_fragment_intensity=self.min_fragment_intensity,
-                    keep_top_k_fragments=self.keep_top_k_fragments,
-                    custom_columns=self.custom_fragment_df_columns,
+            adaptive_settings = model_mgr_settings["predict"]["adaptive_batch_size"]
+            if adaptive_settings["enabled"]:
+                batch_sizer = AdaptiveBatchSizer(
+                    batch_size,
+                    max_batch_size=batch_size * adaptive_settings["max_scale"],
+                    memory_ceiling_gb=adaptive_settings["memory_ceiling_gb"],
+                    name="flat library batch_size",
+                )
+                frag_type_num = len(predict_lib.charged_frag_types)
+                batch_slices = batch_sizer.iter_slices(
+                    len(df),
+                    lambda start, stop: estimate_precursor_bytes(
+                        df.nAA.values[start:stop], frag_type_num
+                    ).mean(),
+                )
+            else:
+                batch_slices = (
+                    slice(i, i + batch_size) for i in range(0, len(df), batch_size)
+                )
+            for batch_slice in tqdm.tqdm(batch_slices):
+                predict_lib._precursor_df = df.iloc[batch_slice].copy()
+                # fragments are predicted into the flat format
+                # by ModelManager.predict_ms2_flat
+                res = predict_lib.predict_all(
+                    flatten_kwargs=dict(
+                        min_fragment_intensity=self.min_fragment_intensity,
+                        keep_top_k_fragments=self.keep_top_k_fragments,
+                        custom_columns=self.custom_fragment_df_columns,
+                    )
                 )
-                precursor_df_list.append(flat_df)
-                fragment_df_list.append(frag_df)
+                precursor_df_list.append(res["precursor_df"])
+                fragment_df_list.append(res["fragment_df"])
             predict_lib._precursor_df = df
             self._precursor_df, self._fragment_df = (
-                concat_precursor_fragment_dataframes(
+                concat_precursor_flat_fragment_dataframes(
                     precursor_df_list, fragment_df_list
                 )
             )
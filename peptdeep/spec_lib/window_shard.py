@@ -0,0 +1,152 @@
+import os
+import numpy as np
+import pandas as pd
+
+from typing import Union
+
+from alphabase.peptide.fragment import remove_unused_fragments, flatten_fragments
+from alphabase.spectral_library.base import SpecLibBase
+
+from peptdeep.utils import logging, read_peptide_table
+
+_lower_mz_columns = ["lower_mz", "lower", "start_mz", "start", "low"]
+_upper_mz_columns = ["upper_mz", "upper", "end_mz", "end", "stop", "high"]
+
+
+def load_isolation_windows(windows: Union[str, list, np.ndarray]) -> np.ndarray:
+    """Load DIA isolation windows.
+
+    Parameters
+    ----------
+    windows : Union[str, list, np.ndarray]
+        A list of (lower_mz, upper_mz) pairs, or a tsv/csv file
+        containing 'lower_mz' and 'upper_mz' columns
+        (e.g. the isolation windows exported from an MS run).
+        Also accepts the column names 'lower'/'upper', 'start'/'end', ...
+
+    Returns
+    -------
+    np.ndarray
+        float64 array with shape (window_num, 2), sorted by lower_mz.
+    """
+    if isinstance(windows, str):
+        df = read_peptide_table(windows)
+        columns = {col.lower(): col for col in df.columns}
+        lower_cols = [columns[col] for col in _lower_mz_columns if col in columns]
+        upper_cols = [columns[col] for col in _upper_mz_columns if col in columns]
+        if not lower_cols or not upper_cols:
+            raise KeyError(
+                f"Isolation window file `{windows}` must contain "
+                "`lower_mz` and `upper_mz` columns"
+            )
+        windows = df[[lower_cols[0], upper_cols[0]]].values
+    windows = np.array(windows, dtype=np.float64).reshape(-1, 2)
+    if np.any(windows[:, 0] >= windows[:, 1]):
+        raise ValueError("lower_mz must be smaller than upper_mz for all windows")
+    return windows[np.argsort(windows[:, 0], kind="stable")]
+
+
+def save_library_window_shards(
+    spec_lib: SpecLibBase,
+    windows: Union[str, list, np.ndarray],
+    output_folder: str,
+    file_format: str = "hdf",
+    min_fragment_intensity: float = 0.001,
+    keep_top_k_fragments: int = 1000,
+) -> pd.DataFrame:
+    """Save the library as one shard per DIA isolation window.
+    A precursor is saved into all windows that contain its `precursor_mz`,
+    so precursors in overlapping regions are duplicated into
+    each overlapping window.
+
+    Parameters
+    ----------
+    spec_lib : SpecLibBase
+        The predicted library with dense fragment dataframes.
+
+    windows : Union[str, list, np.ndarray]
+        See :func:`load_isolation_windows`.
+
+    output_folder : str
+        Folder to save the shards and the index file `window_index.tsv`.
+
+    file_format : str, optional
+        'hdf' or 'parquet', by default 'hdf'.
+        'hdf' saves each shard as a `SpecLibBase` hdf file;
+        'parquet' saves the flattened precursors and fragments
+        (see `alphabase.peptide.fragment.flatten_fragments`)
+        of each shard as two parquet files, which requires `pyarrow`.
+
+    min_fragment_intensity : float, optional
+        Only used for 'parquet', by default 0.001.
+
+    keep_top_k_fragments : int, optional
+        Only used for 'parquet', by default 1000.
+
+    Returns
+    -------
+    pd.DataFrame
+        The window index with columns: window_idx, lower_mz, upper_mz,
+        precursor_num, file (and fragment_file for 'parquet').
+    """
+    file_format = file_format.lower()
+    if file_format not in ["hdf", "parquet"]:
+        raise ValueError(f"Unknown shard file format `{file_format}`")
+
+    windows = load_isolation_windows(windows)
+    os.makedirs(output_folder, exist_ok=True)
+    precursor_df = spec_lib.precursor_df
+    if "precursor_mz" not in precursor_df.columns:
+        spec_lib.calc_precursor_mz()
+        precursor_df = spec_lib.precursor_df
+    precursor_mzs = precursor_df.precursor_mz.values
+
+    logging.info(
+        f"Saving {len(precursor_df)} precursors into {len(windows)} "
+        f"isolation window shards in `{output_folder}` ..."
+    )
+    index_list = []
+    for window_idx, (lower_mz, upper_mz) in enumerate(windows):
+        in_window = (precursor_mzs >= lower_mz) & (precursor_mzs <= upper_mz)
+        shard_name = f"window_{window_idx:04d}_{lower_mz:.2f}_{upper_mz:.2f}"
+        if in_window.any():
+            shard_df, (shard_mz_df, shard_intensity_df) = remove_unused_fragments(
+                precursor_df[in_window].copy(),
+                (spec_lib.fragment_mz_df, spec_lib.fragment_intensity_df),
+            )
+        else:
+            shard_df = precursor_df.iloc[:0].copy()
+            shard_mz_df = spec_lib.fragment_mz_df.iloc[:0].copy()
+            shard_intensity_df = spec_lib.fragment_intensity_df.iloc[:0].copy()
+        index = {
+            "window_idx": window_idx,
+            "lower_mz": lower_mz,
+            "upper_mz": upper_mz,
+            "precursor_num": len(shard_df),
+        }
+        if file_format == "hdf":
+            shard_lib = SpecLibBase(spec_lib.charged_frag_types)
+            shard_lib._precursor_df = shard_df
+            shard_lib._fragment_mz_df = shard_mz_df
+            shard_lib._fragment_intensity_df = shard_intensity_df
+            index["file"] = shard_name + ".speclib.hdf"
+            shard_lib.save_hdf(os.path.join(output_folder, index["file"]))
+        else:
+            flat_df, frag_df = flatten_fragments(
+                shard_df,
+                shard_mz_df,
+                shard_intensity_df,
+                min_fragment_intensity=min_fragment_intensity,
+                keep_top_k_fragments=keep_top_k_fragments,
+            )
+            index["file"] = shard_name + ".precursor.parquet"
+            index["fragment_file"] = shard_name + ".fragment.parquet"
+            flat_df.to_parquet(os.path.join(output_folder, index["file"]))
+            frag_df.to_parquet(os.path.join(output_folder, index["fragment_file"]))
+        index_list.append(index)
+
+    index_df = pd.DataFrame(index_list)
+    index_df.to_csv(
+        os.path.join(output_folder, "window_index.tsv"), sep="\t", index=False
+    )
+    return index_df
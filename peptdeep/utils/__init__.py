@@ -1,6 +1,7 @@
 from .logger import *
 from .regression import *
 from .device_utils import *
+from .adaptive_batch import *
 
 import os
 import tqdm
@@ -91,3 +92,39 @@ def explode_multiple_columns(df: pd.DataFrame, columns: list):
         for col in columns[1:]:
             ret_df[col] = _flatten(df[col].values)
         return ret_df
+
+
+def concat_precursor_flat_fragment_dataframes(
+    precursor_df_list: list, fragment_df_list: list
+):
+    """
+    Concatenate precursor_dfs and flat fragment_dfs (as in
+    `alphabase.spectral_library.flat.SpecLibFlat`),
+    `flat_frag_start_idx` and `flat_frag_stop_idx` of each precursor_df
+    are shifted by the number of fragments of all previous fragment_dfs.
+    `alphabase.peptide.fragment.concat_precursor_fragment_dataframes`
+    only shifts the dense `frag_start_idx` and `frag_stop_idx`.
+
+    Parameters
+    ----------
+    precursor_df_list : list
+        precursor dataframes to concatenate
+
+    fragment_df_list : list
+        flat fragment dataframes to concatenate
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        concatenated precursor_df, fragment_df
+    """
+    cum_frag_df_lens = np.cumsum([len(frag_df) for frag_df in fragment_df_list])
+    precursor_df_list = [df.copy() for df in precursor_df_list]
+    for i, precursor_df in enumerate(precursor_df_list[1:]):
+        precursor_df[["flat_frag_start_idx", "flat_frag_stop_idx"]] += cum_frag_df_lens[
+            i
+        ]
+    return (
+        pd.concat(precursor_df_list, ignore_index=True),
+        pd.concat(fragment_df_list, ignore_index=True),
+    )
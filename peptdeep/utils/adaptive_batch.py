@@ -0,0 +1,166 @@
+import os
+import psutil
+
+import numpy as np
+
+from peptdeep.utils.logger import logging
+
+# Approximate bytes of one precursor row (numeric columns, sequence/mods
+# strings and protein ids) in the precursor dataframe.
+precursor_row_bytes = 400
+# fragment_mz_df is float64, fragment_intensity_df is float32
+fragment_value_bytes = 8 + 4
+
+
+def estimate_precursor_bytes(nAA: np.ndarray, charged_frag_type_num: int) -> np.ndarray:
+    """Estimate the memory (bytes) of each precursor in a dense library,
+    including its rows in the precursor dataframe,
+    fragment_mz_df and fragment_intensity_df.
+
+    Parameters
+    ----------
+    nAA : np.ndarray
+        Peptide lengths.
+
+    charged_frag_type_num : int
+        Number of charged fragment types (columns of the fragment dataframes).
+
+    Returns
+    -------
+    np.ndarray
+        Estimated bytes of each precursor.
+    """
+    return (
+        precursor_row_bytes
+        + (np.asarray(nAA) - 1) * charged_frag_type_num * fragment_value_bytes
+    )
+
+
+def get_rss_bytes() -> int:
+    """RSS of the current process and all its child processes"""
+    process = psutil.Process(os.getpid())
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+class AdaptiveBatchSizer:
+    """
+    Grow or shrink a batch size during a run to keep the RSS of
+    the process (and its child processes) under a memory ceiling.
+
+    Call :meth:`update` before each batch to get the batch size to use.
+    If the per-item memory cost is known (e.g. from
+    :func:`estimate_precursor_bytes`), the batch size is set to use
+    half of the memory headroom, otherwise it is halved when the RSS is
+    above 90% of the ceiling and grown by 1.5x when it is below 50%.
+
+    Parameters
+    ----------
+    batch_size : int
+        The initial batch size.
+
+    min_batch_size : int, optional
+        By default None (`batch_size//16`).
+
+    max_batch_size : int, optional
+        By default None (`batch_size*8`).
+
+    memory_ceiling_gb : float, optional
+        RSS ceiling in GB, <=0 means 80% of the total memory. By default 0.
+
+    name : str, optional
+        Name of the batch size in the logs, by default "batch_size".
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        *,
+        min_batch_size: int = None,
+        max_batch_size: int = None,
+        memory_ceiling_gb: float = 0,
+        name: str = "batch_size",
+    ):
+        self.batch_size = int(batch_size)
+        self.min_batch_size = (
+            max(1, self.batch_size // 16) if min_batch_size is None else min_batch_size
+        )
+        self.max_batch_size = (
+            self.batch_size * 8 if max_batch_size is None else max_batch_size
+        )
+        if memory_ceiling_gb > 0:
+            self.memory_ceiling = memory_ceiling_gb * 1024**3
+        else:
+            self.memory_ceiling = 0.8 * psutil.virtual_memory().total
+        self.name = name
+
+    def update(self, bytes_per_item: float = 0) -> int:
+        """Update and return the batch size based on the current memory usage.
+
+        Parameters
+        ----------
+        bytes_per_item : float, optional
+            Estimated memory cost of each item in a batch, by default 0 (unknown).
+
+        Returns
+        -------
+        int
+            The batch size to use.
+        """
+        rss = get_rss_bytes()
+        headroom = min(
+            self.memory_ceiling - rss, 0.9 * psutil.virtual_memory().available
+        )
+        batch_size = self.batch_size
+        if bytes_per_item > 0:
+            target = int(max(headroom, 0) / 2 / bytes_per_item)
+            # grow at most 2x per step, shrink immediately
+            batch_size = min(target, batch_size * 2)
+        elif rss > 0.9 * self.memory_ceiling:
+            batch_size = batch_size // 2
+        elif rss < 0.5 * self.memory_ceiling:
+            batch_size = int(batch_size * 1.5)
+        batch_size = int(np.clip(batch_size, self.min_batch_size, self.max_batch_size))
+
+        if batch_size != self.batch_size:
+            logging.info(
+                f"Adaptive {self.name}: {self.batch_size} -> {batch_size} "
+                f"(RSS {rss/1024**3:.2f} GB, "
+                f"ceiling {self.memory_ceiling/1024**3:.2f} GB)"
+            )
+            self.batch_size = batch_size
+        return self.batch_size
+
+    def iter_slices(self, total: int, bytes_per_item_func=None):
+        """Generate batch slices over `total` items, the batch size is
+        updated before each batch.
+
+        Parameters
+        ----------
+        total : int
+            Number of items.
+
+        bytes_per_item_func : Callable[[int, int], float], optional
+            Function of (start, stop) returning the estimated bytes per item
+            of the next batch candidate, by default None.
+
+        Yields
+        ------
+        slice
+            The batch slice.
+        """
+        start = 0
+        while start < total:
+            bytes_per_item = 0
+            if bytes_per_item_func is not None:
+                bytes_per_item = bytes_per_item_func(
+                    start, min(start + self.batch_size, total)
+                )
+            stop = min(start + self.update(bytes_per_item), total)
+            yield slice(start, stop)
+            start = stop
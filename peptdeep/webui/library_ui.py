@@ -465,6 +465,13 @@ def show():
         )
     )
 
+    global_ui_settings["library"]["checkpoint"]["enabled"] = bool(
+        st.checkbox(
+            label="Save checkpoints to resume the prediction if the task is killed",
+            value=global_ui_settings["library"]["checkpoint"]["enabled"],
+        )
+    )
+
     tsv_enabled = bool(
         st.checkbox(
             label="Output TSV (for DiaNN/Spectronaut)",
@@ -4,8 +4,44 @@ import psutil
 
 from alphabase.yaml_utils import load_yaml
 
-from peptdeep.webui.server import get_yamls, queue_folder
+from peptdeep.webui.server import get_yamls, queue_folder, home_folder
 from peptdeep.webui.ui_utils import files_in_pandas
+from peptdeep.spec_lib.checkpoint import load_checkpoint_manifest
+
+
+def display_running_progress():
+    running_txt = f"{home_folder}/tasks/running.txt"
+    if not os.path.isfile(running_txt):
+        return
+    with open(running_txt) as f:
+        yaml_file = f.read().strip()
+    if not yaml_file or not os.path.isfile(yaml_file):
+        return
+    _dict = load_yaml(yaml_file)
+    if "library" not in _dict or "output_folder" not in _dict["library"]:
+        return
+    output_folder = os.path.expanduser(
+        _dict["library"]["output_folder"].format(PEPTDEEP_HOME=home_folder)
+    )
+    manifest = load_checkpoint_manifest(output_folder)
+    if not manifest or manifest["precursor_num"] == 0:
+        return
+
+    st.write("### Progress of the running task")
+    st.progress(
+        min(manifest["completed_precursor_num"] / manifest["precursor_num"], 1.0)
+    )
+    if manifest["eta_seconds"] < 0:
+        eta = "unknown"
+    else:
+        eta = f"{manifest['eta_seconds']/60:.1f} min"
+    unit = manifest.get("unit", "precursors")
+    st.write(
+        f"{manifest['completed_precursor_num']}/{manifest['precursor_num']} {unit} "
+        f"({len(manifest['completed_batches'])}/{manifest['batch_num']} batches), "
+        f"{manifest['precursors_per_second']:.1f} {unit}/s, ETA: {eta} "
+        f"(updated at {manifest['update_time']})"
+    )
 
 
 def display_tasks():
@@ -60,6 +96,8 @@ def show():
 
     display_tasks()
 
+    display_running_progress()
+
     st.write("### Hardware utilization")
 
     c1, c2 = st.columns(2)
@@ -199,6 +199,7 @@ def show():
         "thermo_raw": ".raw",
         "mgf": ".mgf",
         "mzml": ".mzml",
+        "mzml_fast": ".mzml",
         "speclib_tsv": [".tsv", ".csv"],
     }
     global_ui_settings["model_mgr"]["transfer"]["ms_file_type"] = ms_file_type